@@ -1,16 +1,30 @@
+import hashlib
 import json
-from google import genai
-from google.genai import types
+import time
+from concurrent.futures import ThreadPoolExecutor
 import os
 from dotenv import load_dotenv
 import re
 
+# Before the local imports, which read their settings at import time
 load_dotenv()
 
+from metrics import (
+    stage, RETRIES, KEY_ROTATIONS, REPAIR_PATHS, FALLBACKS, VALIDATION_ISSUES, FIELD_REPAIRS,
+    UPSTREAM_TOKENS, FINISH_REASONS, TRUNCATIONS,
+)
+from deadline import RequestCancelled, DeadlineExceeded
+import budget
+import router
+import usage
+from state import get_state
+from validation import find_issues, repair_locally, validate_mermaid
+
 API_KEYS = os.getenv("API_KEYS", "").split(",")
 API_KEYS = [k.strip() for k in API_KEYS if k.strip()]
 if not API_KEYS:
-    raise ValueError("API_KEYS list is empty. Please set the API_KEYS environment variable.")
+    # Not fatal at import: the process still starts and reports itself as not ready
+    print("[WARN] API_KEYS list is empty. Generation will fail until API_KEYS is set.")
 
 SYSTEM_PROMPT = """You are an educational assistant AI.
 Your job is to respond as accurately as possible.
@@ -66,8 +80,39 @@ graph TD
 
 Return ONLY the mermaid code, nothing else."""
 
+FIELD_REPAIR_PROMPT = """You are fixing part of a lesson for this request:
+{topic}
+
+The lesson opens with:
+{context}
+
+These fields were rejected:
+{problems}
+
+Rewrite ONLY the fields {fields} so they are complete, correct and consistent
+with the rest of the lesson. Respond with a JSON object containing exactly those fields."""
+
+SEARCH_PROMPT = """Search the web for up-to-date, reliable information on:
+{topic}
+
+Write compact research notes for a teacher preparing a lesson on it: key facts,
+definitions, formulas, recent developments and common misconceptions, as plain
+bullet points. Mention which source each point comes from. No introduction."""
+
+CONTINUE_PROMPT = """Your previous answer was cut off by the output limit.
+Continue it from the exact character where it stopped. Do not repeat anything,
+do not restart the JSON object and do not add commentary or markdown fences."""
+
 
-current_key = 0
+# Regenerate only the fields that fail local validation instead of the whole lesson
+FIELD_REPAIR_ENABLED = os.getenv("FIELD_REPAIR_ENABLED", "1") == "1"
+
+# Output token budget per regenerated field
+FIELD_TOKEN_BUDGETS = {"further_questions": 256, "mermaid_diagram": 512, "code": 1536}
+DEFAULT_FIELD_TOKENS = 1024
+
+# How long a key that returned 401/403/429 is skipped by rotation, shared across workers
+KEY_COOLDOWN_SECONDS = float(os.getenv("KEY_COOLDOWN_SECONDS", "60"))
 
 SCHEMA = {
     "type": "object",
@@ -99,13 +144,208 @@ SCHEMA = {
 }
 
 
-def _get_client():
-    return genai.Client(api_key=API_KEYS[current_key])
+# Stamp stored on cached lessons. It changes with the system prompt, schema or
+# models, which marks everything cached before as stale; bump CACHE_VERSION to
+# force that by hand.
+GENERATION_VERSION = hashlib.sha256("\x1f".join([
+    SYSTEM_PROMPT,
+    json.dumps(SCHEMA, sort_keys=True),
+    json.dumps(router.MODEL_TIERS, sort_keys=True),
+    os.getenv("CACHE_VERSION", ""),
+]).encode("utf-8")).hexdigest()[:16]
+
+# Optional override of the Gemini endpoint, e.g. the local stand-in in bench/fake_gemini.py
+GENAI_BASE_URL = os.getenv("GENAI_BASE_URL")
+
+
+def _sdk():
+    """Import the Gemini SDK on first use; it is the slowest import in the app"""
+    from google import genai
+    from google.genai import types
+    return genai, types
+
+
+def _require_keys():
+    if not API_KEYS:
+        raise ValueError("API_KEYS list is empty. Please set the API_KEYS environment variable.")
+
 
+def _get_client(key_index=None):
+    _require_keys()
+    genai, types = _sdk()
+    api_key = API_KEYS[_current_key() if key_index is None else key_index]
+    if GENAI_BASE_URL:
+        return genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(base_url=GENAI_BASE_URL),
+        )
+    return genai.Client(api_key=api_key)
+
+
+# Upstream calls run here when a deadline or hedge is attached, so the caller can
+# stop waiting as soon as the request is cancelled instead of blocking on the socket.
+_upstream_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("UPSTREAM_THREADS", "32")),
+    thread_name_prefix="genai-upstream",
+)
+
+
+def _closer(client):
+    return lambda: getattr(client, "close", lambda: None)()
+
+
+def _call_upstream(client, deadline=None, hedge=None, validate=None, **kwargs):
+    """Run generate_content, abandoning it if the request is cancelled or out of time.
+
+    `hedge` is an optional (client, model) pair for a backup attempt that fires
+    once this call outlives the model's recent p95 latency; whichever response
+    passes `validate` first is returned.
+    """
+    if deadline is None and hedge is None:
+        return client.models.generate_content(**kwargs)
+
+    primary = (lambda: client.models.generate_content(**kwargs), _closer(client))
+    backup = None
+    if hedge is not None:
+        hedge_client, hedge_model = hedge
+        hedge_kwargs = dict(kwargs, model=hedge_model)
+        backup = (lambda: hedge_client.models.generate_content(**hedge_kwargs), _closer(hedge_client))
+
+    config = kwargs.get("config")
+    output_budget = getattr(config, "max_output_tokens", None) or 0
+    return router.race(
+        _upstream_pool,
+        primary,
+        backup,
+        delay=router.hedge_delay(kwargs["model"]),
+        is_valid=validate,
+        deadline=deadline,
+        hedge_cost=len(str(kwargs.get("contents", ""))) // 4 + output_budget,
+    )
+
+
+def _is_complete_json(response):
+    """Hedge validity check: a non-empty body that parses without any repair"""
+    text = getattr(response, "text", None)
+    if not text:
+        return False
+    try:
+        json.loads(text.strip())
+        return True
+    except json.JSONDecodeError:
+        return False
 
-def _rotate_key():
-    global current_key
-    current_key = (current_key + 1) % len(API_KEYS)
+
+def _finish_reason(response) -> str:
+    candidates = getattr(response, "candidates", None) or []
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    if reason is None:
+        return "UNKNOWN"
+    return getattr(reason, "name", str(reason))
+
+
+def _record_usage(response, model, key_index=None) -> int:
+    """Count the call's tokens in the metrics and the usage ledger; returns the
+    output tokens it spent (visible text plus thinking, which both count
+    against max_output_tokens)"""
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        usage.note_call(model, key_index)
+        return 0
+    prompt_tokens = metadata.prompt_token_count or 0
+    output_tokens = metadata.candidates_token_count or 0
+    thought_tokens = getattr(metadata, "thoughts_token_count", None) or 0
+    cached_tokens = getattr(metadata, "cached_content_token_count", None) or 0
+    UPSTREAM_TOKENS.inc(prompt_tokens, kind="prompt", model=model)
+    UPSTREAM_TOKENS.inc(output_tokens, kind="output", model=model)
+    if thought_tokens:
+        UPSTREAM_TOKENS.inc(thought_tokens, kind="thoughts", model=model)
+    if cached_tokens:
+        UPSTREAM_TOKENS.inc(cached_tokens, kind="cached", model=model)
+    usage.note_call(model, key_index, prompt_tokens, output_tokens, thought_tokens, cached_tokens)
+    return output_tokens + thought_tokens
+
+
+def _count_retry(key_index):
+    RETRIES.inc(key=key_index)
+    usage.note_retry()
+
+
+def _continue_generation(model, config_params, final_prompt, partial, deadline=None):
+    """Ask the model to carry on from where a MAX_TOKENS response stopped.
+
+    Returns (text, output_tokens, finished); `finished` is False when the rounds
+    ran out or a call failed, and the text is left for the JSON repair path.
+    """
+    _, types = _sdk()
+    # JSON mode would make the model open a new object instead of continuing this one
+    params = {k: v for k, v in config_params.items() if k not in ("response_mime_type", "response_schema")}
+    text, spent = partial, 0
+
+    for round_number in range(budget.CONTINUATION_ROUNDS):
+        if deadline is not None and not deadline.can_attempt():
+            print("[BUDGET] No time left to continue the truncated response")
+            break
+        contents = [
+            types.Content(role="user", parts=[types.Part(text=final_prompt)]),
+            types.Content(role="model", parts=[types.Part(text=text)]),
+            types.Content(role="user", parts=[types.Part(text=CONTINUE_PROMPT)]),
+        ]
+        key_index = _current_key()
+        try:
+            with stage("upstream_continue"):
+                response = _call_upstream(
+                    _get_client(key_index),
+                    deadline,
+                    model=model,
+                    config=_attempt_config(params, deadline),
+                    contents=contents
+                )
+        except (RequestCancelled, DeadlineExceeded):
+            raise
+        except Exception as e:
+            print(f"[BUDGET] Continuation failed: {e}")
+            if getattr(e, "code", None) in [401, 403, 429]:
+                get_state().mark_key_cooldown(key_index, KEY_COOLDOWN_SECONDS)
+                _rotate_key(key_index)
+            break
+
+        piece = getattr(response, "text", None) if response is not None else None
+        if not piece:
+            break
+        spent += _record_usage(response, model, key_index)
+        piece = re.sub(r'^\s*```(?:json)?\s*\n', '', piece)
+        piece = re.sub(r'\n?```\s*$', '', piece)
+        text += piece
+        finish = _finish_reason(response)
+        print(f"[BUDGET] Continuation #{round_number + 1}: +{len(piece)} characters, finish={finish}")
+        if finish != "MAX_TOKENS":
+            return text, spent, True
+
+    return text, spent, False
+
+
+def _attempt_config(config_params, deadline):
+    """Build the per-attempt config, passing the remaining budget as the HTTP timeout"""
+    _, types = _sdk()
+    if deadline is None:
+        return types.GenerateContentConfig(**config_params)
+    timeout_ms = max(int(deadline.attempt_timeout() * 1000), 1000)
+    return types.GenerateContentConfig(
+        **config_params,
+        http_options=types.HttpOptions(timeout=timeout_ms),
+    )
+
+
+def _current_key():
+    return get_state().current_key(len(API_KEYS))
+
+
+def _rotate_key(from_index=None):
+    if from_index is None:
+        from_index = _current_key()
+    current_key = get_state().advance_key(from_index, len(API_KEYS))
+    KEY_ROTATIONS.inc()
     print(f"[API KEY ROTATION] -> Now using key #{current_key} / Total Keys: {len(API_KEYS)}")
 
 
@@ -160,33 +400,41 @@ def _repair_truncated_json(json_str, error_pos=None):
 
 def _validate_and_fix_json(raw_text):
     try:
-        parsed = json.loads(raw_text)
+        with stage("parse_json"):
+            parsed = json.loads(raw_text)
         print("[VALIDATION] JSON is valid as-is")
+        REPAIR_PATHS.inc(path="as_is")
         return parsed
     except json.JSONDecodeError as e:
         print(f"[JSON ERROR] {e}")
 
-    extracted = _extract_json_from_text(raw_text)
+    with stage("extract_json"):
+        extracted = _extract_json_from_text(raw_text)
     if extracted and extracted != raw_text:
         try:
             parsed = json.loads(extracted)
             print("[VALIDATION] Extracted JSON from markdown")
+            REPAIR_PATHS.inc(path="extracted")
             return parsed
         except json.JSONDecodeError:
             raw_text = extracted
 
     try:
-        fixed = _fix_unescaped_characters(raw_text)
+        with stage("fix_unescaped"):
+            fixed = _fix_unescaped_characters(raw_text)
         parsed = json.loads(fixed)
         print("[VALIDATION] Fixed unescaped characters")
+        REPAIR_PATHS.inc(path="unescaped")
         return parsed
     except json.JSONDecodeError as e:
         pass
 
     try:
-        repaired = _repair_truncated_json(raw_text, e.pos if 'e' in locals() else None)
+        with stage("repair_truncated"):
+            repaired = _repair_truncated_json(raw_text, e.pos if 'e' in locals() else None)
         parsed = json.loads(repaired)
         print("[VALIDATION] Repaired truncated JSON")
+        REPAIR_PATHS.inc(path="truncated")
         return parsed
     except json.JSONDecodeError:
         pass
@@ -207,6 +455,8 @@ def _validate_and_fix_json(raw_text):
                 "code": ""
             }
             print(f"[VALIDATION] Returning fallback response: {json.dumps(fallback, indent=2)}")
+            REPAIR_PATHS.inc(path="partial_fallback")
+            FALLBACKS.inc(reason="partial_recovery")
             return fallback
     except Exception:
         pass
@@ -214,22 +464,175 @@ def _validate_and_fix_json(raw_text):
     raise ValueError(f"Could not parse or repair JSON response. Length: {len(raw_text)}")
 
 
-def _ensure_schema_compliance(data):
-    """Ensure the parsed data contains all required fields from the schema."""
-    required_fields = SCHEMA["required"]
+def _ensure_schema_compliance(data, schema=SCHEMA):
+    """Fill missing fields, coerce types and restore LaTeX escapes, all locally."""
+    fixes = repair_locally(data, schema)
+    if fixes:
+        print(f"[SCHEMA FIX] Repaired {fixes} problem(s) locally")
+        FIELD_REPAIRS.inc(fixes, outcome="local")
+    return data
+
 
-    for field in required_fields:
-        if field not in data:
-            print(f"[SCHEMA FIX] Missing required field: {field}")
-            if field == "further_questions":
-                data[field] = []
-            else:
-                data[field] = ""
+def _field_schema(fields, schema=SCHEMA):
+    """The part of `schema` covering only `fields`"""
+    return {
+        "type": "object",
+        "properties": {f: schema["properties"][f] for f in fields},
+        "required": list(fields),
+    }
+
+
+def _regenerate_fields(prompt, data, problems, schema=SCHEMA, deadline=None, max_attempts=2):
+    """Ask for just the broken fields under a narrowed schema, so the cost scales
+    with those fields rather than the whole lesson. Returns the fields that came
+    back valid."""
+    fields = list(problems)
+    repair_prompt = FIELD_REPAIR_PROMPT.format(
+        topic=prompt,
+        context=str(data.get("foundations") or "(empty)")[:600],
+        problems="\n".join(f"- {field}: {'; '.join(details)}" for field, details in problems.items()),
+        fields=", ".join(fields),
+    )
+    sub_schema = _field_schema(fields, schema)
+    config_params = {
+        "system_instruction": SYSTEM_PROMPT,
+        "temperature": 0.3,
+        "max_output_tokens": min(sum(FIELD_TOKEN_BUDGETS.get(f, DEFAULT_FIELD_TOKENS) for f in fields), 8192),
+        "response_mime_type": "application/json",
+        "response_schema": sub_schema,
+    }
+
+    for attempt in range(max_attempts):
+        if deadline is not None and not deadline.can_attempt():
+            print("[FIELDS] No budget left to regenerate fields")
+            break
+        key_index = _current_key()
+        try:
+            client = _get_client(key_index)
+            with stage("upstream_fields"):
+                response = _call_upstream(
+                    client,
+                    deadline,
+                    model=router.model_for("standard"),
+                    config=_attempt_config(config_params, deadline),
+                    contents=repair_prompt
+                )
+            if response is not None:
+                _record_usage(response, router.model_for("standard"), key_index)
+            if not response or not response.text:
+                raise ValueError("empty response")
+
+            parsed = _validate_and_fix_json(response.text.strip())
+            parsed = {f: parsed[f] for f in fields if f in parsed}
+            repair_locally(parsed, sub_schema)
+            still_broken = {field for field, _, _ in find_issues(parsed, sub_schema)}
+            fixed = {f: parsed[f] for f in fields if f not in still_broken}
+            print(f"[FIELDS] Regenerated {len(fixed)}/{len(fields)} field(s) (attempt {attempt + 1})")
+            return fixed
+
+        except (RequestCancelled, DeadlineExceeded):
+            raise
+        except Exception as e:
+            print(f"[FIELDS] Attempt {attempt + 1} failed: {e}")
+            if getattr(e, "code", None) in [401, 403, 429]:
+                get_state().mark_key_cooldown(key_index, KEY_COOLDOWN_SECONDS)
+            _count_retry(key_index)
+            if attempt < max_attempts - 1:
+                _rotate_key(key_index)
 
-    if "further_questions" in data and not isinstance(data["further_questions"], list):
-        print("[SCHEMA FIX] Converting further_questions to list")
-        data["further_questions"] = [str(data["further_questions"])]
+    return {}
 
+
+def regenerate_field(prompt, data, field, reason=None, deadline=None):
+    """Regenerate one field of an existing lesson and return its new value"""
+    _require_keys()
+    if field not in SCHEMA["properties"]:
+        raise ValueError(f"Unknown field: {field}")
+    problems = {field: [reason or "the user asked for a better version"]}
+    fixed = _regenerate_fields(prompt, data, problems, deadline=deadline)
+    if field not in fixed:
+        raise ValueError(f"Could not regenerate a valid {field}")
+    return fixed[field]
+
+
+def grounded_search(prompt, deadline=None, max_attempts=2):
+    """First stage of search-grounded generation: a Google Search call that
+    returns {"notes": text, "sources": [{"title", "uri"}]}. Tools can't be
+    combined with response_schema, so the lesson itself is a separate call."""
+    _require_keys()
+    _, types = _sdk()
+    config_params = {
+        "temperature": 0.2,
+        "max_output_tokens": 2048,
+        "tools": [types.Tool(google_search=types.GoogleSearch())],
+    }
+    search_prompt = SEARCH_PROMPT.format(topic=prompt)
+
+    last_error = None
+    for attempt in range(max_attempts):
+        if deadline is not None:
+            deadline.check()
+        key_index = _current_key()
+        try:
+            with stage("upstream_search"):
+                response = _call_upstream(
+                    _get_client(key_index),
+                    deadline,
+                    model=router.model_for("standard"),
+                    config=_attempt_config(config_params, deadline),
+                    contents=search_prompt
+                )
+            if response is not None:
+                _record_usage(response, router.model_for("standard"), key_index)
+            notes = (getattr(response, "text", None) or "").strip() if response is not None else ""
+            if not notes:
+                raise ValueError("empty search response")
+
+            sources = []
+            candidates = getattr(response, "candidates", None) or []
+            metadata = getattr(candidates[0], "grounding_metadata", None) if candidates else None
+            for chunk in (getattr(metadata, "grounding_chunks", None) or []):
+                web = getattr(chunk, "web", None)
+                if web is not None and web.uri and all(s["uri"] != web.uri for s in sources):
+                    sources.append({"title": web.title or web.domain or web.uri, "uri": web.uri})
+            print(f"[SEARCH] {len(notes)} characters of notes, {len(sources)} source(s)")
+            return {"notes": notes, "sources": sources}
+
+        except (RequestCancelled, DeadlineExceeded):
+            raise
+        except Exception as e:
+            last_error = e
+            print(f"[SEARCH] Attempt {attempt + 1} failed: {e}")
+            if getattr(e, "code", None) in [401, 403, 429]:
+                get_state().mark_key_cooldown(key_index, KEY_COOLDOWN_SECONDS)
+            _count_retry(key_index)
+            if attempt < max_attempts - 1:
+                _rotate_key(key_index)
+
+    raise ValueError(f"Grounded search failed: {last_error}")
+
+
+def _quality_gate(prompt, data, schema=SCHEMA, deadline=None):
+    """Check the locally repaired response and regenerate only what is still broken.
+
+    Diagrams are left to the simple-diagram fallback in ai().
+    """
+    problems = {}
+    for field, kind, detail in find_issues(data, schema):
+        VALIDATION_ISSUES.inc(field=field, kind=kind)
+        if field != "mermaid_diagram":
+            problems.setdefault(field, []).append(detail)
+    if not problems or not FIELD_REPAIR_ENABLED:
+        return data
+
+    print(f"[QUALITY] Regenerating {', '.join(problems)}: {problems}")
+    with stage("field_repair"):
+        fixed = _regenerate_fields(prompt, data, problems, schema, deadline)
+    data.update(fixed)
+    if fixed:
+        FIELD_REPAIRS.inc(len(fixed), outcome="regenerated")
+    if len(fixed) < len(problems):
+        FIELD_REPAIRS.inc(len(problems) - len(fixed), outcome="failed")
     return data
 
 
@@ -246,25 +649,31 @@ def _normalize_json_response(data):
     return data
 
 
-def _generate_simple_diagram(topic, max_attempts=2):
+def _generate_simple_diagram(topic, max_attempts=2, deadline=None):
     """Generate a simple mermaid diagram with retry logic"""
     print(f"[DIAGRAM] Attempting to generate simple diagram for topic: {topic}")
     
     for attempt in range(max_attempts):
+        if deadline is not None and not deadline.can_attempt():
+            print("[DIAGRAM] No budget left for another diagram attempt")
+            break
+        key_index = _current_key()
         try:
-            client = _get_client()
+            client = _get_client(key_index)
             prompt = SIMPLE_DIAGRAM_PROMPT.format(topic=topic)
             
-            config = types.GenerateContentConfig(
-                temperature=0.1,
-                max_output_tokens=500,
-            )
+            config = _attempt_config({"temperature": 0.1, "max_output_tokens": 500}, deadline)
             
-            response = client.models.generate_content(
-                model="gemini-2.0-flash-exp",
-                config=config,
-                contents=prompt
-            )
+            with stage("upstream_diagram"):
+                response = _call_upstream(
+                    client,
+                    deadline,
+                    model=router.model_for("diagram"),
+                    config=config,
+                    contents=prompt
+                )
+            if response is not None:
+                _record_usage(response, router.model_for("diagram"), key_index)
             
             if response and response.text:
                 diagram = response.text.strip()
@@ -273,52 +682,50 @@ def _generate_simple_diagram(topic, max_attempts=2):
                 print(f"[DIAGRAM] Successfully generated simple diagram (attempt {attempt + 1})")
                 return diagram
                 
+        except (RequestCancelled, DeadlineExceeded):
+            raise
         except Exception as e:
             print(f"[DIAGRAM] Attempt {attempt + 1} failed: {e}")
+            _count_retry(key_index)
             if attempt < max_attempts - 1:
-                _rotate_key()
+                _rotate_key(key_index)
             
     print("[DIAGRAM] All attempts to generate simple diagram failed")
     return ""
 
 
 def _validate_mermaid_diagram(diagram):
-    """Check if a mermaid diagram is likely to be valid"""
-    if not diagram or not diagram.strip():
-        return False
-    
-    # Check for common error indicators
-    error_indicators = [
-        'Diagram Not Available',
-        'Diagram Error',
-        'Please try regenerating',
-        'No diagram available',
-        'Error',
-        'Failed'
-    ]
-    
-    for indicator in error_indicators:
-        if indicator in diagram:
-            return False
-    
-    # Check if it has basic mermaid structure
-    diagram_lower = diagram.lower()
-    valid_types = ['graph', 'flowchart', 'sequencediagram', 'classdiagram', 'pie', 'journey', 'gantt']
-    
-    has_valid_type = any(diagram_lower.startswith(t) for t in valid_types)
-    has_arrows = '-->' in diagram or '---' in diagram
-    
-    return has_valid_type or has_arrows
-
-
-def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None, max_retries=3):
+    """Check a mermaid diagram against the local grammar"""
+    errors = validate_mermaid(diagram)
+    for error in errors[:3]:
+        print(f"[DIAGRAM] {error}")
+    return not errors
+
+
+def warm_up():
+    """Load the SDK and build a client per key so the first request doesn't pay for it"""
+    _require_keys()
+    with stage("warm_up"):
+        for index in range(len(API_KEYS)):
+            _closer(_get_client(index))()
+    print(f"[STARTUP] Gemini SDK loaded, {len(API_KEYS)} key(s) configured")
+
+
+def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None, max_retries=3, deadline=None,
+       context=None):
+    """Generate a lesson for `prompt`. `context` is reference material (e.g.
+    grounded search notes) appended to the prompt; routing, budgets and the
+    cache key still go by the prompt alone."""
+    _require_keys()
+    prompt = budget.clip_prompt(prompt)
     config_params = {
         "system_instruction": SYSTEM_PROMPT,
         "temperature": 0.3,
-        "max_output_tokens": 8192,
+        "max_output_tokens": budget.estimate(prompt, difficulty_level),
     }
 
     if use_search:
+        _, types = _sdk()
         grounding_tool = types.Tool(
             google_search=types.GoogleSearch()
         )
@@ -328,8 +735,6 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
         config_params["response_mime_type"] = "application/json"
         config_params["response_schema"] = schema
 
-    config = types.GenerateContentConfig(**config_params)
-
     control_tokens = []
     if age is not None:
         control_tokens.append(f"Age Group: {age}")
@@ -341,35 +746,69 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
         final_prompt = prompt + control_string
     else:
         final_prompt = prompt
+    if context:
+        final_prompt += "\n\n" + context
+
+    model = router.choose_model(prompt, difficulty_level)
 
     total_attempts = len(API_KEYS) * max_retries
     attempt_count = 0
 
     while attempt_count < total_attempts:
-        client = _get_client()
+        if deadline is not None:
+            # Don't start an attempt that can't finish or that nobody will read
+            deadline.check()
+        key_index = _current_key()
+        client = _get_client(key_index)
+        hedge = None
+        if router.HEDGE_ENABLED:
+            # Spread the hedge over another key; with a single key, over another model
+            if len(API_KEYS) > 1:
+                hedge = (_get_client((key_index + 1) % len(API_KEYS)), model)
+            else:
+                hedge = (_get_client(key_index), router.hedge_model(model))
         try:
-            print(f"Attempting API call #{attempt_count + 1}/{total_attempts} (Key #{current_key}). Search={use_search}")
-
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                config=config,
-                contents=final_prompt
-            )
+            print(f"Attempting API call #{attempt_count + 1}/{total_attempts} (Key #{key_index}, {model}). Search={use_search}")
+
+            started = time.perf_counter()
+            with stage("upstream"):
+                response = _call_upstream(
+                    client,
+                    deadline,
+                    hedge=hedge,
+                    validate=(lambda r: bool(getattr(r, "text", None))) if use_search else _is_complete_json,
+                    model=model,
+                    config=_attempt_config(config_params, deadline),
+                    contents=final_prompt
+                )
+            router.record_latency(model, time.perf_counter() - started)
 
             if response is None:
                 print("[ERROR] Response is None")
+                _count_retry(key_index)
                 attempt_count += 1
-                _rotate_key()
+                _rotate_key(key_index)
                 continue
 
             raw_text = response.text
 
             if raw_text is None:
                 print("[ERROR] response.text is None")
+                _count_retry(key_index)
                 attempt_count += 1
-                _rotate_key()
+                _rotate_key(key_index)
                 continue
 
+            output_tokens = _record_usage(response, model, key_index)
+            finish = _finish_reason(response)
+            FINISH_REASONS.inc(reason=finish)
+            if finish == "MAX_TOKENS" and not use_search:
+                print(f"[BUDGET] Truncated at {config_params['max_output_tokens']} output tokens, continuing")
+                raw_text, spent, finished = _continue_generation(model, config_params, final_prompt, raw_text, deadline)
+                output_tokens += spent
+                TRUNCATIONS.inc(outcome="continued" if finished else "repaired")
+            budget.record(prompt, difficulty_level, output_tokens)
+
             raw_text = raw_text.strip()
 
             if use_search:
@@ -379,9 +818,14 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
             else:
                 print(f"JSON Mode: Received {len(raw_text)} characters")
 
-                parsed = _validate_and_fix_json(raw_text)
-                parsed = _ensure_schema_compliance(parsed)
-                parsed = _normalize_json_response(parsed)
+                with stage("validate_json"):
+                    parsed = _validate_and_fix_json(raw_text)
+                with stage("schema_compliance"):
+                    parsed = _ensure_schema_compliance(parsed, schema)
+                with stage("quality_gate"):
+                    parsed = _quality_gate(final_prompt, parsed, schema, deadline)
+                with stage("normalize"):
+                    parsed = _normalize_json_response(parsed)
 
                 # Validate and retry diagram generation if needed
                 if "mermaid_diagram" in parsed:
@@ -389,7 +833,8 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
                         print("[DIAGRAM] Invalid diagram detected, attempting simple diagram generation")
                         # Extract topic from prompt for simple diagram
                         topic = prompt[:100] if len(prompt) > 100 else prompt
-                        simple_diagram = _generate_simple_diagram(topic)
+                        with stage("diagram_regeneration"):
+                            simple_diagram = _generate_simple_diagram(topic, deadline=deadline)
                         if simple_diagram and _validate_mermaid_diagram(simple_diagram):
                             parsed["mermaid_diagram"] = simple_diagram
                             print("[DIAGRAM] Successfully replaced with simple diagram")
@@ -404,26 +849,34 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
                     return parsed
                 except Exception as e:
                     print(f"[VALIDATION ERROR] Final serialization check failed: {e}")
+                    _count_retry(key_index)
                     attempt_count += 1
                     if attempt_count < total_attempts:
-                        _rotate_key()
+                        _rotate_key(key_index)
                     continue
 
+        except (RequestCancelled, DeadlineExceeded) as e:
+            print(f"[DEADLINE] Stopping retries: {e}")
+            raise
+
         except (json.JSONDecodeError, ValueError) as e:
             print(f"[JSON ERROR] {e}")
             if 'raw_text' in locals():
                 print(f"[DEBUG] First 500 chars: {raw_text[:500]}")
                 print(f"[DEBUG] Last 500 chars: {raw_text[-500:]}")
+            _count_retry(key_index)
             attempt_count += 1
             if attempt_count < total_attempts:
-                _rotate_key()
+                _rotate_key(key_index)
 
         except Exception as e:
             code = getattr(e, "code", None)
 
             if code in [401, 403, 429]:
                 print(f"[ERROR {code}] API Key failed or Rate Limit exceeded.")
-                _rotate_key()
+                get_state().mark_key_cooldown(key_index, KEY_COOLDOWN_SECONDS)
+                _rotate_key(key_index)
+                _count_retry(key_index)
                 attempt_count += 1
 
             elif "responseSchema" in str(e) or ("tools" in str(e) and use_search is False):
@@ -436,7 +889,8 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
 
             else:
                 print(f"[WARN] Error: {e}. Retrying...")
-                _rotate_key()
+                _rotate_key(key_index)
+                _count_retry(key_index)
                 attempt_count += 1
 
     error_response = {
@@ -452,4 +906,5 @@ def ai(prompt, schema=SCHEMA, use_search=False, age=None, difficulty_level=None,
         "code": ""
     }
     print(f"[FINAL FALLBACK] Returning error response:\n{json.dumps(error_response, indent=2)}")
+    FALLBACKS.inc(reason="all_attempts_failed")
     return error_response
\ No newline at end of file
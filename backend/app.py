@@ -1,35 +1,89 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, WebSocket
+from fastapi.responses import RedirectResponse, PlainTextResponse, Response, JSONResponse
+from profiling import run_in_threadpool, ProfilingMiddleware, is_admin, list_profiles, get_profile
 from pydantic import BaseModel
-from ai import ai  # your AI wrapper
+from ai import ai, warm_up, regenerate_field, SCHEMA, GENERATION_VERSION  # your AI wrapper
+from metrics import stage, render_metrics, CACHE_HITS, CACHE_MISSES, CACHE_REFRESHES
+from cache import prompt_cache_key, is_cacheable
+from compression import encode_payload, decode_payload
+from state import get_state
+from http_compression import CompressionMiddleware, negotiate, render_json, encode_variants, precompressed_headers
+from deadline import Deadline, RequestCancelled, DeadlineExceeded, REQUEST_BUDGET_SECONDS
+import asyncio
+import hashlib
 import json
 import os
 import re
+from datetime import datetime, timedelta
 from typing import List
 
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
 # Import authentication modules
-from auth import oauth, create_access_token, get_current_user, get_or_create_user, FRONTEND_URL, SECRET_KEY
+from auth import get_oauth, create_access_token, get_current_user, get_optional_user, get_or_create_user, user_from_token, FRONTEND_URL, SECRET_KEY
 from database import (
-    get_db, init_db,
+    SessionLocal, get_db, init_db,
     create_chat_session, get_user_sessions, get_session_by_id,
     update_session_title, delete_chat_session,
-    add_message, get_session_messages
+    add_message, get_session_messages, get_session_messages_after, find_cached_payload, remember_generated,
+    get_sessions_version, get_session_version,
+    get_message_by_id, get_message_prompt, update_message_data,
+    get_usage_by_day
 )
 from models import (
     UserResponse, TokenResponse,
     ChatSessionCreate, ChatSessionResponse, ChatSessionDetail,
-    ChatMessageCreate, ChatMessageResponse
+    ChatMessageCreate, ChatMessageResponse, MessageSearchResult,
+    FieldRegenerateRequest, FieldRegenerateResponse,
+    UsageResponse, UsageTotals, UsageDay
 )
+from search import search_messages, search_enabled
+from health import mark_started, mark_failed, probe_loop, readiness
+import prefetch
+from grounding import generate_grounded
+from popularity import tracker as popularity
+from archive import rehydrate_session, remove_archive, compaction_loop
+import usage
+from metrics import WS_CONNECTIONS, WS_TURNS
+from ws_chat import ChatChannel, ChannelClosed, WS_MAX_QUEUED_TURNS, WS_AUTH_TIMEOUT, POLICY_VIOLATION
 
 app = FastAPI()
 
+def _warm_upstreams():
+    try:
+        warm_up()
+        mark_started("upstream")
+    except Exception as e:
+        mark_failed("upstream", str(e))
+        print(f"[STARTUP] Upstream warm-up failed: {e}")
+
+
+_probe_task = None
+_archive_task = None
+
+
 # Initialize database on startup
 @app.on_event("startup")
 async def startup_event():
+    global _probe_task, _archive_task
     init_db()
+    mark_started("database")
+    # Loading the Gemini SDK is slow; do it off the event loop so the
+    # worker starts serving (and answering /health/live) right away
+    asyncio.get_running_loop().run_in_executor(None, _warm_upstreams)
+    _probe_task = asyncio.create_task(probe_loop())
+    _archive_task = asyncio.create_task(compaction_loop())
+    prefetch.start(_prefetch_generate, _is_stale)
+    usage.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in (_probe_task, _archive_task):
+        if task is not None:
+            task.cancel()
+    usage.stop()
 
 # Add SessionMiddleware for OAuth
 app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
@@ -40,11 +94,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# Outside CORS, so it sees the final headers and body of every response
+app.add_middleware(CompressionMiddleware)
+
+# Outermost, so a profile covers everything including compression
+app.add_middleware(ProfilingMiddleware)
+
 class Prompt(BaseModel):
     prompt: str
     session_id: str | None = None  # optional: auto-save to session
+    search: bool = False  # ground the lesson in a web search first
+
+    def cache_key(self) -> str:
+        return prompt_cache_key(self.prompt, mode="search" if self.search else None)
 
 def sanitize_mermaid_text(text: str) -> str:
     text = re.sub(r'<br\s*/?>', r'\n', text, flags=re.IGNORECASE)
@@ -121,6 +186,61 @@ def sanitize_ai_json(json_str: str) -> dict:
 def health():
     return {"status": "yo im fine"}
 
+@app.get("/health/live")
+def health_live():
+    """The process is up and serving requests"""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def health_ready():
+    """Startup, database, key pool and cache status from the background probes;
+    503 while any of them is failing so the worker is taken out of rotation"""
+    ready, report = readiness()
+    return JSONResponse(report, status_code=200 if ready else 503)
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# ── Admin: profiles ─────────────────────────────────────
+
+def _require_admin(request: Request):
+    if not is_admin(request.headers.get("x-admin-token", "")):
+        # Same answer as a missing route, so the endpoints aren't advertised
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+@app.get("/admin/profiles", dependencies=[Depends(_require_admin)])
+def admin_profiles():
+    """Profiles kept by this worker, newest first"""
+    return list_profiles()
+
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(_require_admin)])
+def admin_profile(profile_id: str, format: str = Query("collapsed", pattern="^(collapsed|pstats|text)$")):
+    """One profile: collapsed stacks (for flamegraph.pl / speedscope), or for
+    cProfile runs the raw pstats file or a text report"""
+    profile = get_profile(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found (it may have been evicted, or be on another worker)")
+    if format == "collapsed":
+        if profile.mode != "sample":
+            raise HTTPException(status_code=400, detail="Collapsed stacks are only recorded in sample mode")
+        return PlainTextResponse(
+            profile.collapsed(),
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile.id}.collapsed"'},
+        )
+    if profile.stats is None:
+        raise HTTPException(status_code=400, detail="No cProfile stats recorded for this profile")
+    if format == "text":
+        return PlainTextResponse(profile.pstats_text())
+    return Response(
+        content=profile.pstats_dump(),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile.id}.pstats"'},
+    )
+
+
 @app.get("/")
 def root():
     return {"about": "created by datavorous"}
@@ -132,14 +252,14 @@ def root():
 async def google_login(request: Request):
     """Initiate Google OAuth flow"""
     redirect_uri = request.url_for('google_callback')
-    return await oauth.google.authorize_redirect(request, redirect_uri)
+    return await get_oauth().google.authorize_redirect(request, redirect_uri)
 
 
 @app.get("/auth/google/callback")
 async def google_callback(request: Request, db=Depends(get_db)):
     """Handle Google OAuth callback"""
     try:
-        token = await oauth.google.authorize_access_token(request)
+        token = await get_oauth().google.authorize_access_token(request)
         user_info = token.get('userinfo')
         if not user_info:
             raise HTTPException(status_code=400, detail="Failed to get user info")
@@ -165,6 +285,25 @@ async def get_user(current_user=Depends(get_current_user)):
     return current_user
 
 
+@app.get("/usage", response_model=UsageResponse)
+async def get_usage(
+    days: int = Query(7, ge=1, le=90),
+    current_user=Depends(get_current_user),
+    db=Depends(get_db)
+):
+    """The user's generation usage today, against the daily quota, and per day
+    and feature for the last `days` days (written rollups only)"""
+    today = usage.usage_today(db, current_user.id)
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    return UsageResponse(
+        today=UsageTotals(**today),
+        tokens_today=usage.spent_tokens(today),
+        daily_token_quota=usage.USAGE_DAILY_TOKEN_QUOTA or None,
+        days=[UsageDay(day=day, feature=feature, **totals)
+              for day, feature, totals in get_usage_by_day(db, current_user.id, since)],
+    )
+
+
 @app.post("/auth/logout")
 async def logout():
     """Logout user (client-side token removal)"""
@@ -173,6 +312,51 @@ async def logout():
 
 # ── Chat Session Routes ─────────────────────────────────
 
+# Responses may be cached by the browser but must be revalidated every time,
+# which is what turns repeat fetches into If-None-Match round trips
+SESSION_CACHE_CONTROL = "private, no-cache"
+
+
+def _etag(*parts) -> str:
+    """Strong validator for a representation identified by `parts`"""
+    digest = hashlib.sha256("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def _not_modified(request: Request, etag: str):
+    """A 304 for the request if its If-None-Match already has `etag`, else None"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    # If-None-Match uses the weak comparison, so a W/ prefix still matches
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    if "*" in candidates or etag in candidates:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": SESSION_CACHE_CONTROL})
+    return None
+
+
+def _session_access(db, session_id: str, user_id: int):
+    """The session's version tuple after the 404/403 checks, with its messages
+    brought back first if the session was archived"""
+    version = get_session_version(db, session_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if version[0] != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if version[4] is not None:
+        _rehydrate(db, session_id)
+        version = get_session_version(db, session_id)
+    return version
+
+
+def _rehydrate(db, session_id: str):
+    try:
+        rehydrate_session(db, session_id)
+    except Exception as e:
+        print(f"[ARCHIVE] Could not rehydrate session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Archived session could not be restored")
+
+
 @app.post("/sessions", response_model=ChatSessionResponse)
 async def create_session(
     body: ChatSessionCreate,
@@ -198,10 +382,21 @@ async def create_session(
 
 @app.get("/sessions", response_model=List[ChatSessionResponse])
 async def list_sessions(
+    request: Request,
+    response: Response,
     current_user=Depends(get_current_user),
     db=Depends(get_db)
 ):
-    """List user's chat sessions, newest first"""
+    """List user's chat sessions, newest first. Answers 304 when If-None-Match
+    matches, after a single aggregate query."""
+    count, newest = get_sessions_version(db, current_user.id)
+    etag = _etag("sessions", current_user.id, count, newest)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = SESSION_CACHE_CONTROL
+
     sessions = get_user_sessions(db, current_user.id)
     result = []
     for s in sessions:
@@ -211,24 +406,53 @@ async def list_sessions(
             title=s.title,
             created_at=s.created_at,
             updated_at=s.updated_at,
-            message_count=len(s.messages)
+            message_count=s.archived_messages if s.archived_at else len(s.messages)
         ))
     return result
 
 
+@app.get("/sessions/search", response_model=List[MessageSearchResult])
+async def search_sessions(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user=Depends(get_current_user),
+    db=Depends(get_db)
+):
+    """Full-text search over the user's chat history, best matches first"""
+    if not search_enabled():
+        raise HTTPException(status_code=503, detail="Search is not available")
+    hits = search_messages(db, current_user.id, q, limit=limit, offset=offset)
+    return [MessageSearchResult(
+        message_id=h["id"],
+        session_id=h["session_id"],
+        session_title=h["title"],
+        role=h["role"],
+        snippet=h["snippet"] or "",
+        rank=h["rank"],
+        created_at=h["created_at"]
+    ) for h in hits]
+
+
 @app.get("/sessions/{session_id}", response_model=ChatSessionDetail)
 async def get_session(
     session_id: str,
+    request: Request,
+    response: Response,
     current_user=Depends(get_current_user),
     db=Depends(get_db)
 ):
-    """Get a chat session with all messages"""
-    session = get_session_by_id(db, session_id)
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    if session.user_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not authorized")
+    """Get a chat session with all messages. Answers 304 when If-None-Match
+    matches, without loading any message rows."""
+    _, updated_at, message_count, last_id, _ = _session_access(db, session_id, current_user.id)
+    etag = _etag("session", session_id, updated_at, message_count, last_id)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = SESSION_CACHE_CONTROL
 
+    session = get_session_by_id(db, session_id)
     messages = get_session_messages(db, session_id)
     return ChatSessionDetail(
         id=session.id,
@@ -248,6 +472,38 @@ async def get_session(
     )
 
 
+@app.get("/sessions/{session_id}/messages", response_model=List[ChatMessageResponse])
+async def get_new_session_messages(
+    session_id: str,
+    request: Request,
+    response: Response,
+    after: int = Query(0, ge=0),
+    current_user=Depends(get_current_user),
+    db=Depends(get_db)
+):
+    """Messages newer than message id `after`, for clients that already hold
+    the rest of the session. Edits to older messages (e.g. a regenerated
+    field) are not included; they change the session's ETag instead."""
+    _, updated_at, message_count, last_id, _ = _session_access(db, session_id, current_user.id)
+    etag = _etag("session-after", session_id, after, updated_at, message_count, last_id)
+    not_modified = _not_modified(request, etag)
+    if not_modified:
+        return not_modified
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = SESSION_CACHE_CONTROL
+
+    if last_id is None or last_id <= after:
+        return []
+    return [ChatMessageResponse(
+        id=m.id,
+        session_id=m.session_id,
+        role=m.role,
+        content=m.content,
+        data=m.data,
+        created_at=m.created_at
+    ) for m in get_session_messages_after(db, session_id, after)]
+
+
 @app.post("/sessions/{session_id}/messages", response_model=ChatMessageResponse)
 async def add_session_message(
     session_id: str,
@@ -261,6 +517,8 @@ async def add_session_message(
         raise HTTPException(status_code=404, detail="Session not found")
     if session.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized")
+    if session.archived_at is not None:
+        _rehydrate(db, session_id)
 
     message = add_message(
         db=db,
@@ -299,29 +557,500 @@ async def remove_session(
         raise HTTPException(status_code=403, detail="Not authorized")
 
     delete_chat_session(db, session_id)
+    remove_archive(session_id)
     return {"message": "Session deleted"}
 
 
 # ── Content Generation Routes ────────────────────────────
 
+async def _cancel_on_disconnect(request: Request, deadline: Deadline):
+    """Flag the deadline as cancelled once the client hangs up"""
+    while not deadline.cancelled:
+        if await request.is_disconnected():
+            print("[GENERATE] Client disconnected, cancelling upstream work")
+            deadline.cancel()
+            return
+        await asyncio.sleep(0.5)
+
+
+# Serve a stored response when the same prompt was answered before. Only
+# lessons this server generated are eligible; databases that predate that
+# rule need `python migrations.py clear-prompt-keys` first.
+HISTORY_CACHE_ENABLED = os.getenv("HISTORY_CACHE_ENABLED", "0") == "1"
+
+# Shared response cache lifetime, in seconds
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+
+# /generate requests per client IP per minute (0 disables the limit)
+GENERATE_RATE_LIMIT = int(os.getenv("GENERATE_RATE_LIMIT", "0"))
+
+
+def _cache_response(key: str, data, blob: bytes = None, version: str = GENERATION_VERSION):
+    """Put a lesson in the shared cache, along with its response body in every
+    encoding so later hits are sent without serializing or compressing.
+
+    `version` stamps which prompt/schema/model produced it: "" for unknown,
+    None to keep the stamp already stored.
+    """
+    state = get_state()
+    state.cache_set(key, blob if blob is not None else encode_payload(data), ttl=RESPONSE_CACHE_TTL)
+    for encoding, body in encode_variants(render_json(data)).items():
+        state.cache_set(f"{key}:body:{encoding}", body, ttl=RESPONSE_CACHE_TTL)
+    if version is not None:
+        state.cache_set(f"{key}:version", version.encode(), ttl=RESPONSE_CACHE_TTL)
+
+
+def _is_stale(key: str) -> bool:
+    """The cached lesson is missing or was made by an older prompt, schema or model"""
+    return get_state().cache_get(f"{key}:version") != GENERATION_VERSION.encode()
+
+
+def _note_hit(key: str, prompt: str):
+    """Serve-stale bookkeeping for a cache hit: popular stale entries are
+    regenerated in the background while this copy is returned"""
+    prefetch.note_hit(key)
+    if prefetch.REFRESH_ENABLED and _is_stale(key):
+        CACHE_REFRESHES.inc(outcome="stale_served")
+        prefetch.refresh(key, prompt)
+
+
+def _precompressed_body(key: str, prompt: str, encoding):
+    body = get_state().cache_get(f"{key}:body:{encoding or 'identity'}")
+    if body is not None:
+        _note_hit(key, prompt)
+    return body
+
+
+def _body_response(body: bytes, encoding):
+    return Response(content=body, media_type="application/json", headers=precompressed_headers(encoding))
+
+
+def _cached_response(db, key: str, prompt: str):
+    """Look in the shared response cache, then in stored chat history"""
+    blob = get_state().cache_get(key)
+    if blob is not None:
+        CACHE_HITS.inc(cache="shared")
+        usage.note_cache_hit("shared")
+        _note_hit(key, prompt)
+        return decode_payload(blob)
+    CACHE_MISSES.inc(cache="shared")
+
+    if not HISTORY_CACHE_ENABLED:
+        return None
+    payload = find_cached_payload(db, key)
+    if payload is None:
+        CACHE_MISSES.inc(cache="history")
+        return None
+    CACHE_HITS.inc(cache="history")
+    usage.note_cache_hit("history")
+    print(f"[GENERATE] Serving stored response {payload.hash[:12]} from history")
+    # Stored lessons carry no version, so they count as stale
+    _cache_response(key, payload.data, blob=payload.blob, version="")
+    _note_hit(key, prompt)
+    return payload.data
+
+
+def _remember_generated(db, key: str, result):
+    """Make a freshly generated lesson servable from stored history"""
+    if HISTORY_CACHE_ENABLED and is_cacheable(result):
+        remember_generated(db, result, key)
+
+
+def _rate_limited(client_id: str) -> bool:
+    if not GENERATE_RATE_LIMIT:
+        return False
+    return get_state().hit_rate_limit(f"generate:{client_id}", GENERATE_RATE_LIMIT, 60)
+
+
 @app.post("/generate")
-def generate(query: Prompt):
+async def generate(query: Prompt, request: Request, current_user=Depends(get_optional_user), db=Depends(get_db)):
+    user_id = current_user.id if current_user is not None else None
+    with usage.track("generate_search" if query.search else "generate", user_id):
+        return await _generate_response(query, request, user_id, db)
+
+
+async def _generate_response(query: Prompt, request: Request, user_id, db):
+    key = query.cache_key()
+    popularity.record(key, query.prompt)
+    encoding = negotiate(request.headers.get("accept-encoding", ""))
+    with stage("cache_lookup"):
+        body = await run_in_threadpool(_precompressed_body, key, query.prompt, encoding)
+        if body is not None:
+            CACHE_HITS.inc(cache="precompressed")
+            usage.note_cache_hit("precompressed")
+            return _body_response(body, encoding)
+        cached = await run_in_threadpool(_cached_response, db, key, query.prompt)
+    if cached is not None:
+        return cached
+
+    client_id = request.client.host if request.client else "unknown"
+    if await run_in_threadpool(_rate_limited, client_id):
+        raise HTTPException(status_code=429, detail="Too many generation requests, slow down")
+    if await run_in_threadpool(usage.over_quota, db, user_id):
+        raise HTTPException(status_code=429, detail="Daily generation quota used up")
+
+    deadline = Deadline(REQUEST_BUDGET_SECONDS)
+    watcher = asyncio.create_task(_cancel_on_disconnect(request, deadline))
     try:
-        raw_result = ai(query.prompt)
-        result_json = sanitize_ai_json(raw_result) if isinstance(raw_result, str) else raw_result
+        with prefetch.live_request():
+            result = await run_in_threadpool(_generate_single_flight, query, key, deadline)
+        await run_in_threadpool(_remember_generated, db, key, result)
+        prefetch.schedule(result)
+        return result
+    except RequestCancelled:
+        usage.note_status("cancelled")
+        # Nobody is listening; 499 mirrors nginx's "client closed request"
+        return Response(status_code=499)
+    except DeadlineExceeded as e:
+        usage.note_status("timeout")
+        raise HTTPException(status_code=504, detail=str(e))
+    finally:
+        watcher.cancel()
 
-        if "mermaid_diagram" in result_json and result_json["mermaid_diagram"]:
-            result_json["mermaid_diagram"] = preprocess_mermaid(result_json["mermaid_diagram"])
-        else:
-            result_json["mermaid_diagram"] = "graph TD\n    A[Diagram Not Available]"
 
-        print(f"[GENERATE] Response:\n{json.dumps(result_json, indent=2)}")
+def _generate_single_flight(query: Prompt, key: str, deadline: Deadline):
+    """Generate once per prompt across all workers: concurrent requests for the
+    same prompt wait for the first one's result instead of calling upstream"""
+    state = get_state()
+    lock_name = f"generate:{key}"
+    token = state.acquire_lock(lock_name, ttl=REQUEST_BUDGET_SECONDS)
+    if token is None:
+        print("[GENERATE] Same prompt already in flight, waiting for its result")
+        while state.lock_held(lock_name) and deadline.remaining() > 0:
+            if deadline.wait(0.25):
+                raise RequestCancelled("Client disconnected while waiting")
+        blob = state.cache_get(key)
+        if blob is not None:
+            CACHE_HITS.inc(cache="single_flight")
+            usage.note_cache_hit("single_flight")
+            prefetch.note_hit(key)
+            return decode_payload(blob)
+        # The leader failed or gave up; generate ourselves
+        token = state.acquire_lock(lock_name, ttl=REQUEST_BUDGET_SECONDS)
+
+    try:
+        result = _generate(query, deadline)
+        if is_cacheable(result):
+            _cache_response(key, result)
+        return result
+    finally:
+        if token is not None:
+            state.release_lock(lock_name, token)
+
+
+def _prefetch_generate(prompt: str, key: str, deadline: Deadline):
+    """Prefetch lane: generate and cache a follow-up lesson unless a live
+    request is already generating it"""
+    if get_state().lock_held(f"generate:{key}"):
+        return None
+    # Jobs carry only the prompt and key; a refresh of a grounded lesson must stay grounded
+    grounded = key == Prompt(prompt=prompt, search=True).cache_key()
+    return _generate_single_flight(Prompt(prompt=prompt, search=grounded), key, deadline)
+
+
+def _generate(query: Prompt, deadline: Deadline):
+    try:
+        with stage("generate_total"):
+            if query.search:
+                raw_result = generate_grounded(query.prompt, deadline=deadline)
+            else:
+                raw_result = ai(query.prompt, deadline=deadline)
+            result_json = sanitize_ai_json(raw_result) if isinstance(raw_result, str) else raw_result
+
+            with stage("preprocess_mermaid"):
+                if "mermaid_diagram" in result_json and result_json["mermaid_diagram"]:
+                    result_json["mermaid_diagram"] = preprocess_mermaid(result_json["mermaid_diagram"])
+                else:
+                    result_json["mermaid_diagram"] = "graph TD\n    A[Diagram Not Available]"
+
+            with stage("serialization"):
+                print(f"[GENERATE] Response:\n{json.dumps(result_json, indent=2)}")
         return result_json
+    except (RequestCancelled, DeadlineExceeded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate/field", response_model=FieldRegenerateResponse)
+async def generate_field(
+    body: FieldRegenerateRequest,
+    request: Request,
+    current_user=Depends(get_optional_user),
+    db=Depends(get_db)
+):
+    """Regenerate one field of a lesson, either a stored message's or one passed in"""
+    if body.field not in SCHEMA["properties"]:
+        raise HTTPException(status_code=400, detail=f"Unknown field: {body.field}")
+    if (body.message_id is None) == (body.data is None):
+        raise HTTPException(status_code=400, detail="Pass either message_id or data")
+    if body.message_id is not None and body.prompt is not None:
+        raise HTTPException(status_code=400, detail="A stored message is regenerated for its own prompt")
+
+    message = None
+    data = body.data
+    prompt = body.prompt
+    if body.message_id is not None:
+        if current_user is None:
+            raise HTTPException(status_code=401, detail="Sign in to update a stored message")
+        message = get_message_by_id(db, body.message_id)
+        if not message:
+            raise HTTPException(status_code=404, detail="Message not found")
+        if message.session.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        data = message.data
+        if message.role != "assistant" or not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail="Message has no lesson to update")
+        prompt = get_message_prompt(db, message)
+    if not prompt:
+        raise HTTPException(status_code=400, detail="prompt is required")
+
+    # Every regeneration is an upstream call, under the same limits as /generate
+    user_id = current_user.id if current_user is not None else None
+    client_id = request.client.host if request.client else "unknown"
+    if await run_in_threadpool(_rate_limited, client_id):
+        raise HTTPException(status_code=429, detail="Too many generation requests, slow down")
+    if await run_in_threadpool(usage.over_quota, db, user_id):
+        raise HTTPException(status_code=429, detail="Daily generation quota used up")
+
+    deadline = Deadline(REQUEST_BUDGET_SECONDS)
+    watcher = asyncio.create_task(_cancel_on_disconnect(request, deadline))
+    try:
+        with stage("generate_field"), usage.track("field", user_id):
+            value = await run_in_threadpool(regenerate_field, prompt, data, body.field, body.reason, deadline)
+    except RequestCancelled:
+        return Response(status_code=499)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    finally:
+        watcher.cancel()
+
+    if body.field == "mermaid_diagram":
+        value = preprocess_mermaid(value)
+    data = dict(data, **{body.field: value})
+
+    if message is not None:
+        # Only the owner's copy changes; the edit was steered by `reason`, so
+        # it never goes into the shared cache
+        update_message_data(db, message, data)
+
+    return FieldRegenerateResponse(
+        field=body.field,
+        value=value,
+        data=data,
+        message_id=message.id if message is not None else None,
+    )
+
+# ── WebSocket Chat ──────────────────────────────────────
+
+def _ws_call(func, *args):
+    """func(db, *args) in a session of its own. A connection outlives any one
+    call, and a worker thread still running after the client left must not
+    share a session the handler is closing; short sessions also never serve
+    rows another request has since changed."""
+    db = SessionLocal()
+    try:
+        return func(db, *args)
+    finally:
+        db.close()
+
+
+def _ws_authenticate(db, token: str):
+    """The token's user id, or None"""
+    try:
+        return user_from_token(db, token).id
+    except Exception as e:
+        print(f"[WS] Authentication failed: {getattr(e, 'detail', e)}")
+        return None
+
+
+def _ws_save_prompt(db, user_id: int, query: Prompt):
+    """Find or create the turn's session and store the user's message.
+    Returns (session_id, message_id), or raises HTTPException."""
+    if query.session_id:
+        session = get_session_by_id(db, query.session_id)
+        if session is None:
+            session = create_chat_session(db, user_id, session_id=query.session_id)
+        elif session.user_id != user_id:
+            raise HTTPException(status_code=403, detail="Not authorized")
+        elif session.archived_at is not None:
+            _rehydrate(db, session.id)
+    else:
+        session = create_chat_session(db, user_id)
+    message = add_message(db, session.id, "user", content=query.prompt)
+    if session.title == "New Chat":
+        title = (query.prompt[:60] + "...") if len(query.prompt) > 60 else query.prompt
+        update_session_title(db, session.id, title)
+    return session.id, message.id
+
+
+def _ws_lesson(db, query: Prompt, client_id: str, user_id: int, deadline: Deadline):
+    """(lesson, cached) for a turn, through the same caches, limits and
+    single-flight as POST /generate"""
+    key = query.cache_key()
+    popularity.record(key, query.prompt)
+    cached = _cached_response(db, key, query.prompt)
+    if cached is not None:
+        return cached, True
+    if _rate_limited(client_id):
+        raise HTTPException(status_code=429, detail="Too many generation requests, slow down")
+    if usage.over_quota(db, user_id):
+        raise HTTPException(status_code=429, detail="Daily generation quota used up")
+    with prefetch.live_request():
+        result = _generate_single_flight(query, key, deadline)
+    _remember_generated(db, key, result)
+    prefetch.schedule(result)
+    return result, False
+
+
+async def _ws_turn(channel: ChatChannel, user_id: int, client_id: str, turn_id, query: Prompt, deadline: Deadline):
+    with usage.track("ws_generate_search" if query.search else "ws_generate", user_id):
+        try:
+            session_id, message_id = await run_in_threadpool(_ws_call, _ws_save_prompt, user_id, query)
+            await channel.send({"type": "accepted", "id": turn_id, "session_id": session_id, "message_id": message_id})
+            result, cached = await run_in_threadpool(_ws_call, _ws_lesson, query, client_id, user_id, deadline)
+        except RequestCancelled:
+            usage.note_status("cancelled")
+            WS_TURNS.inc(outcome="cancelled")
+            await channel.send({"type": "error", "id": turn_id, "status": 499, "detail": "Cancelled"})
+            return
+        except DeadlineExceeded as e:
+            usage.note_status("timeout")
+            WS_TURNS.inc(outcome="failed")
+            await channel.send({"type": "error", "id": turn_id, "status": 504, "detail": str(e)})
+            return
+        except HTTPException as e:
+            usage.note_status("error")
+            WS_TURNS.inc(outcome="refused" if e.status_code == 429 else "failed")
+            await channel.send({"type": "error", "id": turn_id, "status": e.status_code, "detail": e.detail})
+            return
+
+        # Sections go out while the assistant message is being stored
+        saving = asyncio.ensure_future(run_in_threadpool(_ws_call, add_message, session_id, "assistant", None, result))
+        try:
+            for field, value in result.items():
+                await channel.send({"type": "section", "id": turn_id, "field": field, "value": value})
+        finally:
+            message = await saving
+        WS_TURNS.inc(outcome="cached" if cached else "generated")
+        await channel.send({"type": "done", "id": turn_id, "message_id": message.id, "cached": cached})
+
+
+async def _ws_run_turns(channel: ChatChannel, user_id: int, client_id: str, turns: asyncio.Queue, pending: dict):
+    """Run queued prompts one at a time, in the order they arrived"""
+    while True:
+        turn_id, query, deadline = await turns.get()
+        try:
+            if deadline.cancelled:
+                WS_TURNS.inc(outcome="cancelled")
+                await channel.send({"type": "error", "id": turn_id, "status": 499, "detail": "Cancelled"})
+                continue
+            try:
+                await _ws_turn(channel, user_id, client_id, turn_id, query, deadline)
+            except ChannelClosed:
+                return
+            except Exception as e:
+                print(f"[WS] Turn failed: {e}")
+                WS_TURNS.inc(outcome="failed")
+                await channel.send({"type": "error", "id": turn_id, "status": 500, "detail": "Internal error"})
+        finally:
+            if pending.get(turn_id) is deadline:
+                del pending[turn_id]
+
+
+def _ws_valid_id(turn_id) -> bool:
+    """Turn ids key the in-flight table, so only hashable scalars will do"""
+    return isinstance(turn_id, (str, int)) and not isinstance(turn_id, bool)
+
+
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket, token: str | None = None):
+    """Chat over one authenticated connection: prompts in, lesson sections out,
+    with both sides of every turn stored server-side (protocol in ws_chat.py)"""
+    WS_CONNECTIONS.inc(event="opened")
+    channel = ChatChannel(websocket)
+    worker = None
+    pending = {}  # turn id -> Deadline, for prompts queued or running
+    try:
+        # A token on the URL is checked before accepting, so bad ones get a plain 403
+        user_id = None
+        if token is not None:
+            user_id = await run_in_threadpool(_ws_call, _ws_authenticate, token)
+            if user_id is None:
+                WS_CONNECTIONS.inc(event="rejected")
+                await websocket.close(code=POLICY_VIOLATION)
+                return
+        await websocket.accept()
+        channel.start()
+        if user_id is None:
+            first = await channel.receive(timeout=WS_AUTH_TIMEOUT)
+            if first.get("type") == "auth" and isinstance(first.get("token"), str):
+                user_id = await run_in_threadpool(_ws_call, _ws_authenticate, first["token"])
+            if user_id is None:
+                WS_CONNECTIONS.inc(event="rejected")
+                await channel.send({"type": "error", "id": None, "status": 401, "detail": "Authentication required"})
+                await channel.flush()
+                await channel.close(POLICY_VIOLATION, "authentication required")
+                return
+        WS_CONNECTIONS.inc(event="authenticated")
+        await channel.send({"type": "ready", "user_id": user_id})
+
+        client_id = websocket.client.host if websocket.client else "unknown"
+        turns = asyncio.Queue()
+        worker = asyncio.create_task(_ws_run_turns(channel, user_id, client_id, turns, pending))
+        while True:
+            message = await channel.receive()
+            kind = message.get("type")
+            if kind == "ping":
+                await channel.send({"type": "pong"})
+            elif kind in ("cancel", "prompt") and not _ws_valid_id(message.get("id")):
+                await channel.send({"type": "error", "id": message.get("id"), "status": 400, "detail": "id must be a string or an integer"})
+            elif kind == "cancel":
+                deadline = pending.get(message["id"])
+                if deadline is not None:
+                    deadline.cancel()
+            elif kind == "prompt":
+                turn_id = message["id"]
+                if turn_id in pending:
+                    await channel.send({"type": "error", "id": turn_id, "status": 400, "detail": "A turn with this id is still in flight"})
+                    continue
+                try:
+                    query = Prompt(
+                        prompt=message.get("prompt"),
+                        session_id=message.get("session_id"),
+                        search=bool(message.get("search", False)),
+                    )
+                except ValueError:
+                    await channel.send({"type": "error", "id": turn_id, "status": 422, "detail": "prompt must be a string"})
+                    continue
+                if turns.qsize() >= WS_MAX_QUEUED_TURNS:
+                    WS_TURNS.inc(outcome="refused")
+                    await channel.send({"type": "error", "id": turn_id, "status": 429, "detail": "Too many turns in flight"})
+                    continue
+                deadline = Deadline(REQUEST_BUDGET_SECONDS)
+                pending[turn_id] = deadline
+                turns.put_nowait((turn_id, query, deadline))
+            else:
+                await channel.send({"type": "error", "id": message.get("id"), "status": 400, "detail": "Unknown message type"})
+    except (ChannelClosed, asyncio.TimeoutError):
+        pass
+    finally:
+        # The client is gone: stop upstream work for anything still queued or running
+        for deadline in pending.values():
+            deadline.cancel()
+        if worker is not None:
+            worker.cancel()
+        await channel.close()
+        WS_CONNECTIONS.inc(event="closed")
+
+
+# Demo file -> its preprocessed response body in every encoding
+_demo_bodies = {}
+
+
 @app.post("/demo")
-def demo(query: Prompt):
+def demo(query: Prompt, request: Request):
     if "write" in query.prompt:
         demo_file_path = "../demos/gc2.json"
     elif "garbage" in query.prompt:
@@ -337,6 +1066,10 @@ def demo(query: Prompt):
     else:
         demo_file_path = "../demos/error.json"
 
+    encoding = negotiate(request.headers.get("accept-encoding", ""))
+    if demo_file_path in _demo_bodies:
+        return _body_response(_demo_bodies[demo_file_path][encoding or "identity"], encoding)
+
     if not os.path.exists(demo_file_path):
         raise HTTPException(status_code=404, detail="demo.json not found")
     try:
@@ -347,6 +1080,7 @@ def demo(query: Prompt):
             demo_data['mermaid_diagram'] = preprocess_mermaid(demo_data['mermaid_diagram'])
 
         print(f"[DEMO] Response:\n{json.dumps(demo_data, indent=2)}")
-        return demo_data
+        _demo_bodies[demo_file_path] = encode_variants(render_json(demo_data))
+        return _body_response(_demo_bodies[demo_file_path][encoding or "identity"], encoding)
     except json.JSONDecodeError:
         raise HTTPException(status_code=500, detail="Invalid JSON in demo.json")
\ No newline at end of file
@@ -0,0 +1,230 @@
+"""Cold storage for chat sessions nobody has opened in a while.
+
+Sessions untouched for ARCHIVE_AFTER_DAYS have their messages moved out of
+chat_messages into one compressed file per session under ARCHIVE_DIR (the
+same zlib+dictionary encoding as message payloads, see compression.py). The
+chat_sessions row stays, so the session list is unchanged, with archived_at
+and archived_messages set. Opening or appending to an archived session
+rehydrates it: the messages go back with their original ids, so client
+caches and message links stay valid.
+
+Archived messages don't show up in full-text search until rehydrated, and
+their shared payload references are dropped, so a payload used only by
+archived sessions is deleted along with its history-cache entry (the
+file keeps the entry's prompt key, and rehydrating restores it).
+
+A background loop archives in batches every ARCHIVE_INTERVAL_SECONDS on
+one worker at a time; `python migrations.py archive-sessions` does the same
+by hand.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from compression import encode_payload, decode_payload
+from database import engine, SessionLocal, ChatSession, ChatMessage, store_payload, release_payloads
+from metrics import SESSION_ARCHIVE
+from search import index_message, unindex_session
+from state import get_state
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+# Sessions not updated for this many days are archived; 0 turns archiving off
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))
+ARCHIVE_LOCK_SECONDS = 600
+
+
+def archive_path(session_id: str) -> str:
+    # Two-character fan-out keeps directories small with many sessions
+    return os.path.join(ARCHIVE_DIR, session_id[:2], f"{session_id}.session")
+
+
+def _write_atomic(path: str, blob: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def remove_archive(session_id: str):
+    try:
+        os.remove(archive_path(session_id))
+    except FileNotFoundError:
+        pass
+
+
+# ── Archive ─────────────────────────────────────────────
+
+def archive_session(db, session_id: str, cutoff: datetime = None) -> bool:
+    """Move one session's messages to its archive file. With `cutoff`, only if
+    the session still hasn't been updated since then. True if archived."""
+    # Claiming the row first makes a concurrent archive or rehydrate of the
+    # same session wait for us (or find nothing to do)
+    claim = db.query(ChatSession).filter(ChatSession.id == session_id, ChatSession.archived_at.is_(None))
+    if cutoff is not None:
+        claim = claim.filter(ChatSession.updated_at < cutoff)
+    now = datetime.utcnow()
+    # updated_at is set to itself so its onupdate doesn't mark the session as touched
+    if not claim.update(
+        {ChatSession.archived_at: now, ChatSession.updated_at: ChatSession.updated_at},
+        synchronize_session=False,
+    ):
+        db.rollback()
+        return False
+
+    messages = (
+        db.query(ChatMessage)
+        .filter(ChatMessage.session_id == session_id)
+        .order_by(ChatMessage.id.asc())
+        .all()
+    )
+    document = {
+        "session_id": session_id,
+        "archived_at": now.isoformat(),
+        "messages": [{
+            "id": m.id,
+            "role": m.role,
+            "content": m.content,
+            "data": m.data,
+            "prompt_key": m.payload.prompt_key if m.payload_hash else None,
+            "created_at": m.created_at.isoformat() if m.created_at else None,
+        } for m in messages],
+    }
+    try:
+        _write_atomic(archive_path(session_id), encode_payload(document))
+        release_payloads(db, ChatMessage.session_id == session_id)
+        unindex_session(db, session_id)
+        db.query(ChatMessage).filter(ChatMessage.session_id == session_id).delete(synchronize_session=False)
+        db.query(ChatSession).filter(ChatSession.id == session_id).update(
+            {ChatSession.archived_messages: len(messages), ChatSession.updated_at: ChatSession.updated_at},
+            synchronize_session=False,
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        SESSION_ARCHIVE.inc(operation="archive_failed")
+        raise
+    SESSION_ARCHIVE.inc(operation="archived")
+    return True
+
+
+def archive_stale_sessions(days: float = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+                           limit: int = None) -> int:
+    """Archive sessions not updated for `days` days, `batch_size` per query"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    db = SessionLocal()
+    archived = 0
+    try:
+        while limit is None or archived < limit:
+            ids = [
+                row[0] for row in
+                db.query(ChatSession.id)
+                .filter(ChatSession.archived_at.is_(None), ChatSession.updated_at < cutoff)
+                .order_by(ChatSession.updated_at.asc())
+                .limit(batch_size)
+                .all()
+            ]
+            if not ids:
+                break
+            done = 0
+            for session_id in ids:
+                try:
+                    done += archive_session(db, session_id, cutoff)
+                except Exception as e:
+                    print(f"[ARCHIVE] Could not archive session {session_id}: {e}")
+            archived += done
+            # A batch that archived nothing would just be fetched again
+            if len(ids) < batch_size or done == 0:
+                break
+            print(f"[ARCHIVE] Archived {archived} sessions so far")
+    finally:
+        db.close()
+    return archived
+
+
+# ── Rehydrate ───────────────────────────────────────────
+
+def rehydrate_session(db, session_id: str) -> bool:
+    """Bring an archived session's messages back into chat_messages.
+    False if it wasn't archived (or another request just restored it)."""
+    session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
+    if session is None or session.archived_at is None:
+        return False
+    claimed = (
+        db.query(ChatSession)
+        .filter(ChatSession.id == session_id, ChatSession.archived_at.isnot(None))
+        .update(
+            {ChatSession.archived_at: None, ChatSession.archived_messages: None,
+             ChatSession.updated_at: ChatSession.updated_at},
+            synchronize_session=False,
+        )
+    )
+    if not claimed:
+        db.rollback()
+        return False
+
+    try:
+        with open(archive_path(session_id), "rb") as f:
+            document = decode_payload(f.read())
+        for item in document["messages"]:
+            message = ChatMessage(
+                id=item["id"],
+                session_id=session_id,
+                role=item["role"],
+                content=item["content"],
+                created_at=datetime.fromisoformat(item["created_at"]) if item["created_at"] else None,
+            )
+            data = item["data"]
+            if data is not None:
+                message.attach_payload(store_payload(db, data, item.get("prompt_key")), data)
+            db.add(message)
+            db.flush()
+            index_message(db, message.id, session.user_id, message.content, data)
+        db.commit()
+    except Exception:
+        db.rollback()
+        SESSION_ARCHIVE.inc(operation="rehydrate_failed")
+        raise
+    db.expire(session)
+    remove_archive(session_id)
+    SESSION_ARCHIVE.inc(operation="rehydrated")
+    print(f"[ARCHIVE] Rehydrated session {session_id} ({len(document['messages'])} messages)")
+    return True
+
+
+# ── Background compaction ───────────────────────────────
+
+def compact():
+    """One archiving pass, then let SQLite refresh its planner statistics"""
+    state = get_state()
+    token = state.acquire_lock("archive", ttl=ARCHIVE_LOCK_SECONDS)
+    if token is None:
+        return 0
+    try:
+        archived = archive_stale_sessions()
+        if archived:
+            print(f"[ARCHIVE] Archived {archived} sessions untouched for {ARCHIVE_AFTER_DAYS:g} days")
+            if engine.dialect.name == "sqlite":
+                with engine.begin() as conn:
+                    conn.execute(text("PRAGMA optimize"))
+        return archived
+    finally:
+        state.release_lock("archive", token)
+
+
+async def compaction_loop():
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, compact)
+        except Exception as e:
+            print(f"[ARCHIVE] Compaction failed: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
@@ -4,34 +4,42 @@ from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import HTTPException, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from authlib.integrations.starlette_client import OAuth
-from starlette.config import Config
 from database import get_db, get_user_by_google_id, create_user
 
-# Load environment variables
-config = Config('.env')
-
-# OAuth setup
-oauth = OAuth(config)
-
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
 SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-change-this-in-production')
 FRONTEND_URL = os.getenv('FRONTEND_URL', 'http://localhost:3000')
 
-# Register Google OAuth
-oauth.register(
-    name='google',
-    client_id=GOOGLE_CLIENT_ID,
-    client_secret=GOOGLE_CLIENT_SECRET,
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_kwargs={
-        'scope': 'openid email profile'
-    }
-)
+_oauth = None
+
+
+def get_oauth():
+    """OAuth client with Google registered, created on the first login"""
+    global _oauth
+    if _oauth is None:
+        from authlib.integrations.starlette_client import OAuth
+        from starlette.config import Config
+
+        # Load environment variables
+        oauth = OAuth(Config('.env'))
+
+        # Register Google OAuth
+        oauth.register(
+            name='google',
+            client_id=GOOGLE_CLIENT_ID,
+            client_secret=GOOGLE_CLIENT_SECRET,
+            server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+            client_kwargs={
+                'scope': 'openid email profile'
+            }
+        )
+        _oauth = oauth
+    return _oauth
 
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -63,7 +71,11 @@ async def get_current_user(
     db = Depends(get_db)
 ):
     """Get current authenticated user from JWT token"""
-    token = credentials.credentials
+    return user_from_token(db, credentials.credentials)
+
+
+def user_from_token(db, token: str):
+    """The user a JWT belongs to; raises HTTPException like get_current_user"""
     payload = verify_token(token)
     
     google_id = payload.get("sub")
@@ -77,6 +89,16 @@ async def get_current_user(
     return user
 
 
+async def get_optional_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    db = Depends(get_db)
+):
+    """Like get_current_user, but None for anonymous requests"""
+    if credentials is None:
+        return None
+    return await get_current_user(credentials, db)
+
+
 def get_or_create_user(db, user_info: dict):
     """Get existing user or create new one from Google user info"""
     google_id = user_info.get('sub')
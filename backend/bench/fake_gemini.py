@@ -0,0 +1,276 @@
+"""Local stand-in for the Gemini generateContent API.
+
+Point the backend at it with GENAI_BASE_URL=http://127.0.0.1:8100 and any
+API_KEYS value. Responses are built from demos/*.json so the JSON repair
+path sees realistic payloads. A request carrying a model turn is treated as a
+continuation of a truncated response and gets the rest of that payload;
+one with tools (Google Search) gets plain-text notes and grounding metadata.
+
+    python bench/fake_gemini.py --latency lognormal:1200,0.6 --rate-429 0.05 --truncate 0.1
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+app = FastAPI()
+
+settings = {
+    "latency": ("fixed", (0.0,)),
+    "rate_429": 0.0,
+    "rate_500": 0.0,
+    "truncate": 0.0,
+    "malformed": 0.0,
+    "degraded": 0.0,
+    "stream_chunks": 8,
+}
+payloads = []
+stats = {"requests": 0, "429": 0, "500": 0, "truncated": 0, "malformed": 0, "degraded": 0, "continued": 0,
+         "searches": 0}
+
+
+# ── Configuration ───────────────────────────────────────
+
+def parse_latency(spec: str):
+    """Parse `fixed:MS`, `uniform:LO,HI` or `lognormal:MEDIAN_MS,SIGMA`"""
+    kind, _, args = spec.partition(":")
+    values = tuple(float(v) for v in args.split(",") if v)
+    expected = {"fixed": 1, "uniform": 2, "lognormal": 2}
+    if kind not in expected or len(values) != expected[kind]:
+        raise ValueError(f"Invalid latency spec: {spec}")
+    return kind, values
+
+
+def sample_latency() -> float:
+    """Draw one upstream latency, in seconds, from the configured distribution"""
+    kind, values = settings["latency"]
+    if kind == "fixed":
+        ms = values[0]
+    elif kind == "uniform":
+        ms = random.uniform(values[0], values[1])
+    else:
+        median, sigma = values
+        ms = random.lognormvariate(0, sigma) * median
+    return max(ms, 0.0) / 1000.0
+
+
+def load_payloads(pattern: str):
+    for path in sorted(glob.glob(pattern)):
+        with open(path, "r", encoding="utf-8") as f:
+            payloads.append(json.dumps(json.load(f)))
+    if not payloads:
+        raise SystemExit(f"No demo payloads matched {pattern}")
+    print(f"[FAKE GEMINI] Loaded {len(payloads)} payloads from {pattern}")
+
+
+# ── Response shaping ────────────────────────────────────
+
+def _error(code: int, status: str, message: str):
+    return JSONResponse(
+        status_code=code,
+        content={"error": {"code": code, "message": message, "status": status}},
+    )
+
+
+def _degrade(text: str) -> str:
+    """Valid JSON with one of the content problems the quality gate catches"""
+    data = json.loads(text)
+    damage = random.choice(("empty_concepts", "questions_string", "latex_escapes", "broken_diagram"))
+    if damage == "empty_concepts":
+        data["concepts"] = ""
+    elif damage == "questions_string":
+        data["further_questions"] = "\n".join(data.get("further_questions") or [])
+    elif damage == "latex_escapes":
+        # What "\frac" and "\theta" become when sent with single backslashes
+        data["formulas"] = "Slope: $\x0crac{dy}{dx}$, angle $\theta$"
+    else:
+        data["mermaid_diagram"] = "graph TD\n    A[Start --> B(Ridge (L2))"
+    return json.dumps(data)
+
+
+def _body_text(prompt: str) -> tuple:
+    """Pick a payload and possibly damage it. Returns (text, finish_reason)."""
+    text = random.choice(payloads)
+    if "mermaid flowchart" in prompt:
+        return "graph TD\n    A[Start] --> B[Step One]\n    B --> C[End]", "STOP"
+
+    roll = random.random()
+    if roll < settings["truncate"]:
+        stats["truncated"] += 1
+        cut = random.randint(len(text) // 3, len(text) - 2)
+        return text[:cut], "MAX_TOKENS"
+    roll -= settings["truncate"]
+    if roll < settings["malformed"]:
+        stats["malformed"] += 1
+        # The two damage patterns the repair pipeline handles: markdown fences
+        # and raw newlines inside string literals.
+        if random.random() < 0.5:
+            return f"Here is the lesson:\n```json\n{text}\n```", "STOP"
+        return text.replace("\\n", "\n"), "STOP"
+    roll -= settings["malformed"]
+    if roll < settings["degraded"] and "were rejected" not in prompt:
+        stats["degraded"] += 1
+        return _degrade(text), "STOP"
+    return text, "STOP"
+
+
+def _continuation(partial: str):
+    """The rest of the payload a truncated response was cut from"""
+    stats["continued"] += 1
+    for text in payloads:
+        if text.startswith(partial):
+            return text[len(partial):], "STOP"
+    return "}", "STOP"
+
+
+def _search_result(prompt: str):
+    """Notes and grounding metadata like a google_search tool call returns"""
+    stats["searches"] += 1
+    topic = prompt.split("\n")[1] if "\n" in prompt else prompt
+    notes = (
+        f"- {topic[:80]} is introduced in most undergraduate texts (Example Encyclopedia).\n"
+        "- The core definitions have not changed recently (Example University notes).\n"
+        "- A common misconception is confusing correlation with causation (Example Blog)."
+    )
+    metadata = {"groundingChunks": [
+        {"web": {"uri": "https://example.org/encyclopedia", "title": "Example Encyclopedia"}},
+        {"web": {"uri": "https://example.edu/notes", "title": "Example University notes"}},
+    ]}
+    return notes, metadata
+
+
+def _candidate(text: str, finish_reason):
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return candidate
+
+
+def _usage(prompt: str, text: str):
+    return {
+        "promptTokenCount": max(len(prompt) // 4, 1),
+        "candidatesTokenCount": max(len(text) // 4, 1),
+        "totalTokenCount": max(len(prompt) // 4, 1) + max(len(text) // 4, 1),
+    }
+
+
+async def _maybe_fail():
+    stats["requests"] += 1
+    await asyncio.sleep(sample_latency())
+    roll = random.random()
+    if roll < settings["rate_429"]:
+        stats["429"] += 1
+        return _error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (fake).")
+    if roll < settings["rate_429"] + settings["rate_500"]:
+        stats["500"] += 1
+        return _error(500, "INTERNAL", "Internal error encountered (fake).")
+    return None
+
+
+def _model_turn(body: dict):
+    """Text of the last model turn in a multi-turn request, if any"""
+    turns = [c for c in body.get("contents", []) if c.get("role") == "model"]
+    if not turns:
+        return None
+    return "".join(part.get("text", "") for part in turns[-1].get("parts", []))
+
+
+def _prompt_text(body: dict) -> str:
+    parts = []
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            parts.append(part.get("text", ""))
+    return "".join(parts)
+
+
+# ── Routes ──────────────────────────────────────────────
+
+@app.post("/{api_version}/models/{model}:generateContent")
+async def generate_content(api_version: str, model: str, request: Request):
+    failure = await _maybe_fail()
+    if failure:
+        return failure
+    body = await request.json()
+    prompt = _prompt_text(body)
+    if body.get("tools"):
+        text, metadata = _search_result(prompt)
+        candidate = dict(_candidate(text, "STOP"), groundingMetadata=metadata)
+        return {"candidates": [candidate], "usageMetadata": _usage(prompt, text), "modelVersion": model}
+    partial = _model_turn(body)
+    text, finish_reason = _continuation(partial) if partial is not None else _body_text(prompt)
+    return {
+        "candidates": [_candidate(text, finish_reason)],
+        "usageMetadata": _usage(prompt, text),
+        "modelVersion": model,
+    }
+
+
+@app.post("/{api_version}/models/{model}:streamGenerateContent")
+async def stream_generate_content(api_version: str, model: str, request: Request):
+    failure = await _maybe_fail()
+    if failure:
+        return failure
+    prompt = _prompt_text(await request.json())
+    text, finish_reason = _body_text(prompt)
+    chunks = max(settings["stream_chunks"], 1)
+    size = max(len(text) // chunks, 1)
+    pieces = [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def events():
+        for i, piece in enumerate(pieces):
+            last = i == len(pieces) - 1
+            event = {"candidates": [_candidate(piece, finish_reason if last else None)]}
+            if last:
+                event["usageMetadata"] = _usage(prompt, text)
+            yield f"data: {json.dumps(event)}\r\n\r\n"
+            if not last:
+                await asyncio.sleep(sample_latency() / chunks)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+def get_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini API server for offline load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:MS | uniform:LO,HI | lognormal:MEDIAN_MS,SIGMA")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="fraction of calls answered with 500")
+    parser.add_argument("--truncate", type=float, default=0.0, help="fraction of responses cut off mid-JSON")
+    parser.add_argument("--malformed", type=float, default=0.0, help="fraction of responses wrapped or badly escaped")
+    parser.add_argument("--degraded", type=float, default=0.0, help="fraction of valid responses with broken fields")
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--demos", default=os.path.join(BACKEND_DIR, "demos", "*.json"))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    settings.update(
+        latency=parse_latency(args.latency),
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        truncate=args.truncate,
+        malformed=args.malformed,
+        degraded=args.degraded,
+        stream_chunks=args.stream_chunks,
+    )
+    load_payloads(args.demos)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Minimal Redis-protocol server for exercising STATE_BACKEND=redis offline.
+
+Supports exactly what state.RedisState uses: PING, GET, SET (NX, PX, EX),
+INCR, PEXPIRE, DEL, SELECT, AUTH and FLUSHALL.
+
+    python bench/fake_redis.py --port 6390
+    STATE_BACKEND=redis STATE_REDIS_URL=redis://127.0.0.1:6390/0 uvicorn app:app --workers 4
+"""
+import argparse
+import asyncio
+import time
+
+store = {}  # key -> (value, expires_at)
+
+
+def _live(key):
+    entry = store.get(key)
+    if entry and entry[1] is not None and entry[1] <= time.monotonic():
+        del store[key]
+        return None
+    return entry
+
+
+def _bulk(value):
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def execute(args):
+    command = args[0].upper()
+    if command == b"PING":
+        return b"+PONG\r\n"
+    if command in (b"SELECT", b"AUTH"):
+        return b"+OK\r\n"
+    if command == b"FLUSHALL":
+        store.clear()
+        return b"+OK\r\n"
+    if command == b"GET":
+        entry = _live(args[1])
+        return _bulk(entry[0] if entry else None)
+    if command == b"SET":
+        key, value = args[1], args[2]
+        nx = False
+        expires_at = None
+        options = [a.upper() for a in args[3:]]
+        i = 0
+        while i < len(options):
+            if options[i] == b"NX":
+                nx = True
+            elif options[i] in (b"PX", b"EX"):
+                amount = float(args[3 + i + 1])
+                expires_at = time.monotonic() + (amount / 1000 if options[i] == b"PX" else amount)
+                i += 1
+            i += 1
+        if nx and _live(key):
+            return b"$-1\r\n"
+        store[key] = (value, expires_at)
+        return b"+OK\r\n"
+    if command == b"INCR":
+        entry = _live(args[1])
+        value = int(entry[0]) + 1 if entry else 1
+        store[args[1]] = (str(value).encode(), entry[1] if entry else None)
+        return b":%d\r\n" % value
+    if command == b"PEXPIRE":
+        entry = _live(args[1])
+        if not entry:
+            return b":0\r\n"
+        store[args[1]] = (entry[0], time.monotonic() + int(args[2]) / 1000)
+        return b":1\r\n"
+    if command == b"DEL":
+        removed = sum(1 for key in args[1:] if _live(key) and store.pop(key, None))
+        return b":%d\r\n" % removed
+    return b"-ERR unknown command '%s'\r\n" % command
+
+
+async def handle(reader, writer):
+    try:
+        while True:
+            header = await reader.readline()
+            if not header:
+                break
+            if not header.startswith(b"*"):
+                writer.write(b"-ERR inline commands not supported\r\n")
+                continue
+            args = []
+            for _ in range(int(header[1:-2])):
+                length = int((await reader.readline())[1:-2])
+                args.append((await reader.readexactly(length + 2))[:-2])
+            writer.write(execute(args))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle, host, port)
+    print(f"[FAKE REDIS] Listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Redis-protocol server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Load generator for the backend API.
+
+Drives /generate, /sessions and /demo at several concurrency levels and
+reports throughput, latency percentiles and error rates. With --spawn it
+starts bench/fake_gemini.py and the app itself against a throwaway database,
+so a full run never touches real quota:
+
+    python bench/loadgen.py --spawn --concurrency 1,8,32 --requests 200
+    python bench/loadgen.py --spawn --out bench_results.json
+    python bench/loadgen.py --spawn --baseline bench_results.json   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = [
+    "Explain linear regression",
+    "What is maximum likelihood estimation?",
+    "Teach me the equations of motion",
+    "How does garbage collection work?",
+    "Explain the Mughal empire's administration",
+    "What is gradient descent?",
+]
+
+
+# ── Statistics ──────────────────────────────────────────
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 1),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 1),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 1),
+    }
+
+
+# ── Load generation ─────────────────────────────────────
+
+def build_request(endpoint, i, token):
+    if endpoint == "generate":
+        return "POST", "/generate", {"json": {"prompt": PROMPTS[i % len(PROMPTS)]}}
+    if endpoint == "demo":
+        return "POST", "/demo", {"json": {"prompt": "regression" if i % 2 else "maximum"}}
+    if endpoint == "sessions":
+        return "GET", "/sessions", {"headers": {"Authorization": f"Bearer {token}"}}
+    raise ValueError(f"Unknown endpoint: {endpoint}")
+
+
+async def run_level(client, endpoint, concurrency, total_requests, token):
+    latencies = []
+    errors = 0
+    counter = iter(range(total_requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, path, kwargs = build_request(endpoint, i, token)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+async def run_all(args, token):
+    results = {}
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+        for endpoint in args.endpoints:
+            for concurrency in args.concurrency:
+                summary = await run_level(client, endpoint, concurrency, args.requests, token)
+                results[f"{endpoint}@{concurrency}"] = summary
+                print(
+                    f"{endpoint:<10} c={concurrency:<4} "
+                    f"rps={summary['throughput_rps']:<8} "
+                    f"p50={summary['p50_ms']:<8} p95={summary['p95_ms']:<8} p99={summary['p99_ms']:<8} "
+                    f"errors={summary['errors']}/{summary['requests']}"
+                )
+    return results
+
+
+# ── Setup helpers ───────────────────────────────────────
+
+def mint_token():
+    """Create (or reuse) a bench user in DATABASE_URL and return a JWT for it"""
+    sys.path.insert(0, BACKEND_DIR)
+    from database import SessionLocal, init_db
+    from auth import get_or_create_user, create_access_token
+
+    init_db()
+    db = SessionLocal()
+    try:
+        user = get_or_create_user(db, {
+            "sub": "bench-user",
+            "email": "bench@example.com",
+            "name": "Bench User",
+        })
+        return create_access_token(data={"sub": user.google_id, "email": user.email})
+    finally:
+        db.close()
+
+
+def wait_for(url, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"Timed out waiting for {url}")
+
+
+def spawn_stack(args):
+    """Start the fake Gemini server and the app against a temporary database"""
+    db_path = os.path.join(tempfile.mkdtemp(prefix="lyrnios-bench-"), "bench.db")
+    env = dict(os.environ)
+    env.update({
+        "API_KEYS": env.get("BENCH_API_KEYS", "fake-key-1,fake-key-2"),
+        "GENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}",
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "SECRET_KEY": env.get("SECRET_KEY", "bench-secret"),
+    })
+    os.environ.update(env)
+
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, "bench", "fake_gemini.py"),
+         "--port", str(args.fake_port), "--latency", args.fake_latency,
+         "--rate-429", str(args.fake_429), "--rate-500", str(args.fake_500),
+         "--truncate", str(args.fake_truncate), "--malformed", str(args.fake_malformed)],
+        cwd=BACKEND_DIR, env=env,
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.app_port),
+         "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    wait_for(f"http://127.0.0.1:{args.fake_port}/stats")
+    wait_for(f"http://127.0.0.1:{args.app_port}/health")
+    return [fake, server]
+
+
+def compare(results, baseline_path, tolerance):
+    """Return a list of regressions against a previous --out file"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = []
+    for key, current in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        if before["p95_ms"] and current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {before['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current["error_rate"] > before["error_rate"] + 0.02:
+            regressions.append(f"{key}: error rate {before['error_rate']} -> {current['error_rate']}")
+        if before["throughput_rps"] and current["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {before['throughput_rps']} -> {current['throughput_rps']} rps")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /generate, /sessions and /demo")
+    parser.add_argument("--url", default=None, help="app base URL (default: the spawned app)")
+    parser.add_argument("--endpoints", default="generate,sessions,demo")
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint and level")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--token", default=None, help="bearer token for /sessions (minted if omitted)")
+    parser.add_argument("--out", default=None, help="write results as JSON")
+    parser.add_argument("--baseline", default=None, help="compare against a previous --out file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p95/throughput drift")
+    parser.add_argument("--spawn", action="store_true", help="start fake Gemini and the app locally")
+    parser.add_argument("--app-port", type=int, default=8001)
+    parser.add_argument("--fake-port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--fake-latency", default="lognormal:800,0.5")
+    parser.add_argument("--fake-429", type=float, default=0.02)
+    parser.add_argument("--fake-500", type=float, default=0.01)
+    parser.add_argument("--fake-truncate", type=float, default=0.05)
+    parser.add_argument("--fake-malformed", type=float, default=0.05)
+    args = parser.parse_args()
+
+    args.endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+
+    processes = []
+    try:
+        if args.spawn:
+            processes = spawn_stack(args)
+            args.url = args.url or f"http://127.0.0.1:{args.app_port}"
+        args.url = args.url or "http://127.0.0.1:8000"
+
+        token = args.token
+        if "sessions" in args.endpoints and not token:
+            token = mint_token()
+
+        results = asyncio.run(run_all(args, token))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"[BENCH] Results written to {args.out}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("[BENCH] Regressions detected:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("[BENCH] No regressions against baseline")
+
+
+if __name__ == "__main__":
+    main()
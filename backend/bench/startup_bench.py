@@ -0,0 +1,136 @@
+"""Cold-start benchmark: how long a fresh worker takes to import the app and
+to become live and ready.
+
+Import time comes from `python -X importtime`, so the heaviest modules are
+listed by name. With --spawn it also starts uvicorn and times /health/live
+and /health/ready:
+
+    python bench/startup_bench.py
+    python bench/startup_bench.py --runs 5 --budget-ms 1500   # exit 1 over budget
+    python bench/startup_bench.py --spawn
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def bench_env():
+    """Environment for a worker that can start without real credentials"""
+    db_path = os.path.join(tempfile.mkdtemp(prefix="lyrnios-startup-"), "startup.db")
+    env = dict(os.environ)
+    env.setdefault("API_KEYS", "fake-key-1")
+    env.setdefault("SECRET_KEY", "bench-secret")
+    env["DATABASE_URL"] = f"sqlite:///{db_path}"
+    return env
+
+
+# ── Import time ─────────────────────────────────────────
+
+def parse_importtime(stderr):
+    """(name, depth, self_us, cumulative_us) for every line of -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def measure_import(module, env):
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise SystemExit(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+    rows = parse_importtime(proc.stderr)
+    total = next((cum for name, depth, _, cum in rows if name == module and depth == 0), 0)
+    return total / 1000.0, wall * 1000.0, rows
+
+
+def heaviest(rows, limit):
+    """The measured module's direct imports, by cumulative time"""
+    direct = [(name, cum) for name, depth, _, cum in rows if depth == 1]
+    return sorted(direct, key=lambda r: r[1], reverse=True)[:limit]
+
+
+# ── Live / ready ────────────────────────────────────────
+
+def wait_status(url, started, timeout):
+    while time.perf_counter() - started < timeout:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return (time.perf_counter() - started) * 1000.0
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.02)
+    return None
+
+
+def measure_spawn(env, port, timeout):
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        live = wait_status(f"http://127.0.0.1:{port}/health/live", started, timeout)
+        ready = wait_status(f"http://127.0.0.1:{port}/health/ready", started, timeout)
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return live, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app import time and time to live/ready")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="heaviest direct imports to list")
+    parser.add_argument("--budget-ms", type=float, default=None, help="fail if median import time exceeds this")
+    parser.add_argument("--spawn", action="store_true", help="also time /health/live and /health/ready")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    env = bench_env()
+    totals, walls, rows = [], [], []
+    for _ in range(args.runs):
+        total, wall, rows = measure_import(args.module, env)
+        totals.append(total)
+        walls.append(wall)
+
+    median = statistics.median(totals)
+    print(f"[STARTUP] import {args.module}: median {median:.0f}ms "
+          f"(min {min(totals):.0f}ms, max {max(totals):.0f}ms, "
+          f"interpreter wall {statistics.median(walls):.0f}ms) over {args.runs} runs")
+    print("[STARTUP] Heaviest imports (cumulative):")
+    for name, cumulative in heaviest(rows, args.top):
+        print(f"  {cumulative / 1000.0:8.1f}ms  {name}")
+
+    if args.spawn:
+        live, ready = measure_spawn(env, args.port, args.timeout)
+        print(f"[STARTUP] /health/live after {live:.0f}ms" if live else "[STARTUP] /health/live never answered")
+        print(f"[STARTUP] /health/ready after {ready:.0f}ms" if ready else "[STARTUP] /health/ready never returned 200")
+
+    if args.budget_ms is not None:
+        if median > args.budget_ms:
+            print(f"[STARTUP] Over budget: {median:.0f}ms > {args.budget_ms:.0f}ms")
+            sys.exit(1)
+        print(f"[STARTUP] Within budget ({args.budget_ms:.0f}ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Compare legacy JSON storage of assistant payloads with compressed blobs.
+
+Builds two throwaway SQLite databases with the same synthetic history (payloads
+derived from demos/*.json) and reports on-disk size and session read latency:
+
+    python bench/storage_bench.py --sessions 200 --turns 5
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from database import Base, User, ChatSession, ChatMessage, get_session_messages
+
+
+def load_payloads():
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(BACKEND_DIR, "demos", "*.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # Embedded images dominate the demo files; real responses don't carry them
+        data.pop("graph", None)
+        payloads.append(data)
+    return payloads
+
+
+def vary(payload, i):
+    """Perturb a payload so rows aren't byte-identical"""
+    data = dict(payload)
+    words = data["concepts"].split()
+    random.Random(i).shuffle(words)
+    data["concepts"] = " ".join(words)
+    data["further_questions"] = [f"{q} ({i})" for q in data.get("further_questions", [])]
+    return data
+
+
+def build(path, payloads, sessions, turns, legacy):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    user = User(google_id="bench", email="bench@example.com")
+    db.add(user)
+    db.commit()
+    session_ids = []
+    n = 0
+    for s in range(sessions):
+        chat = ChatSession(id=f"session-{s}", user_id=user.id, title="Bench")
+        db.add(chat)
+        session_ids.append(chat.id)
+        for t in range(turns):
+            n += 1
+            db.add(ChatMessage(session_id=chat.id, role="user", content=f"Question {n}"))
+            data = vary(payloads[n % len(payloads)], n)
+            if legacy:
+                db.add(ChatMessage(session_id=chat.id, role="assistant", data_json=data))
+            else:
+                db.add(ChatMessage(session_id=chat.id, role="assistant", data=data))
+        db.commit()
+    db.close()
+    engine.dispose()
+    return session_ids
+
+
+def read_latency(path, session_ids, reads):
+    engine = create_engine(f"sqlite:///{path}")
+    SessionLocal = sessionmaker(bind=engine)
+    timings = []
+    for i in range(reads):
+        db = SessionLocal()
+        start = time.perf_counter()
+        messages = get_session_messages(db, session_ids[i % len(session_ids)])
+        for m in messages:
+            _ = m.data
+        timings.append(time.perf_counter() - start)
+        db.close()
+    engine.dispose()
+    timings.sort()
+    return statistics.mean(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compressed message payload storage")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--reads", type=int, default=500)
+    args = parser.parse_args()
+
+    payloads = load_payloads()
+    workdir = tempfile.mkdtemp(prefix="lyrnios-storage-")
+    results = {}
+    for label, legacy in (("json", True), ("compressed", False)):
+        path = os.path.join(workdir, f"{label}.db")
+        start = time.perf_counter()
+        session_ids = build(path, payloads, args.sessions, args.turns, legacy)
+        write_s = time.perf_counter() - start
+        mean_s, p95_s = read_latency(path, session_ids, args.reads)
+        results[label] = (os.path.getsize(path), write_s, mean_s, p95_s)
+
+    messages = args.sessions * args.turns
+    print(f"{messages} assistant messages, {args.reads} session reads")
+    print(f"{'storage':<12}{'db size':>12}{'bytes/msg':>12}{'write s':>10}{'read mean ms':>15}{'read p95 ms':>14}")
+    for label, (size, write_s, mean_s, p95_s) in results.items():
+        print(
+            f"{label:<12}{size / 1024:>10.0f}KB{size / messages:>12.0f}{write_s:>10.2f}"
+            f"{mean_s * 1000:>15.2f}{p95_s * 1000:>14.2f}"
+        )
+    json_size, compressed_size = results["json"][0], results["compressed"][0]
+    print(f"Compressed database is {compressed_size / json_size:.0%} of the JSON database")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Per-turn overhead of a chat turn over HTTP versus /ws/chat.
+
+An HTTP turn is what the frontend does today: POST /generate, then POST the
+user and the assistant message to /sessions/{id}/messages, each request
+authenticating again. A WebSocket turn is one prompt frame on a connection
+that authenticated once, with both messages stored server-side. Prompts are
+generated once up front, so every measured turn is a cache hit and the
+numbers are the per-turn overhead rather than upstream latency:
+
+    python bench/ws_bench.py --spawn --turns 200 --concurrency 1,8
+    python bench/ws_bench.py --url http://127.0.0.1:8000 --token $JWT
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadgen import PROMPTS, summarize, mint_token, spawn_stack  # noqa: E402
+
+
+async def warm(client, token):
+    for prompt in PROMPTS:
+        response = await client.post("/generate", json={"prompt": prompt}, headers={"Authorization": f"Bearer {token}"})
+        response.raise_for_status()
+
+
+# ── Flows ───────────────────────────────────────────────
+
+async def http_client(client, token, turns, latencies, errors):
+    headers = {"Authorization": f"Bearer {token}"}
+    session = (await client.post("/sessions", json={"title": "bench"}, headers=headers)).json()
+    path = f"/sessions/{session['id']}/messages"
+    for i in range(turns):
+        prompt = PROMPTS[i % len(PROMPTS)]
+        start = time.perf_counter()
+        try:
+            lesson = await client.post("/generate", json={"prompt": prompt}, headers=headers)
+            saved_user = await client.post(path, json={"role": "user", "content": prompt}, headers=headers)
+            saved_lesson = await client.post(path, json={"role": "assistant", "data": lesson.json()}, headers=headers)
+            ok = all(r.status_code < 400 for r in (lesson, saved_user, saved_lesson))
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(1)
+
+
+async def ws_client(ws_url, token, turns, latencies, errors):
+    async with websockets.connect(f"{ws_url}/ws/chat?token={token}", max_size=None) as ws:
+        ready = json.loads(await ws.recv())
+        assert ready["type"] == "ready", ready
+        session_id = None
+        for i in range(turns):
+            start = time.perf_counter()
+            await ws.send(json.dumps({
+                "type": "prompt", "id": i, "prompt": PROMPTS[i % len(PROMPTS)], "session_id": session_id,
+            }))
+            while True:
+                message = json.loads(await ws.recv())
+                if message["type"] == "accepted":
+                    session_id = message["session_id"]
+                elif message["type"] in ("done", "error"):
+                    break
+            if message["type"] == "done":
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(1)
+
+
+async def run_level(flow, args, token, concurrency):
+    latencies, errors = [], []
+    turns = max(args.turns // concurrency, 1)
+    start = time.perf_counter()
+    if flow == "http":
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+            await asyncio.gather(*(http_client(client, token, turns, latencies, errors) for _ in range(concurrency)))
+    else:
+        ws_url = "ws" + args.url[len("http"):]
+        await asyncio.gather(*(ws_client(ws_url, token, turns, latencies, errors) for _ in range(concurrency)))
+    summary = summarize(latencies, len(errors), time.perf_counter() - start)
+    summary["turns_per_s"] = summary.pop("throughput_rps")
+    return summary
+
+
+async def run_all(args, token):
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        await warm(client, token)
+    results = {}
+    for concurrency in args.concurrency:
+        for flow in ("http", "ws"):
+            summary = await run_level(flow, args, token, concurrency)
+            results[f"{flow}@{concurrency}"] = summary
+            print(
+                f"{flow:<5} c={concurrency:<4} turns/s={summary['turns_per_s']:<8} "
+                f"p50={summary['p50_ms']:<8} p95={summary['p95_ms']:<8} p99={summary['p99_ms']:<8} "
+                f"errors={summary['errors']}/{summary['requests']}"
+            )
+        http, ws = results[f"http@{concurrency}"], results[f"ws@{concurrency}"]
+        if ws["p50_ms"]:
+            print(f"      c={concurrency:<4} WebSocket turn p50 is {http['p50_ms'] / ws['p50_ms']:.1f}x faster")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare chat turn overhead over HTTP and /ws/chat")
+    parser.add_argument("--url", default=None, help="app base URL (default: the spawned app)")
+    parser.add_argument("--token", default=None, help="bearer token (minted if omitted)")
+    parser.add_argument("--turns", type=int, default=200, help="turns per flow and level")
+    parser.add_argument("--concurrency", default="1,8")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--out", default=None, help="write results as JSON")
+    parser.add_argument("--spawn", action="store_true", help="start fake Gemini and the app locally")
+    parser.add_argument("--app-port", type=int, default=8001)
+    parser.add_argument("--fake-port", type=int, default=8100)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    # Only the warm-up generates; keep it quick and clean
+    args.fake_latency, args.fake_429, args.fake_500 = "fixed:50", 0.0, 0.0
+    args.fake_truncate = args.fake_malformed = 0.0
+
+    processes = []
+    try:
+        if args.spawn:
+            processes = spawn_stack(args)
+            args.url = args.url or f"http://127.0.0.1:{args.app_port}"
+        args.url = args.url or "http://127.0.0.1:8000"
+        token = args.token or mint_token()
+        results = asyncio.run(run_all(args, token))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"[BENCH] Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Output-token budgets for lesson generation.
+
+Instead of always asking for the model maximum, ai() asks for roughly what
+similar prompts needed before: the p90 of observed output sizes for the same
+(difficulty, prompt length) bucket, plus headroom. Until a bucket has seen
+BUDGET_MIN_SAMPLES responses it gets the full MAX_OUTPUT_TOKENS. Responses that
+still hit the limit are continued from the cut point (see ai._continue_generation),
+and the continued total is what gets recorded, so a bucket that keeps
+truncating grows its budget.
+"""
+import os
+import threading
+from collections import deque
+
+from metrics import OUTPUT_BUDGET
+
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "2048"))
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "8192"))
+BUDGET_HEADROOM = float(os.getenv("BUDGET_HEADROOM", "1.3"))
+BUDGET_MIN_SAMPLES = int(os.getenv("BUDGET_MIN_SAMPLES", "20"))
+# Follow-up calls allowed after a MAX_TOKENS finish; 0 goes straight to JSON repair
+CONTINUATION_ROUNDS = int(os.getenv("CONTINUATION_ROUNDS", "2"))
+# Prompts longer than this are cut in the middle before being sent upstream
+MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "8000"))
+
+_LENGTH_BUCKETS = ((200, "short"), (1000, "medium"))
+
+_sizes = {}  # bucket -> recent output token counts
+_sizes_lock = threading.Lock()
+
+
+def bucket(prompt: str, difficulty_level=None) -> str:
+    length = next((name for limit, name in _LENGTH_BUCKETS if len(prompt) < limit), "long")
+    level = str(difficulty_level).lower() if difficulty_level is not None else "any"
+    return f"{level}:{length}"
+
+
+def record(prompt: str, difficulty_level, output_tokens: int):
+    """Remember how many tokens a complete response for this prompt took"""
+    if not output_tokens:
+        return
+    key = bucket(prompt, difficulty_level)
+    with _sizes_lock:
+        window = _sizes.get(key)
+        if window is None:
+            window = _sizes[key] = deque(maxlen=200)
+        window.append(output_tokens)
+
+
+def estimate(prompt: str, difficulty_level=None) -> int:
+    """max_output_tokens for the next generation of this kind of prompt"""
+    key = bucket(prompt, difficulty_level)
+    with _sizes_lock:
+        window = sorted(_sizes.get(key, ()))
+    if len(window) < BUDGET_MIN_SAMPLES:
+        budget = MAX_OUTPUT_TOKENS
+    else:
+        p90 = window[int(len(window) * 0.9) - 1]
+        budget = min(max(int(p90 * BUDGET_HEADROOM), MIN_OUTPUT_TOKENS), MAX_OUTPUT_TOKENS)
+    OUTPUT_BUDGET.observe(budget)
+    return budget
+
+
+def clip_prompt(prompt: str) -> str:
+    """Keep the start and end of an over-long prompt, where the question usually is"""
+    if len(prompt) <= MAX_PROMPT_CHARS:
+        return prompt
+    head = MAX_PROMPT_CHARS * 2 // 3
+    tail = MAX_PROMPT_CHARS - head
+    print(f"[BUDGET] Prompt clipped from {len(prompt)} to {MAX_PROMPT_CHARS} characters")
+    return prompt[:head] + "\n...\n" + prompt[-tail:]
+
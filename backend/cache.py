@@ -0,0 +1,42 @@
+import hashlib
+import json
+import re
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Canonical form of a prompt for cache lookups: case, spacing and trailing
+    punctuation don't change the lesson we'd generate"""
+    text = " ".join(prompt.lower().split())
+    return re.sub(r"[\s?.!]+$", "", text)
+
+
+def prompt_cache_key(prompt: str, age=None, difficulty_level=None, mode: str = None) -> str:
+    """Stable key for a generation request; `mode` separates variants such as
+    search-grounded lessons from plain ones"""
+    parts = [normalize_prompt(prompt), str(age or ""), str(difficulty_level or "")]
+    if mode:
+        parts.append(mode)
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def payload_hash(data) -> str:
+    """Content address of a response payload: key order and surrounding
+    whitespace in string fields don't affect the hash"""
+    def normalize(value):
+        if isinstance(value, str):
+            return value.strip()
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        return value
+
+    canonical = json.dumps(normalize(data), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(data) -> bool:
+    """Only real lessons are worth serving again, never error placeholders"""
+    if not isinstance(data, dict) or data.get("error"):
+        return False
+    return not str(data.get("foundations", "")).startswith("Error:")
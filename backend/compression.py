@@ -0,0 +1,84 @@
+import json
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional: zlib is always available
+    zstandard = None
+
+# Payloads smaller than this are stored as plain UTF-8 JSON
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "256"))
+
+# "zlib" (stdlib) or "zstd" (needs the zstandard package); existing rows keep
+# whatever codec they were written with.
+PAYLOAD_CODEC = os.getenv("PAYLOAD_CODEC", "zlib")
+
+# One-byte header in front of every stored payload
+RAW_JSON = b"\x00"
+ZLIB_DICT_V1 = b"\x01"
+ZSTD_DICT_V1 = b"\x02"
+
+# Shared dictionary primed with the response schema's field names and the
+# fragments that recur in almost every lesson (JSON punctuation, LaTeX
+# commands, Mermaid and code boilerplate). zlib weighs the end of the
+# dictionary most, so the most common fragments come last.
+# NEVER edit this in place: stored rows depend on it byte for byte. Add a
+# new version with a new header byte instead.
+_DICT_FRAGMENTS_V1 = [
+    "def ", "return ", "import ", "print(", "for i in range(", "if __name__ == '__main__':",
+    "class ", "self.", "    ", "\\n    ", "```python", "```",
+    "sequenceDiagram", "classDiagram", "flowchart TD", "graph LR", "graph TD\\n    ",
+    " --> ", "A[", "B[", "C[", "D[", "E[",
+    "\\\\frac{", "\\\\sqrt{", "\\\\sum_{", "\\\\int_", "\\\\alpha", "\\\\beta", "\\\\theta",
+    "\\\\lambda", "\\\\sigma", "\\\\mu", "\\\\cdot", "\\\\times", "\\\\left(", "\\\\right)",
+    "\\\\mathbf{", "\\\\text{", "$$", "\\\\(", "\\\\)", "^{2}", "_{i}",
+    "Week 1: ", "Week 2: ", "Step 1: ", "Step 2: ", "Problem 1: ", "Problem 2: ",
+    "for example, ", "such as ", "which is ", "this is ", "the ", "and ", "of the ",
+    "is the ", "in the ", "to the ", "that ", "with ", "**", "\\n\\n", "\\n- ", "\\n1. ",
+    '"code":"', '"mermaid_diagram":"', '"further_questions":["', '"study_plan":"',
+    '"problems":"', '"keyconcepts":"', '"formulas":"', '"concepts":"', '"foundations":"',
+    '","', '"],"', '{"foundations":"',
+]
+PAYLOAD_DICT_V1 = "".join(_DICT_FRAGMENTS_V1).encode("utf-8")
+
+
+def _dumps(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_payload(data):
+    """Serialize a JSON-able payload into the stored binary form"""
+    if data is None:
+        return None
+    raw = _dumps(data)
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return RAW_JSON + raw
+    if PAYLOAD_CODEC == "zstd" and zstandard is not None:
+        compressor = zstandard.ZstdCompressor(
+            level=9, dict_data=zstandard.ZstdCompressionDict(PAYLOAD_DICT_V1)
+        )
+        return ZSTD_DICT_V1 + compressor.compress(raw)
+    compressor = zlib.compressobj(level=9, zdict=PAYLOAD_DICT_V1)
+    return ZLIB_DICT_V1 + compressor.compress(raw) + compressor.flush()
+
+
+def decode_payload(blob):
+    """Inverse of encode_payload"""
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    header, body = blob[:1], blob[1:]
+    if header == RAW_JSON:
+        return json.loads(body)
+    if header == ZLIB_DICT_V1:
+        decompressor = zlib.decompressobj(zdict=PAYLOAD_DICT_V1)
+        return json.loads(decompressor.decompress(body) + decompressor.flush())
+    if header == ZSTD_DICT_V1:
+        if zstandard is None:
+            raise RuntimeError("Payload was stored with zstd but the zstandard package is not installed")
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=zstandard.ZstdCompressionDict(PAYLOAD_DICT_V1)
+        )
+        return json.loads(decompressor.decompress(body, max_output_size=64 * 1024 * 1024))
+    raise ValueError(f"Unknown payload header: {header!r}")
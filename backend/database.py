@@ -1,10 +1,17 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Text, JSON
+from sqlalchemy import create_engine, event, func, Column, Integer, String, DateTime, ForeignKey, Text, JSON, LargeBinary, Boolean
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, deferred, undefer, joinedload
 from datetime import datetime
 import os
+import time
 import uuid
 
+from metrics import METRICS_ENABLED, DB_QUERY_SECONDS
+from compression import encode_payload, decode_payload
+from cache import payload_hash
+from search import init_search, index_message, unindex_message, unindex_session
+
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./lyrnios_auth.db")
 
@@ -13,6 +20,20 @@ engine = create_engine(
     connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
 )
 
+
+
+if METRICS_ENABLED:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+        DB_QUERY_SECONDS.observe(elapsed, operation=operation)
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -40,7 +61,10 @@ class ChatSession(Base):
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     title = Column(String, default="New Chat")
     created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Set while the messages live in a cold archive file (see archive.py)
+    archived_at = Column(DateTime, nullable=True, index=True)
+    archived_messages = Column(Integer, nullable=True)
 
     # Relationships
     user = relationship("User", back_populates="chat_sessions")
@@ -54,11 +78,99 @@ class ChatMessage(Base):
     session_id = Column(String, ForeignKey("chat_sessions.id", ondelete="CASCADE"), nullable=False, index=True)
     role = Column(String, nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=True)  # text content for user messages
-    data = Column(JSON, nullable=True)     # JSON data for assistant responses
+    data_json = Column("data", JSON(none_as_null=True), nullable=True)  # legacy uncompressed payloads (see migrations.py)
+    data_blob = deferred(Column(LargeBinary, nullable=True))  # compressed JSON for assistant responses
+    payload_hash = Column(String(64), ForeignKey("message_payloads.hash"), nullable=True, index=True)  # shared payload
     created_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
     session = relationship("ChatSession", back_populates="messages")
+    payload = relationship("MessagePayload")
+
+    @property
+    def data(self):
+        """Assistant payload, decompressed on first access"""
+        if "_data_cache" not in self.__dict__:
+            if self.payload_hash is not None:
+                value = self.payload.data
+            elif self.data_blob is not None:
+                value = decode_payload(self.data_blob)
+            else:
+                value = self.data_json
+            self.__dict__["_data_cache"] = value
+        return self.__dict__["_data_cache"]
+
+    @data.setter
+    def data(self, value):
+        self.data_blob = encode_payload(value)
+        self.data_json = None
+        self.__dict__["_data_cache"] = value
+
+    def attach_payload(self, payload_hash: str, value):
+        """Point this message at a shared payload row instead of an inline blob"""
+        self.payload_hash = payload_hash
+        self.data_blob = None
+        self.data_json = None
+        self.__dict__["_data_cache"] = value
+
+
+class MessagePayload(Base):
+    """Assistant response stored once and shared by every message with the same content"""
+    __tablename__ = "message_payloads"
+
+    hash = Column(String(64), primary_key=True)  # sha256 of the normalized payload
+    blob = Column(LargeBinary, nullable=False)  # compressed JSON, see compression.py
+    ref_count = Column(Integer, nullable=False, default=0)
+    prompt_key = Column(String(64), nullable=True, index=True)  # cache key of the prompt that produced it
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    @property
+    def data(self):
+        if "_data_cache" not in self.__dict__:
+            self.__dict__["_data_cache"] = decode_payload(self.blob)
+        return self.__dict__["_data_cache"]
+
+
+class UsageEvent(Base):
+    """One generation request's upstream spend, written in batches by usage.py"""
+    __tablename__ = "usage_events"
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+    user_id = Column(Integer, nullable=True, index=True)  # NULL for anonymous requests
+    feature = Column(String(32), nullable=False)  # generate, generate_search, field, prefetch, refresh
+    model = Column(String(64), nullable=True)  # first model called; NULL when nothing was called
+    key_index = Column(Integer, nullable=True)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    output_tokens = Column(Integer, nullable=False, default=0)
+    thought_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0)
+    upstream_calls = Column(Integer, nullable=False, default=0)
+    retries = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Integer, nullable=False, default=0)
+    cache_hit = Column(Boolean, nullable=False, default=False)
+    cache = Column(String(32), nullable=True)  # which cache answered, for hits
+    status = Column(String(16), nullable=False, default="ok")  # ok, error, cancelled, timeout
+
+
+class UsageRollup(Base):
+    """Hourly per-user totals of usage_events, kept up to date on every flush"""
+    __tablename__ = "usage_rollups"
+
+    hour = Column(DateTime, primary_key=True)
+    user_id = Column(Integer, primary_key=True)  # 0 for anonymous requests
+    feature = Column(String(32), primary_key=True)
+    model = Column(String(64), primary_key=True)  # "" when nothing was called
+    requests = Column(Integer, nullable=False, default=0)
+    cache_hits = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    output_tokens = Column(Integer, nullable=False, default=0)
+    thought_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0)
+    upstream_calls = Column(Integer, nullable=False, default=0)
+    retries = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Integer, nullable=False, default=0)  # sum; divide by requests for the mean
 
 
 # ── Database utilities ──────────────────────────────────
@@ -76,6 +188,10 @@ def init_db():
     """Initialize database tables"""
     Base.metadata.create_all(bind=engine)
 
+    from migrations import add_missing_columns
+    add_missing_columns()
+    init_search(engine)
+
 
 # ── User CRUD ───────────────────────────────────────────
 
@@ -130,6 +246,31 @@ def get_user_sessions(db, user_id: int, limit: int = 50, offset: int = 0):
     )
 
 
+def get_sessions_version(db, user_id: int):
+    """(session count, newest updated_at) for a user; changes whenever the session list would"""
+    return (
+        db.query(func.count(ChatSession.id), func.max(ChatSession.updated_at))
+        .filter(ChatSession.user_id == user_id)
+        .one()
+    )
+
+
+def get_session_version(db, session_id: str):
+    """(user_id, updated_at, message count, max message id, archived_at) for one
+    session, or None if it doesn't exist. Aggregates only, no message rows are loaded."""
+    row = (
+        db.query(
+            ChatSession.user_id, ChatSession.updated_at,
+            func.count(ChatMessage.id), func.max(ChatMessage.id), ChatSession.archived_at,
+        )
+        .outerjoin(ChatMessage, ChatMessage.session_id == ChatSession.id)
+        .filter(ChatSession.id == session_id)
+        .group_by(ChatSession.id)
+        .first()
+    )
+    return tuple(row) if row else None
+
+
 def get_session_by_id(db, session_id: str):
     """Get a chat session by ID"""
     return db.query(ChatSession).filter(ChatSession.id == session_id).first()
@@ -150,12 +291,101 @@ def delete_chat_session(db, session_id: str):
     """Delete a chat session and all its messages"""
     session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
     if session:
+        release_payloads(db, ChatMessage.session_id == session_id)
+        unindex_session(db, session_id)
         db.delete(session)
         db.commit()
         return True
     return False
 
 
+# ── MessagePayload CRUD ─────────────────────────────────
+
+def store_payload(db, data: dict, prompt_key: str = None) -> str:
+    """Store a payload once (or take another reference to it) and return its hash"""
+    digest = payload_hash(data)
+    bumped = (
+        db.query(MessagePayload)
+        .filter(MessagePayload.hash == digest)
+        .update({MessagePayload.ref_count: MessagePayload.ref_count + 1}, synchronize_session=False)
+    )
+    if bumped:
+        if prompt_key:
+            db.query(MessagePayload).filter(
+                MessagePayload.hash == digest, MessagePayload.prompt_key.is_(None)
+            ).update({MessagePayload.prompt_key: prompt_key}, synchronize_session=False)
+        return digest
+
+    try:
+        with db.begin_nested():
+            db.add(MessagePayload(hash=digest, blob=encode_payload(data), ref_count=1, prompt_key=prompt_key))
+    except IntegrityError:
+        # Another request stored the same payload between our UPDATE and INSERT
+        db.query(MessagePayload).filter(MessagePayload.hash == digest).update(
+            {MessagePayload.ref_count: MessagePayload.ref_count + 1}, synchronize_session=False
+        )
+    return digest
+
+
+def release_payloads(db, *criteria):
+    """Drop one reference per matching message and delete payloads nobody uses"""
+    counts = (
+        db.query(ChatMessage.payload_hash, func.count(ChatMessage.id))
+        .filter(ChatMessage.payload_hash.isnot(None), *criteria)
+        .group_by(ChatMessage.payload_hash)
+        .all()
+    )
+    for digest, count in counts:
+        db.query(MessagePayload).filter(MessagePayload.hash == digest).update(
+            {MessagePayload.ref_count: MessagePayload.ref_count - count}, synchronize_session=False
+        )
+    if counts:
+        db.query(MessagePayload).filter(
+            MessagePayload.hash.in_([digest for digest, _ in counts]),
+            MessagePayload.ref_count <= 0,
+        ).delete(synchronize_session=False)
+
+
+def remember_generated(db, data: dict, prompt_key: str):
+    """Mark a lesson the server generated for `prompt_key` as servable from the
+    history cache. Client-supplied payloads never get a key, so stored history
+    can't be used to plant answers for other users' prompts."""
+    digest = payload_hash(data)
+    if db.query(MessagePayload).filter(MessagePayload.hash == digest).update(
+        {MessagePayload.prompt_key: prompt_key}, synchronize_session=False
+    ):
+        db.commit()
+        return digest
+    try:
+        # Unreferenced until a message saves it; released like any other payload
+        with db.begin_nested():
+            db.add(MessagePayload(hash=digest, blob=encode_payload(data), ref_count=0, prompt_key=prompt_key))
+    except IntegrityError:
+        db.query(MessagePayload).filter(MessagePayload.hash == digest).update(
+            {MessagePayload.prompt_key: prompt_key}, synchronize_session=False
+        )
+    db.commit()
+    return digest
+
+
+def find_cached_payload(db, prompt_key: str):
+    """Most recent stored response generated for this prompt, if any"""
+    return (
+        db.query(MessagePayload)
+        .filter(MessagePayload.prompt_key == prompt_key)
+        .order_by(MessagePayload.created_at.desc())
+        .first()
+    )
+
+
+def _last_user_prompt(db, session_id: str, before_id: int = None):
+    query = db.query(ChatMessage.content).filter(ChatMessage.session_id == session_id, ChatMessage.role == "user")
+    if before_id is not None:
+        query = query.filter(ChatMessage.id < before_id)
+    row = query.order_by(ChatMessage.id.desc()).first()
+    return row[0] if row else None
+
+
 # ── ChatMessage CRUD ────────────────────────────────────
 
 def add_message(db, session_id: str, role: str, content: str = None, data: dict = None):
@@ -163,26 +393,101 @@ def add_message(db, session_id: str, role: str, content: str = None, data: dict
     message = ChatMessage(
         session_id=session_id,
         role=role,
-        content=content,
-        data=data
+        content=content
     )
+    if data is not None:
+        message.attach_payload(store_payload(db, data), data)
     db.add(message)
 
     # Update session's updated_at timestamp
     session = db.query(ChatSession).filter(ChatSession.id == session_id).first()
     if session:
         session.updated_at = datetime.utcnow()
+        db.flush()
+        index_message(db, message.id, session.user_id, content, data)
 
     db.commit()
     db.refresh(message)
     return message
 
 
+def get_message_by_id(db, message_id: int):
+    """Get a message with its session and payload loaded"""
+    return (
+        db.query(ChatMessage)
+        .options(undefer(ChatMessage.data_blob), joinedload(ChatMessage.payload), joinedload(ChatMessage.session))
+        .filter(ChatMessage.id == message_id)
+        .first()
+    )
+
+
+def get_message_prompt(db, message):
+    """The user prompt an assistant message answered"""
+    return _last_user_prompt(db, message.session_id, before_id=message.id)
+
+
+def update_message_data(db, message, data: dict):
+    """Replace a message's payload, moving its reference to the new content"""
+    release_payloads(db, ChatMessage.id == message.id)
+    message.attach_payload(store_payload(db, data), data)
+    # Content changed without a new message; this is what moves the session's ETag
+    message.session.updated_at = datetime.utcnow()
+
+    unindex_message(db, message.id)
+    index_message(db, message.id, message.session.user_id, message.content, data)
+    db.commit()
+    return message
+
+
 def get_session_messages(db, session_id: str):
     """Get all messages in a session, ordered by creation time"""
     return (
         db.query(ChatMessage)
+        .options(undefer(ChatMessage.data_blob), joinedload(ChatMessage.payload))
         .filter(ChatMessage.session_id == session_id)
         .order_by(ChatMessage.created_at.asc())
         .all()
     )
+
+
+def get_session_messages_after(db, session_id: str, after_id: int):
+    """Messages added to a session after message `after_id`, oldest first"""
+    return (
+        db.query(ChatMessage)
+        .options(undefer(ChatMessage.data_blob), joinedload(ChatMessage.payload))
+        .filter(ChatMessage.session_id == session_id, ChatMessage.id > after_id)
+        .order_by(ChatMessage.id.asc())
+        .all()
+    )
+
+
+# ── Usage queries ───────────────────────────────────────
+
+USAGE_TOTAL_COLUMNS = (
+    "requests", "cache_hits", "errors", "prompt_tokens", "output_tokens",
+    "thought_tokens", "cached_tokens", "upstream_calls", "retries", "latency_ms",
+)
+
+
+def get_usage_totals(db, user_id: int, since: datetime) -> dict:
+    """A user's summed usage_rollups from the hour containing `since` onwards"""
+    hour = since.replace(minute=0, second=0, microsecond=0)
+    row = (
+        db.query(*[func.coalesce(func.sum(getattr(UsageRollup, c)), 0) for c in USAGE_TOTAL_COLUMNS])
+        .filter(UsageRollup.user_id == user_id, UsageRollup.hour >= hour)
+        .one()
+    )
+    return dict(zip(USAGE_TOTAL_COLUMNS, (int(v) for v in row)))
+
+
+def get_usage_by_day(db, user_id: int, since: datetime):
+    """[(day, feature, totals)] for a user since `since`, oldest first"""
+    day = func.date(UsageRollup.hour)
+    rows = (
+        db.query(day, UsageRollup.feature, *[func.sum(getattr(UsageRollup, c)) for c in USAGE_TOTAL_COLUMNS])
+        .filter(UsageRollup.user_id == user_id, UsageRollup.hour >= since)
+        .group_by(day, UsageRollup.feature)
+        .order_by(day, UsageRollup.feature)
+        .all()
+    )
+    return [(str(r[0]), r[1], dict(zip(USAGE_TOTAL_COLUMNS, (int(v or 0) for v in r[2:])))) for r in rows]
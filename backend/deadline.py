@@ -0,0 +1,58 @@
+import os
+import threading
+import time
+
+# Overall wall-clock budget for one /generate request, in seconds
+REQUEST_BUDGET_SECONDS = float(os.getenv("REQUEST_BUDGET_SECONDS", "90"))
+
+# Upper bound for a single upstream attempt, in seconds
+ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("ATTEMPT_TIMEOUT_SECONDS", "45"))
+
+# Don't start an attempt with less than this much budget left
+MIN_ATTEMPT_SECONDS = float(os.getenv("MIN_ATTEMPT_SECONDS", "3"))
+
+
+class RequestCancelled(Exception):
+    """The client went away; stop spending upstream quota on this request"""
+
+
+class DeadlineExceeded(Exception):
+    """The request budget ran out before a usable response was produced"""
+
+
+class Deadline:
+    """Per-request time budget plus a cancellation flag shared with worker threads"""
+
+    def __init__(self, budget: float = None):
+        self.expires_at = time.monotonic() + budget if budget else None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float("inf")
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def attempt_timeout(self, cap: float = ATTEMPT_TIMEOUT_SECONDS) -> float:
+        """Timeout for the next upstream attempt: the smaller of `cap` and what's left"""
+        return min(cap, self.remaining())
+
+    def can_attempt(self, minimum: float = MIN_ATTEMPT_SECONDS) -> bool:
+        return not self.cancelled and self.remaining() >= minimum
+
+    def check(self):
+        """Raise if the request was cancelled or has no budget left for another attempt"""
+        if self.cancelled:
+            raise RequestCancelled("Client disconnected")
+        if self.remaining() < MIN_ATTEMPT_SECONDS:
+            raise DeadlineExceeded(f"Request budget exhausted ({self.remaining():.1f}s left)")
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep up to `timeout` seconds; returns True early if cancelled"""
+        return self._cancelled.wait(timeout)
@@ -0,0 +1,84 @@
+"""Search-grounded lessons in two stages.
+
+Stage one runs a Google Search call (ai.grounded_search) and caches its notes
+and sources by normalized prompt for SEARCH_CACHE_TTL seconds; concurrent
+requests for the same topic, on any worker, wait for a single search. Stage
+two is the normal structured lesson generation with those notes appended, so
+the result is a schema-conforming dict that the response cache can hold.
+"""
+import os
+import time
+
+from ai import ai, grounded_search
+from cache import prompt_cache_key
+from compression import encode_payload, decode_payload
+from deadline import Deadline, RequestCancelled
+from metrics import CACHE_HITS, CACHE_MISSES, stage
+from state import get_state
+
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "21600"))
+# Notes beyond this many characters are cut before the lesson call
+SEARCH_NOTES_MAX_CHARS = int(os.getenv("SEARCH_NOTES_MAX_CHARS", "6000"))
+SEARCH_LOCK_SECONDS = 60
+
+GROUNDING_CONTEXT = """Research notes from a web search (prefer these over prior knowledge where they
+disagree, and keep the lesson consistent with them):
+{notes}
+
+Sources:
+{sources}"""
+
+
+def search_notes(prompt: str, deadline: Deadline = None):
+    """Cached, single-flight grounded search for `prompt`"""
+    key = prompt_cache_key(prompt)
+    state = get_state()
+    blob = state.cache_get(f"search:{key}")
+    if blob is not None:
+        CACHE_HITS.inc(cache="search")
+        return decode_payload(blob)
+    CACHE_MISSES.inc(cache="search")
+
+    lock_name = f"search:{key}"
+    token = state.acquire_lock(lock_name, ttl=SEARCH_LOCK_SECONDS)
+    if token is None:
+        print("[SEARCH] Same topic already being searched, waiting for its result")
+        while state.lock_held(lock_name) and (deadline is None or deadline.remaining() > 0):
+            if deadline is None:
+                time.sleep(0.25)
+            elif deadline.wait(0.25):
+                raise RequestCancelled("Client disconnected while waiting")
+        blob = state.cache_get(f"search:{key}")
+        if blob is not None:
+            CACHE_HITS.inc(cache="search_single_flight")
+            return decode_payload(blob)
+        token = state.acquire_lock(lock_name, ttl=SEARCH_LOCK_SECONDS)
+
+    try:
+        result = grounded_search(prompt, deadline=deadline)
+        state.cache_set(f"search:{key}", encode_payload(result), ttl=SEARCH_CACHE_TTL)
+        return result
+    finally:
+        if token is not None:
+            state.release_lock(lock_name, token)
+
+
+def generate_grounded(prompt: str, deadline: Deadline = None):
+    """A lesson dict grounded in search results, with a "sources" list added.
+    If the search stage fails the lesson is generated without it."""
+    try:
+        with stage("search"):
+            found = search_notes(prompt, deadline)
+    except ValueError as e:
+        print(f"[SEARCH] Generating without grounding: {e}")
+        found = {"notes": "", "sources": []}
+
+    context = None
+    if found["notes"]:
+        context = GROUNDING_CONTEXT.format(
+            notes=found["notes"][:SEARCH_NOTES_MAX_CHARS],
+            sources="\n".join(f"- {s['title']}: {s['uri']}" for s in found["sources"]) or "(none listed)",
+        )
+    result = ai(prompt, deadline=deadline, context=context)
+    result["sources"] = found["sources"]
+    return result
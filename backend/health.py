@@ -0,0 +1,135 @@
+"""Readiness checks behind /health/ready.
+
+The checks run in the background every HEALTH_PROBE_INTERVAL seconds and the
+endpoint only reads their last results, so orchestrator polling never adds
+database, state-backend or upstream load. A worker reports 503, and is taken
+out of rotation, while any of its own checks (startup, database, cache)
+fails or its results have gone stale.
+
+API key health is reported but doesn't count by default: every worker shares
+the same keys, so a 429 storm would take the whole fleet out of rotation at
+once, including cache hits and routes that never call upstream.
+HEALTH_REQUIRE_KEYS=1 makes it count.
+"""
+import asyncio
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import text
+
+from database import engine
+from state import get_state
+
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "10"))
+# Results older than this count as failed (e.g. the probe loop is wedged)
+HEALTH_STALE_AFTER = float(os.getenv("HEALTH_STALE_AFTER", str(HEALTH_PROBE_INTERVAL * 3)))
+HEALTH_REQUIRE_KEYS = os.getenv("HEALTH_REQUIRE_KEYS", "0") == "1"
+
+_startup = {"database": False, "upstream": False, "error": None}
+_results = {}  # check name -> last probe result
+_lock = threading.Lock()
+
+
+def mark_started(component: str):
+    _startup[component] = True
+
+
+def mark_failed(component: str, error: str):
+    _startup[component] = False
+    _startup["error"] = error
+
+
+# ── Probes ──────────────────────────────────────────────
+
+def probe_database():
+    """Round-trip to the database; on SQLite, also make sure the write lock is free"""
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        if engine.dialect.name == "sqlite":
+            # A plain read succeeds even while another connection holds the lock
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            conn.exec_driver_sql("ROLLBACK")
+    return {"ok": True}
+
+
+def probe_keys():
+    """At least one API key is out of cooldown"""
+    from ai import API_KEYS
+    if not API_KEYS:
+        return {"ok": False, "error": "API_KEYS is empty"}
+    keys = get_state().key_health(len(API_KEYS))
+    available = sum(1 for k in keys if not k["cooling_down"])
+    result = {"ok": available > 0, "available": available, "total": len(keys)}
+    if not available:
+        result["error"] = "every key is cooling down"
+    return result
+
+
+def probe_cache():
+    """The shared state backend (response cache, locks) answers reads and writes"""
+    state = get_state()
+    key = f"health:probe:{socket.gethostname()}:{os.getpid()}"
+    token = str(time.time()).encode()
+    state.set(key, token, ttl=HEALTH_STALE_AFTER)
+    result = {"ok": state.get(key) == token, "backend": type(state).__name__}
+    if not result["ok"]:
+        result["error"] = "read back a different value"
+    return result
+
+
+PROBES = {
+    "database": probe_database,
+    "keys": probe_keys,
+    "cache": probe_cache,
+}
+
+# Checks that decide readiness; the rest are only reported
+GATING = ("startup", "database", "cache") + (("keys",) if HEALTH_REQUIRE_KEYS else ())
+
+
+def run_probes():
+    for name, probe in PROBES.items():
+        started = time.perf_counter()
+        try:
+            result = probe()
+        except Exception as e:
+            result = {"ok": False, "error": str(e).splitlines()[0]}
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        result["checked_at"] = time.time()
+        if not result["ok"]:
+            print(f"[HEALTH] {name} check failed: {result['error']}")
+        with _lock:
+            _results[name] = result
+
+
+async def probe_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await loop.run_in_executor(None, run_probes)
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+
+
+# ── Readiness ───────────────────────────────────────────
+
+def readiness():
+    """(ready, report) from the last probe results; does no I/O"""
+    now = time.time()
+    checks = {"startup": dict(_startup, ok=_startup["database"] and _startup["upstream"])}
+    with _lock:
+        results = {name: dict(result) for name, result in _results.items()}
+
+    for name in PROBES:
+        result = results.get(name)
+        if result is None:
+            checks[name] = {"ok": False, "error": "not checked yet"}
+            continue
+        result["age_s"] = round(now - result.pop("checked_at"), 1)
+        if result["age_s"] > HEALTH_STALE_AFTER:
+            result["ok"] = False
+            result["error"] = "stale"
+        checks[name] = result
+
+    ready = all(checks[name]["ok"] for name in GATING)
+    return ready, {"status": "ready" if ready else "not_ready", "checks": checks}
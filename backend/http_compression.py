@@ -0,0 +1,225 @@
+"""Response compression negotiated from Accept-Encoding.
+
+gzip is always available; br and zstd are offered when the brotli and
+zstandard packages are installed. CompressionMiddleware compresses responses
+on the fly, flushing after every chunk of a streamed response so incremental
+delivery still works. Bodies that are served over and over (cached lessons,
+demos) are compressed once with encode_variants() and sent as they are;
+the middleware leaves responses that already carry Content-Encoding alone.
+"""
+import json
+import os
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import RESPONSE_ENCODINGS
+
+try:
+    import brotli
+except ImportError:  # optional: gzip is always available
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "1") == "1"
+# Smaller complete bodies are sent uncompressed; streamed bodies are always compressed
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESS_MIN_BYTES", "1024"))
+# Server preference when the client accepts several encodings equally
+RESPONSE_ENCODINGS_PREFERENCE = [
+    e.strip() for e in os.getenv("RESPONSE_ENCODINGS", "br,zstd,gzip").split(",") if e.strip()
+]
+
+# Per-request compression favours speed; bodies compressed once for reuse favour size
+_DYNAMIC_LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+_STATIC_LEVELS = {"gzip": 9, "br": 11, "zstd": 19}
+
+_COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/javascript", "application/xml", "image/svg+xml",
+)
+
+
+def available_encodings():
+    encodings = ["gzip"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return [e for e in RESPONSE_ENCODINGS_PREFERENCE if e in encodings]
+
+
+def negotiate(accept_encoding: str):
+    """The encoding to answer with, or None for identity"""
+    if not RESPONSE_COMPRESSION or not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+
+    best, best_weight = None, 0.0
+    for encoding in available_encodings():
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+# ── Compressors ─────────────────────────────────────────
+
+def compress(body: bytes, encoding: str, level: int = None) -> bytes:
+    """One-shot compression of a complete body"""
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level or _DYNAMIC_LEVELS["gzip"], zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == "br":
+        return brotli.compress(body, quality=level or _DYNAMIC_LEVELS["br"])
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level or _DYNAMIC_LEVELS["zstd"]).compress(body)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+class StreamCompressor:
+    """Incremental compressor whose flush() makes everything written so far decodable"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        level = _DYNAMIC_LEVELS[encoding]
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=level)
+        else:
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "gzip":
+            return self._obj.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self._obj.flush()
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+# ── Precompressed bodies ────────────────────────────────
+
+def render_json(data) -> bytes:
+    """The same bytes FastAPI's JSONResponse would send for `data`"""
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def encode_variants(body: bytes) -> dict:
+    """`body` in every available encoding, plus "identity", for serving as-is"""
+    variants = {"identity": body}
+    for encoding in available_encodings():
+        variants[encoding] = compress(body, encoding, level=_STATIC_LEVELS[encoding])
+    return variants
+
+
+def precompressed_headers(encoding) -> dict:
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    RESPONSE_ENCODINGS.inc(encoding=encoding or "identity", mode="precompressed")
+    return headers
+
+
+# ── Middleware ──────────────────────────────────────────
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = RESPONSE_COMPRESS_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _Responder(encoding, send, self.minimum_size).send)
+
+
+class _Responder:
+    def __init__(self, encoding, send, minimum_size):
+        self.encoding = encoding
+        self._send = send
+        self.minimum_size = minimum_size
+        self.start = None
+        self.passthrough = False
+        self.stream = None
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            self.passthrough = (
+                "content-encoding" in headers
+                or message["status"] < 200
+                or message["status"] in (204, 304)
+                or not content_type.startswith(_COMPRESSIBLE_TYPES)
+            )
+            if self.passthrough:
+                await self._send(message)
+            else:
+                # Held back until the first body chunk shows whether this is a stream
+                self.start = message
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(raw=start["headers"])
+            if not more_body:
+                if len(body) < self.minimum_size:
+                    self.passthrough = True
+                    await self._send(start)
+                    await self._send(message)
+                    return
+                body = compress(body, self.encoding)
+                headers["Content-Encoding"] = self.encoding
+                headers["Content-Length"] = str(len(body))
+                headers.add_vary_header("Accept-Encoding")
+                RESPONSE_ENCODINGS.inc(encoding=self.encoding, mode="dynamic")
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body})
+                return
+
+            self.stream = StreamCompressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if "content-length" in headers:
+                del headers["Content-Length"]
+            RESPONSE_ENCODINGS.inc(encoding=self.encoding, mode="streamed")
+            await self._send(start)
+
+        chunk = self.stream.compress(body)
+        # Flush every chunk so the client can decode it right away
+        chunk += self.stream.flush() if more_body else self.stream.finish()
+        await self._send({"type": "http.response.body", "body": chunk, "more_body": more_body})
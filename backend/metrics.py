@@ -0,0 +1,292 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Metrics are on by default; set METRICS_ENABLED=0 to turn every timer and
+# counter into a no-op.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+_registry = []
+
+
+# ── Metric types ────────────────────────────────────────
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by labels"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the elapsed wall time of its block"""
+        if not METRICS_ENABLED:
+            return _NOOP_TIMER
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ("le", bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            plain = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{plain} {series[-2]}")
+            lines.append(f"{self.name}_count{plain} {series[-1]}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_labels", "_start")
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ── Application metrics ─────────────────────────────────
+
+STAGE_SECONDS = Histogram(
+    "lyrnios_stage_seconds",
+    "Wall time spent in each /generate pipeline stage",
+    ["stage"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "lyrnios_db_query_seconds",
+    "Database statement latency by statement type",
+    ["operation"],
+)
+RETRIES = Counter(
+    "lyrnios_upstream_retries_total",
+    "Upstream Gemini attempts that failed and were retried, by API key index",
+    ["key"],
+)
+KEY_ROTATIONS = Counter(
+    "lyrnios_key_rotations_total",
+    "Number of API key rotations",
+)
+REPAIR_PATHS = Counter(
+    "lyrnios_json_repair_total",
+    "Which JSON validation/repair path produced the parsed response",
+    ["path"],
+)
+FALLBACKS = Counter(
+    "lyrnios_fallback_responses_total",
+    "Placeholder responses returned instead of generated content",
+    ["reason"],
+)
+CACHE_HITS = Counter(
+    "lyrnios_cache_hits_total",
+    "Response cache hits by cache name",
+    ["cache"],
+)
+CACHE_MISSES = Counter(
+    "lyrnios_cache_misses_total",
+    "Response cache misses by cache name",
+    ["cache"],
+)
+HEDGES = Counter(
+    "lyrnios_hedges_total",
+    "Hedged upstream attempts: fired, skipped by the cost cap, and which leg won",
+    ["outcome"],
+)
+DUPLICATE_TOKENS = Counter(
+    "lyrnios_hedge_duplicate_tokens_total",
+    "Estimated tokens spent on hedge attempts",
+)
+ROUTED = Counter(
+    "lyrnios_model_routed_total",
+    "Upstream calls by routing tier and model",
+    ["tier", "model"],
+)
+VALIDATION_ISSUES = Counter(
+    "lyrnios_validation_issues_total",
+    "Problems found by the local quality gate, by field and kind",
+    ["field", "kind"],
+)
+FIELD_REPAIRS = Counter(
+    "lyrnios_field_repairs_total",
+    "Fields fixed locally, regenerated with a targeted prompt, or left broken",
+    ["outcome"],
+)
+
+UPSTREAM_TOKENS = Counter(
+    "lyrnios_upstream_tokens_total",
+    "Tokens reported by Gemini usage metadata, by kind (prompt, output, thoughts) and model",
+    ["kind", "model"],
+)
+FINISH_REASONS = Counter(
+    "lyrnios_finish_reasons_total",
+    "Finish reason of each lesson generation call; MAX_TOKENS over the total is the truncation rate",
+    ["reason"],
+)
+TRUNCATIONS = Counter(
+    "lyrnios_truncations_total",
+    "Truncated lesson responses, by whether continuation completed them or JSON repair had to",
+    ["outcome"],
+)
+OUTPUT_BUDGET = Histogram(
+    "lyrnios_output_token_budget",
+    "max_output_tokens requested for lesson generations",
+    buckets=(1024, 2048, 3072, 4096, 6144, 8192, 16384, 32768, 65536),
+)
+
+RESPONSE_ENCODINGS = Counter(
+    "lyrnios_response_encodings_total",
+    "Responses by Content-Encoding and how they were encoded (precompressed, dynamic, streamed)",
+    ["encoding", "mode"],
+)
+
+PREFETCHES = Counter(
+    "lyrnios_prefetch_total",
+    "Prefetch jobs by outcome: queued, dropped, cached, busy, preempted, failed, generated, and hit when a prefetched lesson is served",
+    ["outcome"],
+)
+PREFETCH_TOKENS = Counter(
+    "lyrnios_prefetch_tokens_total",
+    "Estimated output tokens of prefetched lessons (spent) and of those later served (used)",
+    ["kind"],
+)
+CACHE_REFRESHES = Counter(
+    "lyrnios_cache_refresh_total",
+    "Stale-while-revalidate: stale entries served, and background refreshes queued, refreshed, busy, preempted or failed",
+    ["outcome"],
+)
+SESSION_ARCHIVE = Counter(
+    "lyrnios_session_archive_total",
+    "Chat sessions moved to the cold archive, rehydrated from it, or that failed either way",
+    ["operation"],
+)
+USAGE_RECORDS = Counter(
+    "lyrnios_usage_records_total",
+    "Usage ledger records buffered, written to the database, or dropped because the buffer was full",
+    ["outcome"],
+)
+WS_CONNECTIONS = Counter(
+    "lyrnios_ws_connections_total",
+    "/ws/chat connections opened, authenticated, rejected and closed (open = opened - closed)",
+    ["event"],
+)
+WS_FRAMES = Counter(
+    "lyrnios_ws_frames_total",
+    "/ws/chat frames received (in) and sent (out)",
+    ["direction"],
+)
+WS_TURNS = Counter(
+    "lyrnios_ws_turns_total",
+    "/ws/chat turns by outcome: generated, cached, refused, cancelled or failed",
+    ["outcome"],
+)
+PROFILES = Counter(
+    "lyrnios_profiles_total",
+    "Requests profiled, by mode (sample, cprofile) and trigger (header, sampled)",
+    ["mode", "trigger"],
+)
+
+
+def stage(name):
+    """Time a pipeline stage: `with stage("upstream"): ...`"""
+    if not METRICS_ENABLED:
+        return _NOOP_TIMER
+    return _Timer(STAGE_SECONDS, {"stage": name})
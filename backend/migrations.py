@@ -0,0 +1,226 @@
+"""Schema and data migrations for existing databases.
+
+`init_db()` runs `add_missing_columns()` on every startup. Data backfills are
+run by hand:
+
+    python migrations.py compress-messages [--batch-size 500] [--vacuum]
+    python migrations.py dedupe-payloads [--batch-size 500] [--vacuum]
+    python migrations.py clear-prompt-keys
+    python migrations.py index-messages [--batch-size 500]
+    python migrations.py archive-sessions [--days 90] [--batch-size 100] [--vacuum]
+"""
+import argparse
+
+from sqlalchemy import inspect, text, or_
+from sqlalchemy.schema import CreateIndex
+
+from database import engine, Base, SessionLocal, ChatSession, ChatMessage, MessagePayload, store_payload
+from search import init_search, index_message, search_enabled
+from archive import archive_stale_sessions, ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+
+
+def add_missing_columns():
+    """ALTER existing tables to add columns (and their indexes) declared on the models.
+
+    create_all() only creates missing tables, so columns added to a model after a
+    database was created would otherwise never appear.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                print(f"[MIGRATION] Adding column {table.name}.{column.name} ({column_type})")
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+            existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    print(f"[MIGRATION] Creating index {index.name}")
+                    conn.execute(CreateIndex(index))
+
+
+def compress_messages(batch_size: int = 500) -> int:
+    """Move legacy `chat_messages.data` JSON into the compressed `data_blob` column"""
+    db = SessionLocal()
+    migrated = 0
+    last_id = 0
+    try:
+        while True:
+            rows = (
+                db.query(ChatMessage)
+                .filter(ChatMessage.id > last_id)
+                .filter(ChatMessage.data_blob.is_(None))
+                .filter(ChatMessage.data_json.isnot(None))
+                .order_by(ChatMessage.id.asc())
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            for message in rows:
+                # Re-assigning through the property compresses and clears the legacy column
+                message.data = message.data_json
+            db.commit()
+            migrated += len(rows)
+            last_id = rows[-1].id
+            print(f"[MIGRATION] Compressed {migrated} messages (last id {last_id})")
+    finally:
+        db.close()
+    return migrated
+
+
+def dedupe_payloads(batch_size: int = 500) -> int:
+    """Move inline message payloads into the shared, content-addressed message_payloads table"""
+    db = SessionLocal()
+    migrated = 0
+    last_id = 0
+    try:
+        while True:
+            rows = (
+                db.query(ChatMessage)
+                .filter(ChatMessage.id > last_id)
+                .filter(ChatMessage.payload_hash.is_(None))
+                .filter(or_(ChatMessage.data_blob.isnot(None), ChatMessage.data_json.isnot(None)))
+                .order_by(ChatMessage.id.asc())
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            for message in rows:
+                data = message.data
+                if data is None:
+                    continue
+                message.attach_payload(store_payload(db, data), data)
+            db.commit()
+            migrated += len(rows)
+            last_id = rows[-1].id
+            print(f"[MIGRATION] Deduplicated {migrated} messages (last id {last_id})")
+    finally:
+        db.close()
+    return migrated
+
+
+def clear_prompt_keys() -> int:
+    """Forget the history-cache keys of stored payloads. Keys used to be
+    derived for any assistant message a client saved, so a database from
+    before they were limited to server-generated lessons may serve planted
+    answers; run this before turning HISTORY_CACHE_ENABLED on."""
+    db = SessionLocal()
+    try:
+        cleared = (
+            db.query(MessagePayload)
+            .filter(MessagePayload.prompt_key.isnot(None))
+            .update({MessagePayload.prompt_key: None}, synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+    return cleared
+
+
+def index_messages(batch_size: int = 500) -> int:
+    """Rebuild the full-text index from chat_messages"""
+    init_search(engine)
+    if not search_enabled():
+        print("[MIGRATION] Full-text search is not available on this database")
+        return 0
+    db = SessionLocal()
+    indexed = 0
+    last_id = 0
+    try:
+        if engine.dialect.name == "sqlite":
+            db.execute(text("DELETE FROM chat_messages_fts"))
+        while True:
+            rows = (
+                db.query(ChatMessage, ChatSession.user_id)
+                .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+                .filter(ChatMessage.id > last_id)
+                .order_by(ChatMessage.id.asc())
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            for message, user_id in rows:
+                index_message(db, message.id, user_id, message.content, message.data)
+            db.commit()
+            indexed += len(rows)
+            last_id = rows[-1][0].id
+            print(f"[MIGRATION] Indexed {indexed} messages (last id {last_id})")
+        if engine.dialect.name == "sqlite":
+            db.execute(text("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('optimize')"))
+            db.commit()
+    finally:
+        db.close()
+    return indexed
+
+
+def vacuum():
+    """Reclaim the space freed by a backfill (SQLite only)"""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+    print("[MIGRATION] VACUUM complete")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run database migrations")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    compress = sub.add_parser("compress-messages", help="compress legacy message payloads")
+    compress.add_argument("--batch-size", type=int, default=500)
+    compress.add_argument("--vacuum", action="store_true")
+
+    dedupe = sub.add_parser("dedupe-payloads", help="share identical message payloads across sessions")
+    dedupe.add_argument("--batch-size", type=int, default=500)
+    dedupe.add_argument("--vacuum", action="store_true")
+
+    sub.add_parser("clear-prompt-keys", help="drop history-cache keys set from client-saved messages")
+
+    index = sub.add_parser("index-messages", help="rebuild the full-text search index")
+    index.add_argument("--batch-size", type=int, default=500)
+
+    archive = sub.add_parser("archive-sessions", help="move old sessions to the cold archive")
+    archive.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS)
+    archive.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    archive.add_argument("--vacuum", action="store_true")
+
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+    if args.command == "compress-messages":
+        total = compress_messages(args.batch_size)
+        print(f"[MIGRATION] Done: {total} messages compressed")
+        if args.vacuum:
+            vacuum()
+    elif args.command == "dedupe-payloads":
+        total = dedupe_payloads(args.batch_size)
+        print(f"[MIGRATION] Done: {total} messages moved to shared payloads")
+        if args.vacuum:
+            vacuum()
+    elif args.command == "clear-prompt-keys":
+        total = clear_prompt_keys()
+        print(f"[MIGRATION] Done: {total} history-cache keys cleared")
+    elif args.command == "index-messages":
+        total = index_messages(args.batch_size)
+        print(f"[MIGRATION] Done: {total} messages indexed")
+    elif args.command == "archive-sessions":
+        total = archive_stale_sessions(args.days, args.batch_size)
+        print(f"[MIGRATION] Done: {total} sessions archived")
+        if args.vacuum:
+            vacuum()
+
+
+if __name__ == "__main__":
+    main()
@@ -72,3 +72,59 @@ class ChatSessionResponse(BaseModel):
 class ChatSessionDetail(ChatSessionResponse):
     """Session with all messages included"""
     messages: List[ChatMessageResponse] = []
+
+
+# ── Field regeneration schemas ──────────────────────────
+
+class FieldRegenerateRequest(BaseModel):
+    field: str  # one of the lesson fields, e.g. 'code' or 'problems'
+    message_id: Optional[int] = None  # stored assistant message to update
+    data: Optional[dict] = None  # or the prior response itself
+    prompt: Optional[str] = None  # original question, with data; a stored message uses its own
+    reason: Optional[str] = None  # what was wrong with the field
+
+
+class FieldRegenerateResponse(BaseModel):
+    field: str
+    value: Any
+    data: dict  # prior response with the new field merged in
+    message_id: Optional[int] = None
+
+
+# ── Search schemas ──────────────────────────────────────
+
+class MessageSearchResult(BaseModel):
+    message_id: int
+    session_id: str
+    session_title: Optional[str] = None
+    role: str
+    snippet: str  # HTML-escaped, matches wrapped in <mark>
+    rank: float
+    created_at: datetime
+
+
+# ── Usage schemas ───────────────────────────────────────
+
+class UsageTotals(BaseModel):
+    requests: int = 0
+    cache_hits: int = 0
+    errors: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    thought_tokens: int = 0
+    cached_tokens: int = 0
+    upstream_calls: int = 0
+    retries: int = 0
+    latency_ms: int = 0  # summed over requests
+
+
+class UsageDay(UsageTotals):
+    day: str  # UTC date, YYYY-MM-DD
+    feature: str
+
+
+class UsageResponse(BaseModel):
+    today: UsageTotals
+    tokens_today: int  # prompt + output + thinking, what the quota counts
+    daily_token_quota: Optional[int] = None  # None when unlimited
+    days: List[UsageDay] = []
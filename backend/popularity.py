@@ -0,0 +1,82 @@
+"""Bounded-memory popularity tracking for prompts.
+
+A count-min sketch estimates how often each prompt cache key was requested;
+the POPULARITY_TOP_K keys with the highest estimates are kept with their
+prompt text so the background refresher knows what to regenerate. Counts are
+halved every POPULARITY_DECAY_SECONDS so popularity follows recent traffic.
+Each worker tracks its own traffic.
+"""
+import os
+import threading
+import time
+
+POPULARITY_WIDTH = int(os.getenv("POPULARITY_WIDTH", "4096"))
+POPULARITY_DEPTH = 4
+POPULARITY_TOP_K = int(os.getenv("POPULARITY_TOP_K", "200"))
+POPULARITY_DECAY_SECONDS = float(os.getenv("POPULARITY_DECAY_SECONDS", "3600"))
+
+
+class CountMinSketch:
+    """Approximate counts that never undercount; width and depth bound memory and error"""
+
+    def __init__(self, width: int = POPULARITY_WIDTH, depth: int = POPULARITY_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _cells(self, key: str):
+        # Keys are sha256 hex digests, so disjoint 16-hex-digit slices are
+        # independent hashes already
+        return [int(key[i * 16:(i + 1) * 16], 16) % self.width for i in range(self.depth)]
+
+    def add(self, key: str, amount: int = 1) -> int:
+        estimate = None
+        for row, cell in zip(self.rows, self._cells(key)):
+            row[cell] += amount
+            estimate = row[cell] if estimate is None else min(estimate, row[cell])
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(key)))
+
+    def halve(self):
+        for row in self.rows:
+            for i, value in enumerate(row):
+                row[i] = value >> 1
+
+
+class PopularityTracker:
+    def __init__(self, top_k: int = POPULARITY_TOP_K):
+        self.sketch = CountMinSketch()
+        self.top_k = top_k
+        self._top = {}  # key -> prompt, for the heaviest hitters only
+        self._lock = threading.Lock()
+        self._decayed_at = time.monotonic()
+
+    def record(self, key: str, prompt: str):
+        with self._lock:
+            if time.monotonic() - self._decayed_at > POPULARITY_DECAY_SECONDS:
+                self.sketch.halve()
+                self._decayed_at = time.monotonic()
+            count = self.sketch.add(key)
+            if key in self._top or len(self._top) < self.top_k:
+                self._top[key] = prompt
+                return
+            coldest = min(self._top, key=self.sketch.estimate)
+            if self.sketch.estimate(coldest) < count:
+                del self._top[coldest]
+                self._top[key] = prompt
+
+    def estimate(self, key: str) -> int:
+        with self._lock:
+            return self.sketch.estimate(key)
+
+    def hot(self, min_count: int = 1):
+        """[(key, prompt, estimate)] of the tracked heavy hitters, hottest first"""
+        with self._lock:
+            ranked = [(key, prompt, self.sketch.estimate(key)) for key, prompt in self._top.items()]
+        ranked = [entry for entry in ranked if entry[2] >= min_count]
+        return sorted(ranked, key=lambda entry: entry[2], reverse=True)
+
+
+tracker = PopularityTracker()
@@ -0,0 +1,241 @@
+"""Background generation into the response cache, in a low-priority lane.
+
+Two kinds of jobs share one background thread:
+
+- refresh: stale-while-revalidate. A popular prompt whose cached lesson was
+  made with an older GENERATION_VERSION (or has expired) is regenerated while
+  the stale copy keeps being served. Jobs come from stale cache hits and from
+  a sweep over the heaviest hitters every REFRESH_SWEEP_SECONDS, so after a
+  prompt or model change popular topics are rebuilt before anyone waits on them.
+- prefetch: after /generate answers, the first PREFETCH_TOP_K of the lesson's
+  further_questions are generated speculatively.
+
+Refreshes go first. The lane yields to live traffic: it only starts a job
+while fewer than PREFETCH_MAX_LIVE live generations are running and some API
+key is out of cooldown, and it cancels its own in-flight job as soon as live
+traffic goes over that limit.
+
+A cache hit on a prefetched entry counts once as a prefetch hit; estimated
+output tokens are tracked for everything prefetched and for what was used,
+so the wasted share is 1 - used/spent.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from cache import prompt_cache_key, is_cacheable
+from deadline import Deadline, RequestCancelled
+from metrics import PREFETCHES, PREFETCH_TOKENS, CACHE_REFRESHES
+from popularity import tracker
+from state import get_state
+import usage
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "2"))
+PREFETCH_MAX_QUEUE = int(os.getenv("PREFETCH_MAX_QUEUE", "50"))
+# Background jobs only run while fewer live generations than this are in flight
+PREFETCH_MAX_LIVE = int(os.getenv("PREFETCH_MAX_LIVE", "1"))
+PREFETCH_BUDGET_SECONDS = float(os.getenv("PREFETCH_BUDGET_SECONDS", "120"))
+# How long an unused prefetch still counts as a hit when it's finally served
+PREFETCH_HIT_WINDOW = float(os.getenv("PREFETCH_HIT_WINDOW", "86400"))
+
+REFRESH_ENABLED = os.getenv("REFRESH_ENABLED", "1") == "1"
+# Requests (per worker, decayed) before a prompt is worth refreshing
+REFRESH_MIN_HITS = int(os.getenv("REFRESH_MIN_HITS", "3"))
+REFRESH_SWEEP_SECONDS = float(os.getenv("REFRESH_SWEEP_SECONDS", "60"))
+# A prompt isn't refreshed again, by any worker, within this many seconds
+REFRESH_RETRY_SECONDS = float(os.getenv("REFRESH_RETRY_SECONDS", "300"))
+
+_queue = OrderedDict()  # cache key -> (prompt, age, difficulty_level)
+_refresh_queue = OrderedDict()  # cache key -> prompt
+_cond = threading.Condition()
+_live = 0
+_current = None  # Deadline of the job in progress
+_generate = None
+_is_stale = None
+_worker = None
+
+
+def start(generate, is_stale):
+    """Start the background thread.
+
+    `generate(prompt, key, deadline)` produces a lesson and caches it,
+    returning None if it was left to someone else; `is_stale(key)` tells
+    whether the cached lesson for `key` is missing or out of date.
+    """
+    global _generate, _is_stale, _worker
+    if not (PREFETCH_ENABLED or REFRESH_ENABLED) or _worker is not None:
+        return
+    _generate = generate
+    _is_stale = is_stale
+    _worker = threading.Thread(target=_run, name="prefetch", daemon=True)
+    _worker.start()
+    print(f"[PREFETCH] Background lane started (prefetch={PREFETCH_ENABLED}, refresh={REFRESH_ENABLED}, "
+          f"max {PREFETCH_MAX_LIVE} live)")
+
+
+# ── Live traffic ────────────────────────────────────────
+
+@contextmanager
+def live_request():
+    """Wrap a live generation so background jobs step aside while it runs"""
+    global _live
+    with _cond:
+        _live += 1
+        if _live >= PREFETCH_MAX_LIVE and _current is not None:
+            _current.cancel()
+    try:
+        yield
+    finally:
+        with _cond:
+            _live -= 1
+            _cond.notify_all()
+
+
+def _has_capacity() -> bool:
+    if _live >= PREFETCH_MAX_LIVE:
+        return False
+    from ai import API_KEYS
+    return any(not k["cooling_down"] for k in get_state().key_health(len(API_KEYS)))
+
+
+# ── Scheduling ──────────────────────────────────────────
+
+def schedule(data, age=None, difficulty_level=None):
+    """Queue the top follow-up questions of a lesson that was just served"""
+    if not PREFETCH_ENABLED or _worker is None or not is_cacheable(data):
+        return
+    questions = data.get("further_questions")
+    if not isinstance(questions, list):
+        return
+    with _cond:
+        for question in questions[:PREFETCH_TOP_K]:
+            if not isinstance(question, str) or not question.strip():
+                continue
+            key = prompt_cache_key(question, age, difficulty_level)
+            if key in _queue:
+                continue
+            if len(_queue) >= PREFETCH_MAX_QUEUE:
+                # Oldest first out: the newest lesson's questions are likelier next
+                _queue.popitem(last=False)
+                PREFETCHES.inc(outcome="dropped")
+            _queue[key] = (question, age, difficulty_level)
+            PREFETCHES.inc(outcome="queued")
+        _cond.notify_all()
+
+
+def refresh(key: str, prompt: str):
+    """Queue a regeneration of a stale entry if the prompt is popular enough"""
+    if not REFRESH_ENABLED or _worker is None:
+        return
+    if tracker.estimate(key) < REFRESH_MIN_HITS:
+        return
+    # Claims the refresh across workers and rate-limits retries of failing prompts
+    if not get_state().set_nx(f"refreshing:{key}", b"1", ttl=REFRESH_RETRY_SECONDS):
+        return
+    with _cond:
+        _refresh_queue[key] = prompt
+        CACHE_REFRESHES.inc(outcome="queued")
+        _cond.notify_all()
+
+
+def _sweep():
+    """Queue refreshes for hot prompts whose cached lesson is stale or gone"""
+    for key, prompt, _ in tracker.hot(REFRESH_MIN_HITS):
+        if _is_stale(key):
+            refresh(key, prompt)
+
+
+def _next_job(timeout: float):
+    """("refresh" | "prefetch", key, job) once there's work and capacity,
+    or None after `timeout` seconds"""
+    give_up_at = time.monotonic() + timeout
+    with _cond:
+        while not (_refresh_queue or _queue) or not _has_capacity():
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                return None
+            _cond.wait(timeout=min(remaining, 1.0))
+        if _refresh_queue:
+            key, prompt = _refresh_queue.popitem(last=False)
+            return "refresh", key, (prompt, None, None)
+        key, job = _queue.popitem(last=True)
+        return "prefetch", key, job
+
+
+def _requeue(kind, key, job):
+    with _cond:
+        if kind == "refresh":
+            _refresh_queue.setdefault(key, job[0])
+        else:
+            _queue.setdefault(key, job)
+
+
+def _run():
+    global _current
+    swept_at = time.monotonic()
+    while True:
+        if REFRESH_ENABLED and time.monotonic() - swept_at >= REFRESH_SWEEP_SECONDS:
+            swept_at = time.monotonic()
+            try:
+                _sweep()
+            except Exception as e:
+                print(f"[REFRESH] Sweep failed: {e}")
+        job = _next_job(REFRESH_SWEEP_SECONDS)
+        if job is None:
+            continue
+        kind, key, (prompt, age, difficulty_level) = job
+        counter = PREFETCHES if kind == "prefetch" else CACHE_REFRESHES
+        tag = "[PREFETCH]" if kind == "prefetch" else "[REFRESH]"
+        state = get_state()
+        if kind == "prefetch" and state.cache_get(key) is not None:
+            counter.inc(outcome="cached")
+            continue
+
+        deadline = Deadline(PREFETCH_BUDGET_SECONDS)
+        with _cond:
+            _current = deadline
+        try:
+            with usage.track(kind):
+                result = _generate(prompt, key, deadline)
+        except RequestCancelled:
+            print(f"{tag} Yielded to live traffic: {prompt[:60]}")
+            counter.inc(outcome="preempted")
+            _requeue(kind, key, (prompt, age, difficulty_level))
+            continue
+        except Exception as e:
+            print(f"{tag} Failed for {prompt[:60]}: {e}")
+            counter.inc(outcome="failed")
+            continue
+        finally:
+            with _cond:
+                _current = None
+
+        if result is None:
+            counter.inc(outcome="busy")
+            continue
+        if kind == "refresh":
+            counter.inc(outcome="refreshed")
+            print(f"[REFRESH] Regenerated {prompt[:60]}")
+            continue
+        tokens = len(json.dumps(result, ensure_ascii=False)) // 4
+        state.set(f"prefetch:{key}", str(tokens).encode(), ttl=PREFETCH_HIT_WINDOW)
+        counter.inc(outcome="generated")
+        PREFETCH_TOKENS.inc(tokens, kind="spent")
+        print(f"[PREFETCH] Cached {prompt[:60]} (~{tokens} tokens)")
+
+
+# ── Hits ────────────────────────────────────────────────
+
+def note_hit(key: str):
+    """Call on a response-cache hit; counts the first use of a prefetched entry"""
+    if not PREFETCH_ENABLED:
+        return
+    state = get_state()
+    raw = state.get(f"prefetch:{key}")
+    if raw is not None and state.delete_if(f"prefetch:{key}", raw):
+        PREFETCHES.inc(outcome="hit")
+        PREFETCH_TOKENS.inc(int(raw), kind="used")
@@ -0,0 +1,294 @@
+"""On-demand profiling of single requests.
+
+A request is profiled when it carries `X-Profile: sample|cprofile|1` together
+with `X-Admin-Token: $PROFILE_ADMIN_TOKEN`, or at random with probability
+PROFILE_SAMPLE_RATE when its path starts with one of PROFILE_PATHS. Two modes:
+
+- sample: a background thread snapshots the stacks of the threads working on
+  the request every PROFILE_INTERVAL_MS. The overhead is one stack walk per
+  interval, so this is the one to leave on in production. Results are
+  collapsed stacks ("frame;frame;frame count" lines), the input format of
+  flamegraph.pl, speedscope and inferno.
+- cprofile: deterministic cProfile stats of the request's worker-thread
+  calls, much more expensive; only for requests asked for by header.
+
+"Threads working on the request" are the event loop thread (which also runs
+other requests' coroutines, so those can show up in its samples) and the
+worker threads of every run_in_threadpool call made while handling it. The
+app imports run_in_threadpool from here for that reason. Upstream calls
+appear as time spent waiting in router.race.
+
+The last PROFILE_KEEP profiles are kept in memory per worker and served by
+the admin endpoints; the X-Profile-Id response header names the profile.
+"""
+import contextvars
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from metrics import PROFILES
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_PATHS = tuple(p.strip() for p in os.getenv("PROFILE_PATHS", "/generate,/sessions/").split(",") if p.strip())
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# Distinct stacks kept per profile; the rest are counted under "(truncated)"
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "5000"))
+
+MODES = ("sample", "cprofile")
+
+_active = contextvars.ContextVar("profile", default=None)
+_profiles = OrderedDict()  # id -> Profile, oldest first
+_profiles_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+class Profile:
+    def __init__(self, mode: str, trigger: str, method: str, path: str):
+        self.id = f"{os.getpid()}-{next(_ids)}"
+        self.mode = mode
+        self.trigger = trigger
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.duration_ms = None
+        self.status = None
+        self.threads = {}  # thread id -> label, while working on this request
+        self.stacks = Counter()
+        self.samples = 0
+        self.stats = None  # pstats.Stats for cprofile mode
+        self.lock = threading.Lock()
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "trigger": self.trigger,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "samples": self.samples,
+        }
+
+    def add_stats(self, profiler: cProfile.Profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+
+    def collapsed(self) -> str:
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def pstats_text(self, limit: int = 60) -> str:
+        if self.stats is None:
+            return ""
+        out = io.StringIO()
+        with self.lock:
+            self.stats.stream = out
+            self.stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def pstats_dump(self) -> bytes:
+        """The bytes Stats.dump_stats() would write, for pstats or snakeviz"""
+        with self.lock:
+            return marshal.dumps(self.stats.stats)
+
+
+# ── Sampler ─────────────────────────────────────────────
+
+_sampling = set()  # profiles in sample mode that are still running
+_sampling_lock = threading.Lock()
+_sampling_wake = threading.Event()
+_sampler = None
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> list:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _sample_loop():
+    interval = PROFILE_INTERVAL_MS / 1000.0
+    own = threading.get_ident()
+    while True:
+        with _sampling_lock:
+            profiles = list(_sampling)
+        if not profiles:
+            _sampling_wake.wait(1.0)
+            _sampling_wake.clear()
+            continue
+        frames = sys._current_frames()
+        for profile in profiles:
+            with profile.lock:
+                threads = list(profile.threads.items())
+            for ident, label in threads:
+                frame = frames.get(ident)
+                if frame is None or ident == own:
+                    continue
+                # An idle event loop is waiting in select(); that's not the request's time
+                if label == "event_loop" and frame.f_code.co_filename.endswith("selectors.py"):
+                    continue
+                key = ";".join([label] + _stack(frame))
+                with profile.lock:
+                    if key in profile.stacks or len(profile.stacks) < PROFILE_MAX_STACKS:
+                        profile.stacks[key] += 1
+                    else:
+                        profile.stacks[f"{label};(truncated)"] += 1
+                    profile.samples += 1
+        del frames
+        time.sleep(interval)
+
+
+def _ensure_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = threading.Thread(target=_sample_loop, name="profiler", daemon=True)
+        _sampler.start()
+
+
+# ── Threads ─────────────────────────────────────────────
+
+def _attach(profile: Profile, label: str):
+    with profile.lock:
+        profile.threads[threading.get_ident()] = label
+
+
+def _detach(profile: Profile):
+    with profile.lock:
+        profile.threads.pop(threading.get_ident(), None)
+
+
+def _traced(func):
+    def call(*args, **kwargs):
+        profile = _active.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        if profile.mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                profile.add_stats(profiler)
+        _attach(profile, "worker")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _detach(profile)
+    return call
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """starlette's run_in_threadpool, with the worker thread counted as part
+    of the request when it's being profiled"""
+    if _active.get() is None:
+        return await _run_in_threadpool(func, *args, **kwargs)
+    return await _run_in_threadpool(_traced(func), *args, **kwargs)
+
+
+# ── Triggering ──────────────────────────────────────────
+
+def is_admin(token: str) -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+
+def _requested_mode(headers: Headers, path: str):
+    """(mode, trigger) if this request should be profiled, else None"""
+    asked = headers.get("x-profile")
+    if asked is not None and is_admin(headers.get("x-admin-token", "")):
+        mode = asked.strip().lower()
+        return (mode if mode in MODES else "sample"), "header"
+    if PROFILE_SAMPLE_RATE > 0 and path.startswith(PROFILE_PATHS) and random.random() < PROFILE_SAMPLE_RATE:
+        return "sample", "sampled"
+    return None
+
+
+def _store(profile: Profile):
+    with _profiles_lock:
+        _profiles[profile.id] = profile
+        while len(_profiles) > PROFILE_KEEP:
+            _profiles.popitem(last=False)
+
+
+def list_profiles():
+    """Summaries of the kept profiles, newest first"""
+    with _profiles_lock:
+        profiles = list(_profiles.values())
+    return [p.summary() for p in reversed(profiles)]
+
+
+def get_profile(profile_id: str):
+    with _profiles_lock:
+        return _profiles.get(profile_id)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        requested = _requested_mode(Headers(scope=scope), scope["path"])
+        if requested is None:
+            await self.app(scope, receive, send)
+            return
+
+        mode, trigger = requested
+        profile = Profile(mode, trigger, scope["method"], scope["path"])
+        PROFILES.inc(mode=mode, trigger=trigger)
+        token = _active.set(profile)
+        if mode == "sample":
+            _ensure_sampler()
+            _attach(profile, "event_loop")
+            with _sampling_lock:
+                _sampling.add(profile)
+            _sampling_wake.set()
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                MutableHeaders(scope=message)["X-Profile-Id"] = profile.id
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            profile.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            _active.reset(token)
+            with _sampling_lock:
+                _sampling.discard(profile)
+            _detach(profile)
+            _store(profile)
+            print(f"[PROFILE] {profile.method} {profile.path} took {profile.duration_ms}ms "
+                  f"({profile.mode}, {profile.samples} samples), id {profile.id}")
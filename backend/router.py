@@ -0,0 +1,208 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import wait as wait_futures, FIRST_COMPLETED
+
+from metrics import HEDGES, DUPLICATE_TOKENS, ROUTED
+from deadline import RequestCancelled, DeadlineExceeded
+
+# ── Model tiers ─────────────────────────────────────────
+# Each tier maps to one Gemini model. "standard" is what ai() always used;
+# "fast" serves simple prompts when ROUTE_BY_COMPLEXITY is on.
+
+MODEL_TIERS = {
+    "fast": os.getenv("MODEL_FAST", "gemini-2.5-flash-lite"),
+    "standard": os.getenv("MODEL_STANDARD", "gemini-2.5-flash"),
+    "diagram": os.getenv("MODEL_DIAGRAM", "gemini-2.0-flash-exp"),
+}
+
+ROUTE_BY_COMPLEXITY = os.getenv("ROUTE_BY_COMPLEXITY", "0") == "1"
+COMPLEXITY_THRESHOLD = float(os.getenv("COMPLEXITY_THRESHOLD", "3"))
+
+# ── Hedging ─────────────────────────────────────────────
+# A hedge is a second attempt fired once the primary has been running longer
+# than the model's recent p95. HEDGE_MAX_RATIO caps hedges as a fraction of all
+# upstream calls, which bounds the duplicate spend.
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "2"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "15"))
+HEDGE_MIN_SAMPLES = 20
+
+_HARD_WORDS = re.compile(
+    r"\b(prove|proof|derive|derivation|compare|contrast|advanced|research|rigorous|"
+    r"theorem|optimi[sz]e|implement|analy[sz]e|graduate|phd)\b",
+    re.IGNORECASE,
+)
+_HARD_LEVELS = ("advanced", "expert", "hard", "graduate", "university")
+
+
+def complexity_score(prompt: str, difficulty_level=None) -> float:
+    """Rough difficulty estimate: long prompts, proof/derivation verbs and high
+    difficulty levels push a prompt towards the standard tier"""
+    score = len(prompt) / 200.0
+    score += 2 * len(_HARD_WORDS.findall(prompt))
+    score += prompt.count("?") * 0.5
+    if difficulty_level is not None:
+        level = str(difficulty_level).lower()
+        if any(h in level for h in _HARD_LEVELS):
+            score += 3
+        elif level.isdigit():
+            score += int(level) / 2
+    return score
+
+
+def choose_model(prompt: str, difficulty_level=None) -> str:
+    """Pick the model for a full lesson generation"""
+    tier = "standard"
+    if ROUTE_BY_COMPLEXITY and complexity_score(prompt, difficulty_level) < COMPLEXITY_THRESHOLD:
+        tier = "fast"
+    model = MODEL_TIERS[tier]
+    ROUTED.inc(tier=tier, model=model)
+    return model
+
+
+def model_for(tier: str) -> str:
+    model = MODEL_TIERS[tier]
+    ROUTED.inc(tier=tier, model=model)
+    return model
+
+
+def hedge_model(model: str) -> str:
+    """Alternate model for a hedge when there's no second API key to spread over"""
+    if model == MODEL_TIERS["standard"]:
+        return MODEL_TIERS["fast"]
+    return MODEL_TIERS["standard"]
+
+
+# ── Latency tracking ────────────────────────────────────
+
+_latencies = {}
+_latency_lock = threading.Lock()
+
+
+def record_latency(model: str, seconds: float):
+    with _latency_lock:
+        window = _latencies.get(model)
+        if window is None:
+            window = _latencies[model] = deque(maxlen=200)
+        window.append(seconds)
+
+
+def p95(model: str):
+    with _latency_lock:
+        window = sorted(_latencies.get(model, ()))
+    if len(window) < HEDGE_MIN_SAMPLES:
+        return None
+    return window[int(len(window) * 0.95) - 1]
+
+
+def hedge_delay(model: str) -> float:
+    observed = p95(model)
+    if observed is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(observed, HEDGE_MIN_DELAY)
+
+
+# ── Hedge budget ────────────────────────────────────────
+
+_budget_lock = threading.Lock()
+_calls = 0
+_hedges = 0
+
+
+def _note_call():
+    global _calls
+    with _budget_lock:
+        _calls += 1
+
+
+def _take_hedge_slot() -> bool:
+    global _hedges
+    with _budget_lock:
+        if _hedges + 1 > HEDGE_MAX_RATIO * _calls:
+            return False
+        _hedges += 1
+        return True
+
+
+def hedge_stats():
+    with _budget_lock:
+        return {"calls": _calls, "hedges": _hedges, "ratio": _hedges / _calls if _calls else 0.0}
+
+
+# ── Racing attempts ─────────────────────────────────────
+
+def race(pool, primary, hedge=None, delay=None, is_valid=None, deadline=None, hedge_cost=0):
+    """Run `primary` and, if it's still running after `delay` seconds, `hedge`.
+
+    `primary` and `hedge` are (call, abort) pairs: `call()` performs one upstream
+    request and `abort()` tears down its HTTP client. The first response that
+    passes `is_valid` wins and the other leg is aborted. If no response is valid,
+    the first one that completed is returned so the caller's repair path still
+    gets a chance; if every leg failed, the last error is raised.
+    `hedge_cost` is the estimated token cost of one extra attempt, recorded
+    as duplicate spend whenever a hedge fires.
+    """
+    _note_call()
+    legs = {pool.submit(primary[0]): ("primary", primary[1])}
+    start = time.monotonic()
+    hedge_fired = False
+    hedge_considered = False
+    fallback = None
+    last_error = None
+
+    def abort_all():
+        for future, (_, abort) in legs.items():
+            future.cancel()
+            try:
+                abort()
+            except Exception:
+                pass
+
+    while legs:
+        done, _ = wait_futures(list(legs), timeout=0.25, return_when=FIRST_COMPLETED)
+        for future in done:
+            label, _ = legs.pop(future)
+            try:
+                response = future.result()
+            except Exception as e:
+                last_error = e
+                continue
+            if is_valid is None or is_valid(response):
+                if hedge_fired:
+                    HEDGES.inc(outcome=f"{label}_won")
+                    abort_all()
+                return response
+            if fallback is None:
+                fallback = response
+
+        if deadline is not None and (deadline.cancelled or deadline.remaining() <= 0):
+            abort_all()
+            if deadline.cancelled:
+                raise RequestCancelled("Client disconnected during upstream call")
+            raise DeadlineExceeded("Request budget exhausted during upstream call")
+
+        if (
+            hedge is not None
+            and not hedge_considered
+            and legs
+            and fallback is None
+            and time.monotonic() - start >= delay
+        ):
+            hedge_considered = True
+            if _take_hedge_slot():
+                hedge_fired = True
+                print(f"[HEDGE] Primary still running after {delay:.1f}s, firing hedge")
+                HEDGES.inc(outcome="fired")
+                DUPLICATE_TOKENS.inc(hedge_cost)
+                legs[pool.submit(hedge[0])] = ("hedge", hedge[1])
+            else:
+                HEDGES.inc(outcome="skipped_cap")
+
+    if fallback is not None:
+        return fallback
+    raise last_error
@@ -0,0 +1,194 @@
+"""Full-text search over chat history.
+
+SQLite uses an FTS5 table keyed by message id; Postgres uses a generated
+tsvector column with a GIN index. Both are kept in sync from add_message and
+delete_chat_session, so nothing here runs a rebuild on the request path.
+
+Snippets come back HTML-escaped with matches wrapped in <mark>: the database
+highlights with control-character sentinels (stripped from indexed text), and
+only the escaped result has them turned into tags, so stored markup can't
+reach a client that renders snippets as HTML.
+"""
+import html
+import re
+
+from sqlalchemy import text
+
+# Assistant payload fields worth searching; diagrams and code are mostly noise
+SEARCH_FIELDS = [
+    "foundations",
+    "concepts",
+    "formulas",
+    "keyconcepts",
+    "problems",
+    "study_plan",
+    "further_questions",
+]
+
+SNIPPET_TOKENS = 16
+
+# Highlight markers the database puts around matches; never in indexed text
+_MARK_START, _MARK_END = "\x02", "\x03"
+
+_enabled = None
+
+
+def _dialect(db_or_engine):
+    bind = db_or_engine.get_bind() if hasattr(db_or_engine, "get_bind") else db_or_engine
+    return bind.dialect.name
+
+
+def init_search(engine):
+    """Create the search index structures if they don't exist yet"""
+    global _enabled
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == "sqlite":
+            try:
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts "
+                    "USING fts5(owner, body, tokenize='porter unicode61')"
+                ))
+                _enabled = True
+            except Exception as e:
+                print(f"[SEARCH] FTS5 unavailable, search disabled: {e}")
+                _enabled = False
+        elif dialect == "postgresql":
+            conn.execute(text("ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS search_text TEXT"))
+            conn.execute(text(
+                "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                "GENERATED ALWAYS AS (to_tsvector('english', coalesce(search_text, ''))) STORED"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_chat_messages_search_vector "
+                "ON chat_messages USING GIN (search_vector)"
+            ))
+            _enabled = True
+        else:
+            print(f"[SEARCH] No full-text search support for {dialect}")
+            _enabled = False
+
+
+def search_enabled() -> bool:
+    return bool(_enabled)
+
+
+def message_text(content, data) -> str:
+    """Searchable text for a message: its content plus the text fields of its payload"""
+    parts = [content] if content else []
+    if isinstance(data, dict):
+        for field in SEARCH_FIELDS:
+            value = data.get(field)
+            if isinstance(value, list):
+                parts.extend(str(v) for v in value)
+            elif value:
+                parts.append(str(value))
+    return "\n".join(parts).replace(_MARK_START, "").replace(_MARK_END, "")
+
+
+def _highlight(snippet):
+    """Escape a database snippet, then turn its sentinels into <mark> tags"""
+    if snippet is None:
+        return None
+    return html.escape(snippet).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+
+
+def index_message(db, message_id: int, user_id: int, content, data):
+    """Add one message to the index, inside the caller's transaction"""
+    if not _enabled:
+        return
+    body = message_text(content, data)
+    if not body:
+        return
+    if _dialect(db) == "sqlite":
+        db.execute(
+            text("INSERT INTO chat_messages_fts(rowid, owner, body) VALUES (:id, :owner, :body)"),
+            {"id": message_id, "owner": f"u{user_id}", "body": body},
+        )
+    else:
+        db.execute(
+            text("UPDATE chat_messages SET search_text = :body WHERE id = :id"),
+            {"id": message_id, "body": body},
+        )
+
+
+def unindex_message(db, message_id: int):
+    """Remove one message from the index before re-indexing it (SQLite only;
+    on Postgres index_message overwrites the row's text)"""
+    if not _enabled or _dialect(db) != "sqlite":
+        return
+    db.execute(text("DELETE FROM chat_messages_fts WHERE rowid = :id"), {"id": message_id})
+
+
+def unindex_session(db, session_id: str):
+    """Remove a session's messages from the index (Postgres drops them with the rows)"""
+    if not _enabled or _dialect(db) != "sqlite":
+        return
+    db.execute(
+        text(
+            "DELETE FROM chat_messages_fts WHERE rowid IN "
+            "(SELECT id FROM chat_messages WHERE session_id = :session_id)"
+        ),
+        {"session_id": session_id},
+    )
+
+
+def _fts5_query(query: str):
+    """Turn free text into a safe FTS5 expression: every word must match, the
+    last one as a prefix so results show up while the user is still typing"""
+    terms = re.findall(r"\w+", query, re.UNICODE)
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search_messages(db, user_id: int, query: str, limit: int = 20, offset: int = 0):
+    """Ranked matches in a user's history as dicts with a highlighted snippet"""
+    if not _enabled:
+        return []
+
+    if _dialect(db) == "sqlite":
+        terms = _fts5_query(query)
+        if terms is None:
+            return []
+        # Scoping on the indexed owner column keeps the match set per-user
+        # instead of filtering every user's hits after the fact.
+        rows = db.execute(
+            text(
+                "SELECT m.id, m.session_id, m.role, m.created_at, s.title, "
+                f"snippet(chat_messages_fts, 1, :mark_start, :mark_end, '…', {SNIPPET_TOKENS}) AS snippet, "
+                "bm25(chat_messages_fts, 0.0, 1.0) AS rank "
+                "FROM chat_messages_fts "
+                "JOIN chat_messages m ON m.id = chat_messages_fts.rowid "
+                "JOIN chat_sessions s ON s.id = m.session_id "
+                "WHERE chat_messages_fts MATCH :match "
+                "ORDER BY rank LIMIT :limit OFFSET :offset"
+            ),
+            {"match": f'owner:"u{user_id}" AND ({terms})', "limit": limit, "offset": offset,
+             "mark_start": _MARK_START, "mark_end": _MARK_END},
+        ).mappings().all()
+        # bm25 is lower-is-better; flip it so callers can treat rank as a score
+        return [dict(r, rank=-r["rank"], snippet=_highlight(r["snippet"])) for r in rows]
+
+    rows = db.execute(
+        text(
+            "WITH hits AS ("
+            "  SELECT m.id, m.session_id, m.role, m.created_at, s.title, m.search_text, "
+            "         ts_rank(m.search_vector, q) AS rank "
+            "  FROM chat_messages m "
+            "  JOIN chat_sessions s ON s.id = m.session_id, "
+            "       websearch_to_tsquery('english', :query) q "
+            "  WHERE m.search_vector @@ q AND s.user_id = :user_id "
+            "  ORDER BY rank DESC LIMIT :limit OFFSET :offset"
+            ") "
+            "SELECT id, session_id, role, created_at, title, rank, "
+            "       ts_headline('english', search_text, websearch_to_tsquery('english', :query), "
+            "                   :options) AS snippet "
+            "FROM hits ORDER BY rank DESC"
+        ),
+        {"query": query, "user_id": user_id, "limit": limit, "offset": offset,
+         "options": f"StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords={SNIPPET_TOKENS}"},
+    ).mappings().all()
+    return [dict(r, snippet=_highlight(r["snippet"])) for r in rows]
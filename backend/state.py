@@ -0,0 +1,423 @@
+"""Runtime state shared between workers: API key health, the response cache,
+single-flight locks and rate-limit counters.
+
+STATE_BACKEND picks the implementation:
+    memory  per-process dicts (default; fine for a single uvicorn worker)
+    sqlite  a WAL-mode SQLite file, for several workers on one host
+    redis   any Redis-protocol server, for several hosts (STATE_REDIS_URL)
+
+Every backend implements the same five primitives (get, set, set_nx, incr,
+delete_if); the higher-level operations are built on those in StateBackend.
+
+Expired entries are dropped every STATE_SWEEP_EVERY writes (Redis expires
+keys itself), and the memory backend evicts its least recently used keys
+past STATE_MEMORY_MAX_KEYS, so per-IP rate-limit buckets and cached bodies
+don't pile up between reads.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "./lyrnios_state.db")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://127.0.0.1:6379/0")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "lyrnios:")
+STATE_SWEEP_EVERY = int(os.getenv("STATE_SWEEP_EVERY", "1000"))
+STATE_MEMORY_MAX_KEYS = int(os.getenv("STATE_MEMORY_MAX_KEYS", "100000"))
+
+
+class StateBackend:
+    """Shared-state operations on top of backend-specific primitives"""
+
+    # ── Primitives (implemented by subclasses) ──────────
+
+    def get(self, key: str):
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: float = None):
+        raise NotImplementedError
+
+    def set_nx(self, key: str, value: bytes, ttl: float = None) -> bool:
+        """Set only if absent (or expired); True if this call set it"""
+        raise NotImplementedError
+
+    def incr(self, key: str, ttl: float = None) -> int:
+        """Increment a counter; `ttl` applies when the counter is created"""
+        raise NotImplementedError
+
+    def delete_if(self, key: str, value: bytes) -> bool:
+        """Delete only if the current value matches"""
+        raise NotImplementedError
+
+    # ── API key health ──────────────────────────────────
+
+    def current_key(self, n: int) -> int:
+        raw = self.get("keys:index")
+        return int(raw) % n if raw is not None else 0
+
+    def advance_key(self, from_index: int, n: int) -> int:
+        """Move the shared key index past `from_index`, skipping keys in cooldown.
+
+        When several workers hit the same failing key at once, only the first
+        one rotates; the others pick up the index it chose.
+        """
+        if n > 1 and self.set_nx(f"keys:rotating:{from_index}", b"1", ttl=1.0):
+            candidate = (from_index + 1) % n
+            for step in range(1, n + 1):
+                candidate = (from_index + step) % n
+                if not self.key_in_cooldown(candidate):
+                    break
+            self.set("keys:index", str(candidate).encode())
+        return self.current_key(n)
+
+    def mark_key_cooldown(self, index: int, seconds: float):
+        self.set(f"keys:cooldown:{index}", b"1", ttl=seconds)
+
+    def key_in_cooldown(self, index: int) -> bool:
+        return self.get(f"keys:cooldown:{index}") is not None
+
+    def key_health(self, n: int):
+        return [{"index": i, "cooling_down": self.key_in_cooldown(i)} for i in range(n)]
+
+    # ── Response cache ──────────────────────────────────
+
+    def cache_get(self, key: str):
+        return self.get(f"cache:{key}")
+
+    def cache_set(self, key: str, value: bytes, ttl: float = None):
+        self.set(f"cache:{key}", value, ttl=ttl)
+
+    # ── Single-flight locks ─────────────────────────────
+
+    def acquire_lock(self, name: str, ttl: float):
+        """Returns a token if acquired, None if someone else holds the lock"""
+        token = uuid.uuid4().hex.encode()
+        if self.set_nx(f"lock:{name}", token, ttl=ttl):
+            return token
+        return None
+
+    def lock_held(self, name: str) -> bool:
+        return self.get(f"lock:{name}") is not None
+
+    def release_lock(self, name: str, token: bytes):
+        self.delete_if(f"lock:{name}", token)
+
+    # ── Rate limits ─────────────────────────────────────
+
+    def hit_rate_limit(self, name: str, limit: int, window: float) -> bool:
+        """Count one hit in the current fixed window; True if over `limit`"""
+        bucket = int(time.time() // window)
+        return self.incr(f"rl:{name}:{bucket}", ttl=window) > limit
+
+
+# ── In-process ──────────────────────────────────────────
+
+class InProcessState(StateBackend):
+    def __init__(self, max_keys: int = STATE_MEMORY_MAX_KEYS):
+        self._data = OrderedDict()  # key -> (value, expires_at), least recently used first
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+        self._writes = 0
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry):
+        """Write under the lock, sweeping expired keys every STATE_SWEEP_EVERY
+        writes and evicting the least recently used past the size bound"""
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        self._writes += 1
+        if self._writes >= STATE_SWEEP_EVERY:
+            self._writes = 0
+            self._sweep()
+        while len(self._data) > self._max_keys:
+            self._data.popitem(last=False)
+
+    def _sweep(self):
+        now = time.monotonic()
+        expired = [k for k, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    def purge_expired(self):
+        with self._lock:
+            return self._sweep()
+
+    @staticmethod
+    def _expiry(ttl):
+        return time.monotonic() + ttl if ttl else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, (value, self._expiry(ttl)))
+
+    def set_nx(self, key, value, ttl=None):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, (value, self._expiry(ttl)))
+            return True
+
+    def incr(self, key, ttl=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                self._store(key, (b"1", self._expiry(ttl)))
+                return 1
+            value = int(entry[0]) + 1
+            self._data[key] = (str(value).encode(), entry[1])
+            return value
+
+    def delete_if(self, key, value):
+        with self._lock:
+            entry = self._live(key)
+            if entry is not None and entry[0] == value:
+                del self._data[key]
+                return True
+            return False
+
+
+# ── SQLite (single host, many workers) ──────────────────
+
+class SQLiteState(StateBackend):
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS state_kv ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS state_kv_expires_at ON state_kv (expires_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _expiry(ttl):
+        # Wall clock, since the expiry is shared across processes
+        return time.time() + ttl if ttl else None
+
+    def _wrote(self):
+        """Count a write; every STATE_SWEEP_EVERY of them (per process) purge expired rows"""
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes >= STATE_SWEEP_EVERY
+            if due:
+                self._writes = 0
+        if due:
+            self.purge_expired()
+
+    def _read(self, conn, key):
+        row = conn.execute(
+            "SELECT value FROM state_kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get(self, key):
+        return self._read(self._conn(), key)
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO state_kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, self._expiry(ttl)),
+        )
+        self._wrote()
+
+    def set_nx(self, key, value, ttl=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._read(conn, key) is not None:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO state_kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, self._expiry(ttl)),
+            )
+        finally:
+            conn.execute("COMMIT")
+        self._wrote()
+        return True
+
+    def incr(self, key, ttl=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value, expires_at FROM state_kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+            if row is None:
+                value, expires_at = 1, self._expiry(ttl)
+            else:
+                value, expires_at = int(row[0]) + 1, row[1]
+            conn.execute(
+                "INSERT OR REPLACE INTO state_kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, str(value).encode(), expires_at),
+            )
+        finally:
+            conn.execute("COMMIT")
+        if row is None:
+            self._wrote()
+        return value
+
+    def delete_if(self, key, value):
+        cursor = self._conn().execute("DELETE FROM state_kv WHERE key = ? AND value = ?", (key, value))
+        return cursor.rowcount > 0
+
+    def purge_expired(self):
+        cursor = self._conn().execute(
+            "DELETE FROM state_kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+
+# ── Redis protocol (many hosts) ─────────────────────────
+
+class RedisError(Exception):
+    pass
+
+
+class RedisState(StateBackend):
+    """Speaks RESP2 directly so no client library is needed. Only GET, SET
+    (NX/PX), INCR, PEXPIRE and DEL are used, so any Redis-compatible server
+    works, including bench/fake_redis.py"""
+
+    def __init__(self, url: str, prefix: str = STATE_PREFIX):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.password = parsed.password
+        self.prefix = prefix
+        self._local = threading.local()
+
+    # Connection handling: one socket per thread, reopened after any error
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=2.0)
+        self._local.sock = sock
+        self._local.reader = sock.makefile("rb")
+        if self.password:
+            self._call_raw("AUTH", self.password)
+        if self.db:
+            self._call_raw("SELECT", str(self.db))
+
+    def _call_raw(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._local.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._local.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(rest)
+            return None if count < 0 else [self._read_reply() for _ in range(count)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    def _call(self, *args):
+        for attempt in range(2):
+            try:
+                if getattr(self._local, "sock", None) is None:
+                    self._connect()
+                return self._call_raw(*args)
+            except (OSError, ConnectionError):
+                self._local.sock = None
+                if attempt:
+                    raise
+
+    def _k(self, key):
+        return self.prefix + key
+
+    def get(self, key):
+        return self._call("GET", self._k(key))
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self._call("SET", self._k(key), value, "PX", int(ttl * 1000))
+        else:
+            self._call("SET", self._k(key), value)
+
+    def set_nx(self, key, value, ttl=None):
+        args = ["SET", self._k(key), value, "NX"]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        return self._call(*args) is not None
+
+    def incr(self, key, ttl=None):
+        value = self._call("INCR", self._k(key))
+        if value == 1 and ttl:
+            self._call("PEXPIRE", self._k(key), int(ttl * 1000))
+        return value
+
+    def delete_if(self, key, value):
+        # GET + DEL is not atomic; a lock that expired in between could be
+        # released early, which only costs a duplicate generation.
+        if self._call("GET", self._k(key)) == value:
+            return bool(self._call("DEL", self._k(key)))
+        return False
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state() -> StateBackend:
+    """Process-wide backend chosen by STATE_BACKEND"""
+    global _state
+    if _state is None:
+        with _state_lock:
+            if _state is None:
+                if STATE_BACKEND == "sqlite":
+                    _state = SQLiteState(STATE_SQLITE_PATH)
+                elif STATE_BACKEND == "redis":
+                    _state = RedisState(STATE_REDIS_URL)
+                else:
+                    _state = InProcessState()
+                print(f"[STATE] Using {type(_state).__name__}")
+    return _state
@@ -0,0 +1,137 @@
+import pytest
+
+from validation import (
+    _coerce, find_issues, fix_latex_escapes, latex_issues, repair_locally, validate_mermaid,
+)
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "foundations": {"type": "string"},
+        "formulas": {"type": "string"},
+        "further_questions": {"type": "array", "items": {"type": "string"}},
+        "mermaid_diagram": {"type": "string"},
+    },
+    "required": ["foundations", "formulas", "further_questions", "mermaid_diagram"],
+}
+
+
+# ── Mermaid ─────────────────────────────────────────────
+
+@pytest.mark.parametrize("diagram", [
+    "graph TD\n    A[Start] --> B{Decide}\n    B -->|yes| C((Done))\n    B -- no --> A",
+    'graph LR\n    A["Label [with] brackets"] --> B(Round)',
+    "graph TD; A-->B; B-->C",
+    "flowchart LR\n    subgraph one\n    a1 --> a2\n    end\n    a2 -.-> b & c",
+    "graph TD\n    %% a comment\n    my-node --> other_node\n    classDef hot fill:#f00\n    class my-node hot",
+    "sequenceDiagram\n    participant A\n    A->>B: hello\n    loop every minute\n    B-->>A: hi\n    end\n    Note over A,B: done",
+    'pie\n    title Pets\n    "Dogs" : 386\n    "Cats" : 85.5',
+    "mindmap\n  root((math))",
+])
+def test_valid_mermaid(diagram):
+    assert validate_mermaid(diagram) == []
+
+
+@pytest.mark.parametrize("diagram, error", [
+    ("", "diagram is empty"),
+    ("graph TD", "diagram has no content"),
+    ("graph XY\n    A --> B", "expected 'graph <direction>'"),
+    ("chart TD\n    A --> B", "unknown diagram type"),
+    ("graph TD\n    A[Start --> B", "unclosed '['"),
+    ("graph TD\n    A[Label [nested]] --> B", "brackets inside the label"),
+    ("graph TD\n    A -->", "link has no target node"),
+    ("graph TD\n    end --> B", "'end' cannot be used as a node id"),
+    ("graph TD\n    subgraph one\n    A --> B", "subgraph is never closed"),
+    ("sequenceDiagram\n    A to B", "expected 'A->>B: message'"),
+    ("sequenceDiagram\n    loop forever\n    A->>B: hi", "block is never closed"),
+    ('pie\n    "Dogs" 386', "expected '\"label\" : value'"),
+    ("graph TD\n    A[Diagram Not Available]", "diagram is a placeholder"),
+])
+def test_invalid_mermaid(diagram, error):
+    errors = validate_mermaid(diagram)
+    assert any(error in e for e in errors), errors
+
+
+# ── LaTeX ───────────────────────────────────────────────
+
+def test_backspace_and_form_feed_are_restored_everywhere():
+    text, fixes = fix_latex_escapes("\x08eta and \x0crac{1}{2}")
+    assert text == "\\beta and \\frac{1}{2}"
+    assert fixes == 2
+
+
+def test_tab_cr_lf_are_restored_only_inside_math():
+    text, fixes = fix_latex_escapes("col\ttheta $\theta \times \rho + \nabla$")
+    assert text == "col\ttheta $\\theta \\times \\rho + \\nabla$"
+    assert fixes == 4
+
+
+def test_real_newlines_in_math_are_kept():
+    text, fixes = fix_latex_escapes("$$a +\nb$$")
+    assert text == "$$a +\nb$$"
+    assert fixes == 0
+
+
+@pytest.mark.parametrize("text", [
+    "The area is $\\pi r^2$ and $$E = mc^2$$.",
+    "It costs $5, or $10 with shipping.",
+    "In bash, echo $HOME prints your home dir.",
+    "Set $x$ to $PATH and run it.",
+    "A literal \\$ sign and \\(x\\) and \\[y\\].",
+    "\\begin{align} a &= b \\end{align}",
+])
+def test_balanced_latex(text):
+    assert latex_issues(text) == []
+
+
+@pytest.mark.parametrize("text, issue", [
+    ("$\\frac{a}{b} is never closed", "unclosed $ inline math"),
+    ("so $x^2 grows", "unclosed $ inline math"),
+    ("$$E = mc^2", "unclosed $$ display math"),
+    ("\\(x", "unbalanced \\( \\)"),
+    ("\\begin{align} a \\end{matrix}", "\\end{matrix} without matching \\begin"),
+    ("\\begin{cases} a", "\\begin{cases} is never closed"),
+    ("$\\frac{a}{b$", "unbalanced braces"),
+])
+def test_latex_issues(text, issue):
+    assert any(issue in i for i in latex_issues(text))
+
+
+# ── Schema types ────────────────────────────────────────
+
+def test_coerce_string_to_question_list():
+    spec = SCHEMA["properties"]["further_questions"]
+    assert _coerce("1. Why?\n- How?\n\n* What?", spec) == ["Why?", "How?", "What?"]
+    assert _coerce(["a", None, {"q": 1}], spec) == ["a", '{"q": 1}']
+    assert _coerce(None, spec) == []
+
+
+def test_coerce_to_string():
+    spec = {"type": "string"}
+    assert _coerce(None, spec) == ""
+    assert _coerce(["a", "b"], spec) == "a\nb"
+    assert _coerce({"k": "v"}, spec) == '{"k": "v"}'
+    assert _coerce(3, spec) == "3"
+
+
+def test_repair_locally_then_find_issues():
+    data = {
+        "foundations": "Start with $\x08eta$.",
+        "formulas": ["$a$", "$b$"],
+        "further_questions": "Why?\nHow?",
+    }
+    fixes = repair_locally(data, SCHEMA)
+    assert fixes == 4  # formulas, further_questions, mermaid_diagram, \beta
+    assert data["foundations"] == "Start with $\\beta$."
+    assert data["formulas"] == "$a$\n$b$"
+    assert data["further_questions"] == ["Why?", "How?"]
+    assert find_issues(data, SCHEMA) == [("mermaid_diagram", "mermaid", "diagram is empty")]
+
+
+def test_find_issues_reports_types_and_empty_fields():
+    data = {"foundations": " ", "formulas": 3, "further_questions": [], "mermaid_diagram": "graph TD\n A-->B"}
+    assert find_issues(data, SCHEMA) == [
+        ("foundations", "empty", "field is empty"),
+        ("formulas", "type", "expected string, got int"),
+        ("further_questions", "empty", "no questions"),
+    ]
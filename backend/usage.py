@@ -0,0 +1,247 @@
+"""Per-request usage ledger: upstream tokens, model, key, latency, retries and
+cache status of every generation, attributed to a user and a feature.
+
+A request opens a record with `track(feature, user_id)`; ai.py adds every
+upstream call's usage_metadata to the current record through a ContextVar,
+so nothing has to be threaded through the generation code. Finished records
+go into an in-memory buffer that a background thread writes every
+USAGE_FLUSH_SECONDS in one batch, updating the hourly usage_rollups table in
+the same transaction, so the request path never waits on the database. If the
+database falls behind, the buffer drops its oldest records past
+USAGE_BUFFER_MAX rather than grow without bound.
+
+Records still in the buffer count towards quotas, so a user can't get past
+USAGE_DAILY_TOKEN_QUOTA by sending requests faster than the flush interval.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal, UsageEvent, UsageRollup, USAGE_TOTAL_COLUMNS, get_usage_totals
+from deadline import RequestCancelled, DeadlineExceeded
+from metrics import USAGE_RECORDS
+
+USAGE_LEDGER_ENABLED = os.getenv("USAGE_LEDGER_ENABLED", "1") == "1"
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "2"))
+USAGE_BUFFER_MAX = int(os.getenv("USAGE_BUFFER_MAX", "10000"))
+# Prompt + output + thinking tokens a signed-in user may spend per UTC day (0 = unlimited)
+USAGE_DAILY_TOKEN_QUOTA = int(os.getenv("USAGE_DAILY_TOKEN_QUOTA", "0"))
+
+_current = contextvars.ContextVar("usage_record", default=None)
+_buffer = deque()
+_buffer_lock = threading.Lock()
+_worker = None
+
+
+# ── Recording ───────────────────────────────────────────
+
+def _new_record(feature: str, user_id):
+    return {
+        "created_at": datetime.utcnow(),
+        "user_id": user_id,
+        "feature": feature,
+        "model": None,
+        "key_index": None,
+        "prompt_tokens": 0,
+        "output_tokens": 0,
+        "thought_tokens": 0,
+        "cached_tokens": 0,
+        "upstream_calls": 0,
+        "retries": 0,
+        "latency_ms": 0,
+        "cache_hit": False,
+        "cache": None,
+        "status": "ok",
+    }
+
+
+@contextmanager
+def track(feature: str, user_id: int = None):
+    """Collect the usage of everything run inside the block into one ledger
+    record. Nested calls join the outer record."""
+    if not USAGE_LEDGER_ENABLED or _current.get() is not None:
+        yield
+        return
+    record = _new_record(feature, user_id)
+    reset = _current.set(record)
+    started = time.perf_counter()
+    try:
+        yield
+    except RequestCancelled:
+        record["status"] = "cancelled"
+        raise
+    except DeadlineExceeded:
+        record["status"] = "timeout"
+        raise
+    except BaseException:
+        record["status"] = "error"
+        raise
+    finally:
+        _current.reset(reset)
+        record["latency_ms"] = int((time.perf_counter() - started) * 1000)
+        _enqueue(record)
+
+
+def note_call(model: str, key_index, prompt_tokens=0, output_tokens=0, thought_tokens=0, cached_tokens=0):
+    """Add one upstream call's usage to the current record"""
+    record = _current.get()
+    if record is None:
+        return
+    if record["model"] is None:
+        record["model"] = model
+        record["key_index"] = key_index
+    record["upstream_calls"] += 1
+    record["prompt_tokens"] += prompt_tokens
+    record["output_tokens"] += output_tokens
+    record["thought_tokens"] += thought_tokens
+    record["cached_tokens"] += cached_tokens
+
+
+def note_retry():
+    record = _current.get()
+    if record is not None:
+        record["retries"] += 1
+
+
+def note_cache_hit(cache: str):
+    record = _current.get()
+    if record is not None and not record["cache_hit"]:
+        record["cache_hit"] = True
+        record["cache"] = cache
+
+
+def note_status(status: str):
+    """For outcomes that are answered rather than raised (e.g. a 499)"""
+    record = _current.get()
+    if record is not None:
+        record["status"] = status
+
+
+def _enqueue(record):
+    with _buffer_lock:
+        _buffer.append(record)
+        overflow = len(_buffer) - USAGE_BUFFER_MAX
+        for _ in range(max(overflow, 0)):
+            _buffer.popleft()
+    if overflow > 0:
+        USAGE_RECORDS.inc(overflow, outcome="dropped")
+    USAGE_RECORDS.inc(outcome="buffered")
+
+
+# ── Flushing ────────────────────────────────────────────
+
+def start():
+    global _worker
+    if not USAGE_LEDGER_ENABLED or _worker is not None:
+        return
+    _worker = threading.Thread(target=_run, name="usage-ledger", daemon=True)
+    _worker.start()
+
+
+def stop():
+    """Write whatever is still buffered; call on shutdown"""
+    if USAGE_LEDGER_ENABLED:
+        flush()
+
+
+def _run():
+    while True:
+        time.sleep(USAGE_FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception as e:
+            print(f"[USAGE] Flush failed, will retry: {e}")
+
+
+def _rollup_key(record):
+    hour = record["created_at"].replace(minute=0, second=0, microsecond=0)
+    return hour, record["user_id"] or 0, record["feature"], record["model"] or ""
+
+
+def _rollup(records):
+    totals = defaultdict(lambda: dict.fromkeys(USAGE_TOTAL_COLUMNS, 0))
+    for record in records:
+        row = totals[_rollup_key(record)]
+        row["requests"] += 1
+        row["cache_hits"] += int(record["cache_hit"])
+        row["errors"] += int(record["status"] != "ok")
+        for column in ("prompt_tokens", "output_tokens", "thought_tokens", "cached_tokens",
+                       "upstream_calls", "retries", "latency_ms"):
+            row[column] += record[column]
+    return totals
+
+
+def _add_to_rollup(db, key, row):
+    hour, user_id, feature, model = key
+    match = db.query(UsageRollup).filter(
+        UsageRollup.hour == hour, UsageRollup.user_id == user_id,
+        UsageRollup.feature == feature, UsageRollup.model == model,
+    )
+    if match.update({getattr(UsageRollup, c): getattr(UsageRollup, c) + v for c, v in row.items()},
+                    synchronize_session=False):
+        return
+    try:
+        with db.begin_nested():
+            db.add(UsageRollup(hour=hour, user_id=user_id, feature=feature, model=model, **row))
+    except IntegrityError:
+        # Another worker created the row between our UPDATE and INSERT
+        match.update({getattr(UsageRollup, c): getattr(UsageRollup, c) + v for c, v in row.items()},
+                     synchronize_session=False)
+
+
+def flush() -> int:
+    """Write the buffered records and their rollups in one transaction"""
+    with _buffer_lock:
+        records = list(_buffer)
+        _buffer.clear()
+    if not records:
+        return 0
+    db = SessionLocal()
+    try:
+        db.execute(insert(UsageEvent), records)
+        for key, row in _rollup(records).items():
+            _add_to_rollup(db, key, row)
+        db.commit()
+    except Exception:
+        db.rollback()
+        # Put them back, in front of anything recorded since, for the next flush
+        with _buffer_lock:
+            _buffer.extendleft(reversed(records))
+            while len(_buffer) > USAGE_BUFFER_MAX:
+                _buffer.popleft()
+        raise
+    finally:
+        db.close()
+    USAGE_RECORDS.inc(len(records), outcome="written")
+    return len(records)
+
+
+# ── Quotas ──────────────────────────────────────────────
+
+def spent_tokens(totals: dict) -> int:
+    return totals["prompt_tokens"] + totals["output_tokens"] + totals["thought_tokens"]
+
+
+def usage_today(db, user_id: int) -> dict:
+    """The user's totals since UTC midnight, including records not yet written"""
+    midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    totals = get_usage_totals(db, user_id, midnight)
+    with _buffer_lock:
+        pending = [r for r in _buffer if r["user_id"] == user_id and r["created_at"] >= midnight]
+    for row in _rollup(pending).values():
+        for column, value in row.items():
+            totals[column] += value
+    return totals
+
+
+def over_quota(db, user_id: int) -> bool:
+    if not USAGE_LEDGER_ENABLED or not USAGE_DAILY_TOKEN_QUOTA or user_id is None:
+        return False
+    return spent_tokens(usage_today(db, user_id)) >= USAGE_DAILY_TOKEN_QUOTA
@@ -0,0 +1,384 @@
+"""Local quality checks for generated lessons.
+
+Everything here is pure string work, so a response can be checked and mostly
+repaired before deciding whether another upstream call is needed:
+
+- schema types (strings vs. the further_questions list), missing and empty fields
+- LaTeX: unbalanced math delimiters, braces and environments, and escapes
+  like "\\frac" that JSON decoding turned into control characters
+- Mermaid: a small grammar for flowcharts, sequence diagrams and pie charts
+"""
+import json
+import re
+
+# Fields a lesson is useless without
+REQUIRED_TEXT = ("foundations", "concepts", "keyconcepts")
+
+# Fields whose text may contain LaTeX
+LATEX_FIELDS = ("foundations", "concepts", "formulas", "keyconcepts", "problems", "study_plan")
+
+
+# ── Schema types ────────────────────────────────────────
+
+def _type_ok(value, spec) -> bool:
+    if spec.get("type") == "array":
+        return isinstance(value, list) and all(_type_ok(v, spec.get("items", {})) for v in value)
+    if spec.get("type") == "string":
+        return isinstance(value, str)
+    return True
+
+
+def _coerce(value, spec):
+    """Best local conversion of `value` to the schema type"""
+    if spec.get("type") == "array":
+        if isinstance(value, str):
+            # A list that came back as one string: one question per line
+            items = [re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip() for line in value.splitlines()]
+            items = [item for item in items if item]
+            return items or ([value.strip()] if value.strip() else [])
+        if isinstance(value, list):
+            return [v if isinstance(v, str) else json.dumps(v, ensure_ascii=False) for v in value if v is not None]
+        return [] if value is None else [str(value)]
+    if spec.get("type") == "string" and not isinstance(value, str):
+        if value is None:
+            return ""
+        if isinstance(value, list):
+            return "\n".join(v if isinstance(v, str) else json.dumps(v, ensure_ascii=False) for v in value)
+        if isinstance(value, dict):
+            return json.dumps(value, ensure_ascii=False)
+        return str(value)
+    return value
+
+
+# ── LaTeX ───────────────────────────────────────────────
+
+_MATH = re.compile(r"\$\$.+?\$\$|\$[^$]+?\$|\\\(.+?\\\)|\\\[.+?\\\]", re.DOTALL)
+
+# What's left of a LaTeX command after JSON decoding ate its "\t", "\r" or "\n"
+_TAB_COMMANDS = r"(?:heta|imes|extbf|extit|ext|frac|au|anh|an|ilde|riangle|op|o)\b"
+_CR_COMMANDS = r"(?:ho|ightarrow|ight|angle|ceil|floor|m)\b"
+_LF_COMMANDS = r"(?:abla|eq|eg|otin|ot|u|ewline|exists)\b"
+
+
+def fix_latex_escapes(text: str):
+    """Undo JSON escapes that were meant as LaTeX commands; returns (text, fixes).
+
+    "\\beta" and "\\frac" decode to backspace and form-feed, which are never
+    wanted, so those are restored everywhere. Tab, CR and LF are only restored
+    inside math segments, where "\\theta" vs. a real tab is unambiguous.
+    """
+    fixes = text.count("\x08") + text.count("\x0c")
+    text = text.replace("\x08", "\\b").replace("\x0c", "\\f")
+
+    def fix_segment(match):
+        nonlocal fixes
+        segment = match.group(0)
+        for char, tail, escape in (("\t", _TAB_COMMANDS, r"\\t"), ("\r", _CR_COMMANDS, r"\\r"), ("\n", _LF_COMMANDS, r"\\n")):
+            segment, count = re.subn(re.escape(char) + f"(?={tail})", escape, segment)
+            fixes += count
+        return segment
+
+    return _MATH.sub(fix_segment, text), fixes
+
+
+# A "$" not followed by a digit, up to the next "$"
+_INLINE_PAIR = re.compile(r"\$(?!\d)[^$]+?\$")
+_INLINE_OPENER = re.compile(r"\$\s*\w?[\\^_{]")
+
+
+def latex_issues(text: str):
+    """Unbalanced math delimiters, braces and environments in `text`"""
+    issues = []
+    body = text.replace("\\$", "")
+
+    display = body.count("$$")
+    if display % 2:
+        issues.append("unclosed $$ display math")
+    # Once the $...$ pairs are gone, a "$" left over is only an unclosed
+    # formula if math follows it; "$5" or "echo $HOME" is plain text
+    unpaired = _INLINE_PAIR.sub("", body.replace("$$", ""))
+    if _INLINE_OPENER.search(unpaired):
+        issues.append("unclosed $ inline math")
+    if body.count("\\(") != body.count("\\)"):
+        issues.append("unbalanced \\( \\)")
+    if body.count("\\[") != body.count("\\]"):
+        issues.append("unbalanced \\[ \\]")
+
+    stack = []
+    for kind, env in re.findall(r"\\(begin|end)\{([^}]*)\}", body):
+        if kind == "begin":
+            stack.append(env)
+        elif not stack or stack.pop() != env:
+            issues.append(f"\\end{{{env}}} without matching \\begin")
+            break
+    if stack:
+        issues.append(f"\\begin{{{stack[-1]}}} is never closed")
+
+    for segment in _MATH.findall(body):
+        depth = 0
+        for char in re.sub(r"\\[{}]", "", segment):
+            depth += char == "{"
+            depth -= char == "}"
+            if depth < 0:
+                break
+        if depth:
+            issues.append(f"unbalanced braces in {segment[:40]!r}")
+            break
+    return issues
+
+
+# ── Mermaid ─────────────────────────────────────────────
+
+_DIRECTIONS = ("TB", "TD", "BT", "RL", "LR")
+
+# Node shapes: opener -> accepted closers, longest openers first
+_SHAPES = [
+    ("(((", (")))",)), ("((", ("))",)), ("([", ("])",)), ("[[", ("]]",)), ("[(", (")]",)),
+    ("{{", ("}}",)), ("[/", ("/]", "\\]")), ("[\\", ("\\]", "/]")),
+    ("[", ("]",)), ("(", (")",)), ("{", ("}",)), (">", ("]",)),
+]
+_BRACKETS = "[](){}"
+# Hyphens are allowed in ids, but not the "--" or "-." that starts a link
+_NODE_ID = re.compile(r"[^\W](?:\w|-(?![-.>]))*", re.UNICODE)
+_LINK = re.compile(
+    r"(?:--|==|-\.)[ \t]+[^\n|]+?[ \t]+(?:-{2,}>|={2,}>|\.-+>|-{3,}|={3,}|\.-+)"  # -- text -->
+    r"|<?(?:-{2,}|={2,}|-\.+-|~{3,})[>ox]?"                                     # --> --- ==> -.-> ~~~
+)
+_LINK_LABEL = re.compile(r"\s*\|[^|\n]*\|")
+_FLOWCHART_KEYWORDS = ("classDef ", "class ", "style ", "linkStyle ", "click ", "direction ")
+
+
+def _parse_node(line, pos):
+    """Parse `ID[label]` at `pos`; returns the position after it or raises ValueError"""
+    match = _NODE_ID.match(line, pos)
+    if not match:
+        raise ValueError(f"expected a node id at {line[pos:pos + 15]!r}")
+    if match.group(0) == "end":
+        raise ValueError("'end' cannot be used as a node id")
+    pos = match.end()
+    for opener, closers in _SHAPES:
+        if not line.startswith(opener, pos):
+            continue
+        start = pos + len(opener)
+        if line.startswith('"', start):
+            label_end = line.find('"', start + 1)
+            if label_end < 0:
+                raise ValueError("unterminated quoted label")
+            label_end += 1
+        else:
+            ends = [i for i in (line.find(c, start) for c in closers) if i >= 0]
+            label_end = min(ends) if ends else -1
+            label = line[start:label_end] if label_end >= 0 else ""
+            # Square-bracket labels are quoted by preprocess_mermaid before
+            # rendering, so only nesting breaks them; other shapes are rendered as-is
+            forbidden = "[" if opener == "[" else _BRACKETS
+            if any(c in label for c in forbidden):
+                raise ValueError(f"brackets inside the label of node {match.group(0)}: quote the label")
+        closer = next((c for c in closers if line.startswith(c, label_end)), None) if label_end >= 0 else None
+        if closer is None:
+            raise ValueError(f"unclosed {opener!r} in node {match.group(0)}")
+        pos = label_end + len(closer)
+        break
+    if line.startswith(":::", pos):
+        cls = _NODE_ID.match(line, pos + 3)
+        if not cls:
+            raise ValueError("expected a class name after :::")
+        pos = cls.end()
+    return pos
+
+
+def _skip_space(line, pos):
+    while pos < len(line) and line[pos] in " \t":
+        pos += 1
+    return pos
+
+
+def _parse_flowchart_statement(line):
+    pos = _parse_node(line, _skip_space(line, 0))
+    while True:
+        pos = _skip_space(line, pos)
+        if pos >= len(line):
+            return
+        if line[pos] == "&":
+            pos = _parse_node(line, _skip_space(line, pos + 1))
+            continue
+        link = _LINK.match(line, pos)
+        if not link:
+            raise ValueError(f"expected a link or end of line at {line[pos:pos + 15]!r}")
+        pos = link.end()
+        label = _LINK_LABEL.match(line, pos)
+        if label:
+            pos = label.end()
+        pos = _skip_space(line, pos)
+        if pos >= len(line):
+            raise ValueError("link has no target node")
+        pos = _parse_node(line, pos)
+
+
+def _validate_flowchart(lines):
+    errors = []
+    depth = 0
+    for number, line in lines:
+        statement = line.rstrip(";").strip()
+        if statement.startswith("subgraph"):
+            depth += 1
+            continue
+        if statement == "end":
+            depth -= 1
+            if depth < 0:
+                errors.append(f"line {number}: 'end' without subgraph")
+                depth = 0
+            continue
+        if statement.startswith(_FLOWCHART_KEYWORDS):
+            continue
+        try:
+            _parse_flowchart_statement(statement)
+        except ValueError as e:
+            errors.append(f"line {number}: {e}")
+    if depth:
+        errors.append("subgraph is never closed with 'end'")
+    return errors
+
+
+_SEQ_MESSAGE = re.compile(r"[^\s:][^:]*?(?:-{1,2}>>|-{1,2}>|-{1,2}x|-{1,2}\))\s*[+-]?\s*[^\s:][^:]*:")
+_SEQ_BLOCKS = ("loop", "alt", "opt", "par", "critical", "break", "rect", "box")
+
+
+def _validate_sequence(lines):
+    errors = []
+    depth = 0
+    for number, line in lines:
+        word = line.split()[0]
+        if word in ("participant", "actor", "activate", "deactivate", "autonumber", "title", "create", "destroy", "links", "link"):
+            continue
+        if word in _SEQ_BLOCKS:
+            depth += 1
+            continue
+        if word in ("else", "and", "option"):
+            if not depth:
+                errors.append(f"line {number}: '{word}' outside a block")
+            continue
+        if word == "end":
+            depth -= 1
+            if depth < 0:
+                errors.append(f"line {number}: 'end' without a block")
+                depth = 0
+            continue
+        if word == "Note" or word == "note":
+            if not re.match(r"[Nn]ote\s+(left of|right of|over)\s+[^:]+:", line):
+                errors.append(f"line {number}: malformed note")
+            continue
+        if not _SEQ_MESSAGE.match(line):
+            errors.append(f"line {number}: expected 'A->>B: message', got {line[:30]!r}")
+    if depth:
+        errors.append("block is never closed with 'end'")
+    return errors
+
+
+def _validate_pie(lines):
+    errors = []
+    for number, line in lines:
+        if line.startswith(("title ", "showData")):
+            continue
+        if not re.match(r'"[^"]*"\s*:\s*-?\d+(\.\d+)?$', line):
+            errors.append(f'line {number}: expected \'"label" : value\', got {line[:30]!r}')
+    return errors
+
+
+# Diagram types we only check for a header and a non-empty body
+_OTHER_TYPES = (
+    "classDiagram", "stateDiagram", "stateDiagram-v2", "erDiagram", "gantt", "journey",
+    "gitGraph", "gitgraph", "mindmap", "timeline", "quadrantChart", "xychart-beta",
+)
+
+# Text our own fallbacks put in place of a diagram
+_PLACEHOLDERS = ("Diagram Not Available", "Diagram Error", "Please try regenerating", "No diagram available")
+
+
+def validate_mermaid(diagram: str):
+    """Syntax errors in a Mermaid diagram; an empty list means it should render"""
+    if not diagram or not diagram.strip():
+        return ["diagram is empty"]
+    if any(p in diagram for p in _PLACEHOLDERS):
+        return ["diagram is a placeholder"]
+
+    lines = [
+        (number, line.strip())
+        for number, line in enumerate(diagram.strip().splitlines(), 1)
+        if line.strip() and not line.strip().startswith("%%")
+    ]
+    first, _, rest = lines[0][1].partition(";")
+    header = first.split()
+    body = lines[1:]
+    kind = header[0]
+
+    if kind in ("graph", "flowchart"):
+        if len(header) > 2 or (len(header) == 2 and header[1] not in _DIRECTIONS):
+            return [f"line 1: expected 'graph <direction>', got {first!r}"]
+        if rest.strip():
+            # "graph TD; A-->B; B-->C" on one line
+            body = [(lines[0][0], part.strip()) for part in rest.split(";") if part.strip()] + body
+        errors = _validate_flowchart(body)
+    elif kind == "sequenceDiagram":
+        errors = _validate_sequence(body)
+    elif kind == "pie":
+        errors = _validate_pie(body)
+    elif kind in _OTHER_TYPES:
+        errors = []
+    else:
+        return [f"line 1: unknown diagram type {kind!r}"]
+
+    if not body:
+        errors.append("diagram has no content")
+    return errors
+
+
+# ── Whole responses ─────────────────────────────────────
+
+def find_issues(data: dict, schema: dict):
+    """[(field, kind, detail)] for everything wrong with a parsed response"""
+    issues = []
+    properties = schema.get("properties", {})
+    for field in schema.get("required", properties):
+        spec = properties.get(field, {})
+        if field not in data:
+            issues.append((field, "missing", "field is missing"))
+            continue
+        value = data[field]
+        if not _type_ok(value, spec):
+            issues.append((field, "type", f"expected {spec.get('type')}, got {type(value).__name__}"))
+            continue
+        if field in REQUIRED_TEXT and not value.strip():
+            issues.append((field, "empty", "field is empty"))
+        elif field in REQUIRED_TEXT and value.startswith("Error:"):
+            issues.append((field, "placeholder", "field holds an error placeholder"))
+        elif field == "further_questions" and not value:
+            issues.append((field, "empty", "no questions"))
+        elif field in LATEX_FIELDS:
+            issues.extend((field, "latex", detail) for detail in latex_issues(value))
+        elif field == "mermaid_diagram":
+            issues.extend((field, "mermaid", detail) for detail in validate_mermaid(value))
+    return issues
+
+
+def repair_locally(data: dict, schema: dict):
+    """Fill missing fields, coerce types and restore LaTeX escapes in place.
+
+    Returns the number of fixes; whatever is still wrong afterwards needs the model.
+    """
+    fixes = 0
+    properties = schema.get("properties", {})
+    for field in schema.get("required", properties):
+        spec = properties.get(field, {})
+        value = data.get(field)
+        if field not in data or not _type_ok(value, spec):
+            data[field] = _coerce(value, spec)
+            fixes += 1
+        if field in LATEX_FIELDS and isinstance(data[field], str):
+            data[field], count = fix_latex_escapes(data[field])
+            fixes += count
+        elif field == "further_questions" and isinstance(data[field], list):
+            fixed = [fix_latex_escapes(q) for q in data[field]]
+            data[field] = [q for q, _ in fixed]
+            fixes += sum(count for _, count in fixed)
+    return fixes
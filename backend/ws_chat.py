@@ -0,0 +1,120 @@
+"""Framing and flow control for the /ws/chat WebSocket.
+
+Protocol (JSON text frames). The client authenticates with `?token=` on the
+URL or with a first frame {"type": "auth", "token": ...}, then sends:
+
+    {"type": "prompt", "id": str|int, "prompt": str, "session_id": str?, "search": bool?}
+    {"type": "cancel", "id": str|int}
+    {"type": "ping"}
+
+A prompt or cancel with any other kind of id, or a prompt reusing the id of
+a turn still queued or running, is answered with a status 400 error.
+
+and receives, for each prompt in the order they were sent:
+
+    {"type": "accepted", "id", "session_id", "message_id"}    user turn saved
+    {"type": "section", "id", "field", "value"}               one per lesson field
+    {"type": "done", "id", "message_id", "cached"}            assistant turn saved
+    {"type": "error", "id", "status", "detail"}               the turn failed
+
+plus {"type": "ready", "user_id"} after authentication and {"type": "pong"}.
+
+Turns run one at a time per connection; up to WS_MAX_QUEUED_TURNS more wait
+behind it and further prompts are refused with status 429. Outgoing frames
+go through a queue of WS_SEND_QUEUE frames, so a client that stops reading
+pauses its own turn instead of growing server memory; one that hasn't read
+anything for WS_SEND_TIMEOUT seconds is disconnected (1008).
+"""
+import asyncio
+import json
+import os
+
+from starlette.websockets import WebSocketDisconnect
+
+from metrics import WS_FRAMES
+
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "64"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "30"))
+WS_MAX_QUEUED_TURNS = int(os.getenv("WS_MAX_QUEUED_TURNS", "4"))
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+# Frames larger than this are refused (1009) before they are parsed
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", "65536"))
+
+POLICY_VIOLATION = 1008
+MESSAGE_TOO_BIG = 1009
+
+
+class ChannelClosed(Exception):
+    """The connection is gone (or was closed for a protocol violation)"""
+
+
+class ChatChannel:
+    """One WebSocket connection: a bounded outbound queue drained by a single
+    sender task, and JSON frame parsing on the way in"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self._outbox = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+        self._sender = None
+        self.closed = False
+
+    def start(self):
+        self._sender = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        try:
+            while True:
+                frame = await self._outbox.get()
+                await self.websocket.send_text(frame)
+                WS_FRAMES.inc(direction="out")
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            self.closed = True
+
+    async def send(self, message: dict):
+        """Queue a frame, waiting while the client is behind on reading"""
+        if self.closed:
+            raise ChannelClosed()
+        frame = json.dumps(message, ensure_ascii=False, default=str)
+        try:
+            await asyncio.wait_for(self._outbox.put(frame), timeout=WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"[WS] Client stopped reading for {WS_SEND_TIMEOUT:g}s, disconnecting")
+            await self.close(POLICY_VIOLATION, "client not reading")
+            raise ChannelClosed()
+
+    async def receive(self, timeout: float = None) -> dict:
+        """The next frame as a dict; raises ChannelClosed on disconnect"""
+        try:
+            if timeout is None:
+                text = await self.websocket.receive_text()
+            else:
+                text = await asyncio.wait_for(self.websocket.receive_text(), timeout=timeout)
+        except (WebSocketDisconnect, RuntimeError):
+            self.closed = True
+            raise ChannelClosed()
+        WS_FRAMES.inc(direction="in")
+        if len(text) > WS_MAX_FRAME_BYTES:
+            await self.close(MESSAGE_TOO_BIG, "frame too large")
+            raise ChannelClosed()
+        try:
+            message = json.loads(text)
+        except json.JSONDecodeError:
+            return {"type": "invalid"}
+        return message if isinstance(message, dict) else {"type": "invalid"}
+
+    async def flush(self, timeout: float = 5.0):
+        """Give queued frames a chance to go out before closing"""
+        waited = 0.0
+        while not self._outbox.empty() and not self.closed and waited < timeout:
+            await asyncio.sleep(0.05)
+            waited += 0.05
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self._sender is not None:
+            self._sender.cancel()
+        if not self.closed:
+            self.closed = True
+            try:
+                await self.websocket.close(code=code, reason=reason)
+            except (RuntimeError, OSError):
+                pass